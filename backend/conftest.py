@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Tests convert the checked-in corpus into a scratch directory instead of next to main.py
+_scratch = tempfile.mkdtemp(prefix="reddit-ai-tests-")
+os.environ.setdefault("CORPUS_PATH", os.path.join(_scratch, "reddit_comments.jsonl"))
+os.environ.setdefault("PROFILE_DIR", os.path.join(_scratch, "profiles"))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Manual script that talks to the live Letta agents
+collect_ignore = ["test_letta.py"]
@@ -1,11 +1,21 @@
-import os, json, time
-from typing import List, Dict, Any
+import os, re, sys, json, hmac, math, mmap, time, zlib, random, asyncio, hashlib, inspect, weakref, tempfile, threading, contextlib, contextvars
+MODULE_LOAD_STARTED = time.perf_counter()
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 from urllib.parse import urlparse
 import httpx
-from fastapi import FastAPI, HTTPException, Body
+import numpy as np
+from fastapi import FastAPI, HTTPException, Body, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
 load_dotenv()
 
 API_PROVIDER = os.getenv("API_PROVIDER")
@@ -35,6 +45,135 @@ subreddit_summaries = {
     "askhistorians": "block-ff5d12cb-ba14-4240-8193-7fa9d38ba651"
 }
 
+# Narrated subreddit overviews are cached per subreddit and refreshed in the
+# background when the memory block's content hash changes or the TTL expires.
+# A failed refresh keeps the last good narration and is retried after the shorter retry TTL.
+SUBREDDIT_OVERVIEW_TTL = float(os.getenv("SUBREDDIT_OVERVIEW_TTL", "600"))
+SUBREDDIT_OVERVIEW_RETRY_TTL = float(os.getenv("SUBREDDIT_OVERVIEW_RETRY_TTL", "30"))
+subreddit_overview_cache: Dict[str, Dict[str, Any]] = {}
+subreddit_overview_tasks: Dict[str, asyncio.Task] = {}
+
+REDDIT_DATA_PATH = os.path.join(os.path.dirname(__file__), 'reddit_comments.json')
+# Append-only JSONL corpus + sidecar offset index, converted from REDDIT_DATA_PATH on first use
+CORPUS_PATH = os.getenv("CORPUS_PATH", os.path.join(os.path.dirname(__file__), 'reddit_comments.jsonl'))
+CORPUS_INDEX_PATH = os.getenv("CORPUS_INDEX_PATH", CORPUS_PATH + '.idx')
+# POST /api/corpus/posts requires this token in X-Admin-Token (empty disables ingestion)
+CORPUS_ADMIN_TOKEN = os.getenv("CORPUS_ADMIN_TOKEN", "")
+# Memory-mapped BM25 segment over the corpus
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", CORPUS_PATH + '.search')
+
+# Subreddit → agent routing table (hot-reloaded when the file changes)
+AGENT_ROUTING_PATH = os.getenv("AGENT_ROUTING_PATH", os.path.join(os.path.dirname(__file__), 'agent_routing.json'))
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "4096"))
+
+# Incremental analysis of live threads
+THREAD_STATE_CACHE_SIZE = int(os.getenv("THREAD_STATE_CACHE_SIZE", "512"))
+SUMMARY_DELTA_MIN_COMMENTS = int(os.getenv("SUMMARY_DELTA_MIN_COMMENTS", "10"))
+SUMMARY_DELTA_MIN_RATIO = float(os.getenv("SUMMARY_DELTA_MIN_RATIO", "0.2"))
+
+# Map-reduce summarization for very large threads
+SUMMARY_MAX_COMMENTS = int(os.getenv("SUMMARY_MAX_COMMENTS", "5000"))
+# Collapsed "load more comments" stubs are expanded 100 ids per /api/morechildren call, up to this many calls
+REDDIT_MORECHILDREN_URL = os.getenv("REDDIT_MORECHILDREN_URL", "https://www.reddit.com/api/morechildren.json")
+REDDIT_MORECHILDREN_CALLS = int(os.getenv("REDDIT_MORECHILDREN_CALLS", "60"))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000"))
+SUMMARY_CHUNK_BOUNDARY = int(os.getenv("SUMMARY_CHUNK_BOUNDARY", "4"))
+SUMMARY_MAP_CONCURRENCY = int(os.getenv("SUMMARY_MAP_CONCURRENCY", "4"))
+SUMMARY_CHUNK_CACHE_SIZE = int(os.getenv("SUMMARY_CHUNK_CACHE_SIZE", "2048"))
+
+# Array-backed comment trees for corpus posts
+COMMENT_TREE_CACHE_SIZE = int(os.getenv("COMMENT_TREE_CACHE_SIZE", "256"))
+
+# Moderation verdict cache (exact + near-duplicate reuse, scoped per agent)
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "20000"))
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", "86400"))
+VERDICT_SIMILARITY_THRESHOLD = float(os.getenv("VERDICT_SIMILARITY_THRESHOLD", "0.8"))
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+
+# Local pre-filter cascade in front of the Letta agents
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "false").lower() == "true"
+CASCADE_FINE_BELOW = float(os.getenv("CASCADE_FINE_BELOW", "0.08"))
+# Until an agent's scorer has learned from this many agent labels, FINE also needs a benign marker
+CASCADE_MIN_LABELS = int(os.getenv("CASCADE_MIN_LABELS", "200"))
+CASCADE_VIOLATION_ABOVE = float(os.getenv("CASCADE_VIOLATION_ABOVE", "0.92"))
+CASCADE_LEARNING_RATE = float(os.getenv("CASCADE_LEARNING_RATE", "0.1"))
+
+# Stratified-sample moderation estimates for huge threads
+SAMPLING_MAX_COMMENTS = int(os.getenv("SAMPLING_MAX_COMMENTS", "5000"))
+SAMPLING_INITIAL = int(os.getenv("SAMPLING_INITIAL", "40"))
+SAMPLING_STEP = int(os.getenv("SAMPLING_STEP", "30"))
+SAMPLING_BUDGET = int(os.getenv("SAMPLING_BUDGET", "200"))
+SAMPLING_MARGIN = float(os.getenv("SAMPLING_MARGIN", "0.05"))
+SAMPLING_CONFIDENCE = float(os.getenv("SAMPLING_CONFIDENCE", "0.95"))
+
+# Bounded Letta agent context
+LETTA_STATELESS_CLASSIFICATION = os.getenv("LETTA_STATELESS_CLASSIFICATION", "true").lower() != "false"
+# Optional JSON map of moderation agent name -> pre-created stateless classifier agent id.
+# Without an entry, an existing "<agent>-classifier" agent is reused before a new one is created.
+LETTA_CLASSIFIER_AGENTS = json.loads(os.getenv("LETTA_CLASSIFIER_AGENTS", "{}") or "{}")
+LETTA_COMPACTION_INTERVAL = float(os.getenv("LETTA_COMPACTION_INTERVAL", "900"))
+LETTA_MAX_HISTORY_MESSAGES = int(os.getenv("LETTA_MAX_HISTORY_MESSAGES", "200"))
+# Compaction keeps the system prompt and this many most recent messages in context
+LETTA_KEEP_MESSAGES = int(os.getenv("LETTA_KEEP_MESSAGES", "40"))
+LETTA_MAX_CONTEXT_TOKENS = int(os.getenv("LETTA_MAX_CONTEXT_TOKENS", "24000"))
+
+# Per-request deadline budgets (seconds). Clients replace them, up to REQUEST_DEADLINE_MAX, with an
+# X-Request-Timeout header, a `timeout` query parameter or a `timeout` field in the JSON body.
+# Moderation marks comments it could not reach in time as TIMEOUT, so its budget is generous.
+REQUEST_DEADLINE_DEFAULT = float(os.getenv("REQUEST_DEADLINE_DEFAULT", "120"))
+REQUEST_DEADLINE_MAX = float(os.getenv("REQUEST_DEADLINE_MAX", "600"))
+ENDPOINT_DEADLINES = {
+    "/api/summarize": 60.0,
+    "/api/analyze": 60.0,
+    "/api/compare": 90.0,
+    "/api/batch": 180.0,
+    "/api/moderate": 300.0,
+    "/api/insights": 300.0,
+}
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# Concurrent per-comment classifier calls within one moderation request
+MODERATION_CONCURRENCY = int(os.getenv("MODERATION_CONCURRENCY", "8"))
+
+# Large JSON payloads are parsed off the event loop ("thread" or "process" workers)
+JSON_OFFLOAD_BYTES = int(os.getenv("JSON_OFFLOAD_BYTES", str(256 * 1024)))
+JSON_PARSE_EXECUTOR = os.getenv("JSON_PARSE_EXECUTOR", "thread")
+JSON_PARSE_WORKERS = int(os.getenv("JSON_PARSE_WORKERS", "2"))
+
+# Full-text search
+SEARCH_MERGE_DOCS = int(os.getenv("SEARCH_MERGE_DOCS", "20000"))
+SEARCH_BM25_K1 = float(os.getenv("SEARCH_BM25_K1", "1.2"))
+SEARCH_BM25_B = float(os.getenv("SEARCH_BM25_B", "0.75"))
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "160"))
+
+# Related threads (TF-IDF + engagement/sentiment vectors, LSH candidates)
+RELATED_VOCAB_SIZE = int(os.getenv("RELATED_VOCAB_SIZE", "20000"))
+RELATED_DIM = int(os.getenv("RELATED_DIM", "128"))
+RELATED_FEATURE_WEIGHT = float(os.getenv("RELATED_FEATURE_WEIGHT", "0.35"))
+RELATED_LSH_TABLES = int(os.getenv("RELATED_LSH_TABLES", "8"))
+RELATED_LSH_BITS = int(os.getenv("RELATED_LSH_BITS", "8"))
+RELATED_REBUILD_FRACTION = float(os.getenv("RELATED_REBUILD_FRACTION", "0.25"))
+COMPARE_LOCAL_MAX_THREADS = int(os.getenv("COMPARE_LOCAL_MAX_THREADS", "500"))
+
+# Sentiment timelines
+TIMELINE_CACHE_SIZE = int(os.getenv("TIMELINE_CACHE_SIZE", "256"))
+TIMELINE_BASE_SECONDS = float(os.getenv("TIMELINE_BASE_SECONDS", "60"))
+TIMELINE_MAX_BASE_BUCKETS = int(os.getenv("TIMELINE_MAX_BASE_BUCKETS", "20000"))
+TIMELINE_TOXIC_THRESHOLD = float(os.getenv("TIMELINE_TOXIC_THRESHOLD", "0.5"))
+
+# Thread watch scheduler (WebSocket push)
+WATCH_CACHE_SIZE = int(os.getenv("WATCH_CACHE_SIZE", "256"))
+WATCH_MIN_INTERVAL = float(os.getenv("WATCH_MIN_INTERVAL", "15"))
+WATCH_MAX_INTERVAL = float(os.getenv("WATCH_MAX_INTERVAL", "600"))
+WATCH_TARGET_NEW_COMMENTS = float(os.getenv("WATCH_TARGET_NEW_COMMENTS", "5"))
+
+# Opt-in request profiling (empty token disables it) and event-loop lag logging
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), 'profiles'))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+LOOP_LAG_MONITOR = os.getenv("LOOP_LAG_MONITOR", "true").lower() != "false"
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -42,8 +181,388 @@ app.add_middleware(
     allow_methods=["*"], allow_headers=["*"]
 )
 
+@app.middleware("http")
+async def apply_request_deadline(request, call_next):
+    """Give every request a deadline: endpoint default, replaced by a header or query parameter."""
+    request_deadline.set(None)
+    set_request_deadline(ENDPOINT_DEADLINES.get(request.url.path, REQUEST_DEADLINE_DEFAULT))
+    set_request_deadline(request.headers.get("x-request-timeout") or request.query_params.get("timeout"), override=True)
+    return await call_next(request)
+
+# ---------- Profiling ----------
+# Opt-in per-request sampling: a caller presenting PROFILE_TOKEN (X-Profile header or ?profile=)
+# gets a background thread that samples every PROFILE_INTERVAL seconds. Wall-clock samples follow
+# each task the request spawned (registered through a task factory), either running on the loop
+# or suspended on an await; worker threads busy in this module (to_thread / Letta SDK calls) are
+# sampled too, along with a CPU profile weighted by per-thread CPU time. Output is a speedscope
+# file plus folded stacks for flamegraph.pl. Streaming responses are profiled until headers go out.
+
+profile_session: contextvars.ContextVar = contextvars.ContextVar("profile_session", default=None)
+EXECUTOR_WORKER_FILE = os.path.join("concurrent", "futures", "thread.py")
+
+def frame_chain(frame) -> list:
+    """Frames from the outermost caller down to `frame`."""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+def await_chain(coro) -> tuple:
+    """Frames along a suspended coroutine's await chain, plus a label for what it is waiting on."""
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    waiting = f"[awaiting {type(coro).__name__}]" if coro is not None else "[suspended]"
+    return frames, waiting
+
+def thread_cpu_time(ident: int) -> Optional[float]:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+# Per loop: how many profiling sessions are running; the last one to finish removes the task factory
+profiling_sessions = weakref.WeakKeyDictionary()
+
+def profiling_task_factory(loop, coro, context=None):
+    task = asyncio.Task(coro, loop=loop, context=context) if context is not None else asyncio.Task(coro, loop=loop)
+    session = context.get(profile_session) if context is not None else profile_session.get()
+    if session is not None:
+        session.tasks.add(task)
+    return task
+
+class RequestProfiler:
+    """Samples one request's tasks and the worker threads doing module work until stopped."""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.tasks = weakref.WeakSet()
+        self.task_labels = weakref.WeakKeyDictionary()
+        self.frames: List[Dict[str, Any]] = []
+        self.frame_index: Dict[tuple, int] = {}
+        self.wall: Dict[str, List[tuple]] = {}
+        self.cpu: List[tuple] = []
+        self.cpu_seen: Dict[int, float] = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if loop.get_task_factory() is None:
+            loop.set_task_factory(profiling_task_factory)
+        profiling_sessions[loop] = profiling_sessions.get(loop, 0) + 1
+        self.loop_thread = threading.get_ident()
+        self.tasks.add(asyncio.current_task())
+        profile_session.set(self)
+        self.started = self.last = time.perf_counter()
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            try:
+                self.sample()
+            except RuntimeError:
+                # The task set changed under us; take the next sample
+                continue
+
+    def stack_ids(self, frames, leaf: str = None) -> tuple:
+        ids = []
+        for frame in frames:
+            code = frame.f_code
+            key = (code.co_name, code.co_filename, code.co_firstlineno)
+            if key not in self.frame_index:
+                self.frame_index[key] = len(self.frames)
+                self.frames.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+            ids.append(self.frame_index[key])
+        if leaf:
+            key = (leaf, "", 0)
+            if key not in self.frame_index:
+                self.frame_index[key] = len(self.frames)
+                self.frames.append({"name": leaf})
+            ids.append(self.frame_index[key])
+        return tuple(ids)
+
+    def sample(self):
+        now = time.perf_counter()
+        elapsed, self.last = now - self.last, now
+        current = sys._current_frames()
+        loop_frames = frame_chain(current.get(self.loop_thread))
+        on_loop = {id(f): i for i, f in enumerate(loop_frames)}
+        for task in list(self.tasks):
+            if task.done():
+                continue
+            frames, waiting = await_chain(task.get_coro())
+            if not frames:
+                continue
+            if task not in self.task_labels:
+                self.task_labels[task] = f"task {len(self.task_labels) + 1}: {task.get_name()}"
+            samples = self.wall.setdefault(self.task_labels[task], [])
+            if id(frames[0]) in on_loop:
+                # Running right now: the loop thread's real stack from this task's entry point
+                samples.append((self.stack_ids(loop_frames[on_loop[id(frames[0])]:], "[running]"), elapsed))
+            else:
+                samples.append((self.stack_ids(frames, waiting), elapsed))
+        for ident, frame in current.items():
+            if ident == threading.get_ident():
+                continue
+            frames = frame_chain(frame)
+            if ident != self.loop_thread:
+                # Executor threads (to_thread, sync Letta SDK calls) currently inside this module
+                if not any(f.f_code.co_filename.endswith(EXECUTOR_WORKER_FILE) for f in frames):
+                    continue
+                if not any(f.f_code.co_filename == __file__ for f in frames):
+                    continue
+                self.wall.setdefault(f"worker thread {ident}", []).append((self.stack_ids(frames), elapsed))
+            cpu = thread_cpu_time(ident)
+            if cpu is not None:
+                used = cpu - self.cpu_seen.get(ident, cpu)
+                self.cpu_seen[ident] = cpu
+                if used > 0:
+                    self.cpu.append((self.stack_ids(frames), used))
+
+    def detach(self):
+        """Called on the loop when the request ends; unprofiled traffic goes back to plain task creation."""
+        loop = asyncio.get_running_loop()
+        profiling_sessions[loop] = profiling_sessions.get(loop, 1) - 1
+        if profiling_sessions[loop] <= 0:
+            del profiling_sessions[loop]
+            if loop.get_task_factory() is profiling_task_factory:
+                loop.set_task_factory(None)
+
+    def stop_and_write(self) -> str:
+        """Stop sampling and write <PROFILE_DIR>/<time>-<label>.speedscope.json and .folded."""
+        self.stopped.set()
+        self.thread.join()
+        duration = time.perf_counter() - self.started
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{re.sub(r'[^A-Za-z0-9]+', '_', self.label).strip('_')}")
+
+        def profile(name: str, samples: List[tuple]) -> Dict[str, Any]:
+            return {
+                "type": "sampled", "name": name, "unit": "seconds", "startValue": 0, "endValue": duration,
+                "samples": [list(stack) for stack, _ in samples], "weights": [weight for _, weight in samples],
+            }
+
+        document = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.label,
+            "exporter": "reddit-ai request profiler",
+            "shared": {"frames": self.frames},
+            "profiles": [profile(f"wall: {name}", samples) for name, samples in self.wall.items()] + [profile("cpu: all threads", self.cpu)],
+        }
+        with open(base + ".speedscope.json", 'w', encoding='utf-8') as f:
+            json.dump(document, f)
+        folded = Counter()
+        for name, samples in self.wall.items():
+            for stack, weight in samples:
+                folded[";".join([name] + [self.frames[i]["name"] for i in stack])] += weight
+        with open(base + ".folded", 'w', encoding='utf-8') as f:
+            for stack, weight in folded.items():
+                f.write(f"{stack} {max(1, round(weight * 1e6))}\n")
+        return base + ".speedscope.json"
+
+# Event-loop lag: a heartbeat coroutine ticks every LOOP_LAG_THRESHOLD / 4; a watchdog thread that
+# sees it go stale captures what the loop thread is executing and logs it once the stall ends.
+
+loop_lag_state: Dict[str, Any] = {"loop": None, "beat": 0.0, "thread_id": None, "task": None, "max_lag": 0.0, "stalls": deque(maxlen=50)}
+
+def blocking_culprit(frame) -> Dict[str, Any]:
+    """Innermost coroutine and innermost frame of this module on the loop thread's stack."""
+    culprit = {"coroutine": None, "location": None}
+    innermost = frame
+    while frame is not None:
+        code = frame.f_code
+        if culprit["location"] is None and code.co_filename == __file__:
+            culprit["location"] = f"main.py:{frame.f_lineno} in {code.co_name}"
+        if culprit["coroutine"] is None and code.co_flags & inspect.CO_COROUTINE:
+            culprit["coroutine"] = getattr(code, "co_qualname", code.co_name)
+        if culprit["location"] and culprit["coroutine"]:
+            break
+        frame = frame.f_back
+    if culprit["location"] is None and innermost is not None:
+        culprit["location"] = f"{os.path.basename(innermost.f_code.co_filename)}:{innermost.f_lineno} in {innermost.f_code.co_name}"
+    return culprit
+
+async def loop_heartbeat():
+    while True:
+        loop_lag_state["beat"] = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_THRESHOLD / 4)
+
+def watch_loop_lag(loop):
+    stall = None
+    while loop_lag_state["loop"] is loop and not loop.is_closed():
+        time.sleep(LOOP_LAG_THRESHOLD / 4)
+        lag = time.monotonic() - loop_lag_state["beat"]
+        if lag > LOOP_LAG_THRESHOLD and loop.is_running():
+            if stall is None:
+                stall = blocking_culprit(sys._current_frames().get(loop_lag_state["thread_id"]))
+            stall["lag"] = lag
+        elif stall is not None:
+            # Blocked for roughly the stalest heartbeat seen, minus one tick
+            blocked = max(0.0, stall.pop("lag") - LOOP_LAG_THRESHOLD / 4)
+            stall.update(blocked_ms=round(blocked * 1000, 1), at=time.time())
+            loop_lag_state["stalls"].append(stall)
+            loop_lag_state["max_lag"] = max(loop_lag_state["max_lag"], blocked)
+            print(f"Warning: event loop blocked for {stall['blocked_ms']}ms in {stall['coroutine'] or '?'} ({stall['location']})")
+            stall = None
+    if loop_lag_state["loop"] is loop:
+        loop_lag_state["loop"] = None
+
+def ensure_loop_lag_monitor():
+    """Start the heartbeat and watchdog for the running loop (once per loop)."""
+    loop = asyncio.get_running_loop()
+    if not LOOP_LAG_MONITOR or loop_lag_state["loop"] is loop:
+        return
+    loop_lag_state.update(loop=loop, beat=time.monotonic(), thread_id=threading.get_ident())
+    loop_lag_state["task"] = loop.create_task(loop_heartbeat())
+    threading.Thread(target=watch_loop_lag, args=(loop,), name="loop-lag-monitor", daemon=True).start()
+
+@app.middleware("http")
+async def profile_request(request, call_next):
+    """Profile the request when an authorized caller asks for it (X-Profile header or ?profile=)."""
+    ensure_loop_lag_monitor()
+    token = request.headers.get("x-profile") or request.query_params.get("profile")
+    # Compare bytes: compare_digest rejects non-ASCII str with a TypeError
+    if not token or not PROFILE_TOKEN or not hmac.compare_digest(token.encode("utf-8"), PROFILE_TOKEN.encode("utf-8")):
+        return await call_next(request)
+    profiler = RequestProfiler(f"{request.method} {request.url.path}")
+    profiler.start()
+    try:
+        response = await call_next(request)
+    finally:
+        profiler.detach()
+        path = await asyncio.to_thread(profiler.stop_and_write)
+    response.headers["X-Profile-Output"] = path
+    return response
+
 # ---------- helpers ----------
 
+class LRUCache(OrderedDict):
+    """Small bounded mapping that evicts the least recently used key."""
+
+    def __init__(self, maxsize: int = 1024, on_evict=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            evicted_key, evicted = self.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(evicted_key, evicted)
+
+# ---------- JSON parsing ----------
+
+def loads_json(data):
+    """orjson when installed (several times faster on large payloads), stdlib json otherwise."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+json_parse_pool: Dict[str, Any] = {"executor": None}
+
+async def run_parse_job(size: int, fn, *args, allow_process: bool = True):
+    """Run a parse/extract function inline for small inputs, otherwise in a worker so the loop stays free.
+
+    Jobs that fill in-process caches (e.g. comment trees) pass allow_process=False.
+    """
+    if size < JSON_OFFLOAD_BYTES:
+        return fn(*args)
+    if allow_process and JSON_PARSE_EXECUTOR == "process":
+        if json_parse_pool["executor"] is None:
+            from concurrent.futures import ProcessPoolExecutor
+            json_parse_pool["executor"] = ProcessPoolExecutor(max_workers=JSON_PARSE_WORKERS)
+        return await asyncio.get_running_loop().run_in_executor(json_parse_pool["executor"], fn, *args)
+    return await asyncio.to_thread(fn, *args)
+
+# ---------- Request deadlines ----------
+
+class DeadlineExceeded(HTTPException):
+    def __init__(self, detail: str = "Request deadline exceeded"):
+        super().__init__(status_code=504, detail=detail)
+
+class RedditFetchError(HTTPException):
+    def __init__(self, detail: str = "Could not fetch the thread from Reddit"):
+        super().__init__(status_code=502, detail=detail)
+
+request_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+def set_request_deadline(seconds, override: bool = False) -> None:
+    """Set the current request's deadline to `seconds` (at most REQUEST_DEADLINE_MAX) from now.
+    Server defaults only tighten an existing deadline; a client-supplied value (override=True) replaces it.
+    """
+    try:
+        seconds = float(seconds)
+    except (TypeError, ValueError):
+        return
+    if seconds <= 0:
+        return
+    deadline = time.monotonic() + min(seconds, REQUEST_DEADLINE_MAX)
+    current = request_deadline.get()
+    if override or current is None or deadline < current:
+        request_deadline.set(deadline)
+
+def time_left():
+    """Seconds until the current deadline, or None when there is none."""
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def deadline_exceeded() -> bool:
+    remaining = time_left()
+    return remaining is not None and remaining <= 0
+
+def upstream_timeout(default: float) -> float:
+    """Timeout for one upstream call: its usual cap, shortened to what is left of the budget."""
+    remaining = time_left()
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return min(default, remaining)
+
+async def gather_until_deadline(factories: List, limit: int = BATCH_CONCURRENCY) -> List[tuple]:
+    """Run coroutine factories concurrently until the deadline; returns one
+    ("ok", value) / ("error", exc) / ("timeout", None) tuple per factory, in order.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def guarded(factory):
+        async with semaphore:
+            return await factory()
+
+    tasks = [asyncio.create_task(guarded(f)) for f in factories]
+    if not tasks:
+        return []
+    remaining = time_left()
+    done, pending = await asyncio.wait(tasks, timeout=None if remaining is None else max(0.0, remaining))
+    for task in pending:
+        task.cancel()
+    outcomes = []
+    for task in tasks:
+        if task in pending:
+            outcomes.append(("timeout", None))
+        elif isinstance(task.exception(), DeadlineExceeded):
+            outcomes.append(("timeout", None))
+        elif task.exception() is not None:
+            outcomes.append(("error", task.exception()))
+        else:
+            outcomes.append(("ok", task.result()))
+    return outcomes
+
 def reddit_json_url(thread_url: str) -> str:
     # works for many public threads: https://www.reddit.com/r/.../postid/.json
     u = thread_url
@@ -56,11 +575,27 @@ def reddit_json_url(thread_url: str) -> str:
 
 async def fetch_reddit_comments(thread_url: str) -> List[str]:
     """Path A: scrape public JSON without OAuth (hackathon-fast)."""
+    return [c["body"] for c in await fetch_reddit_comment_records(thread_url)]
+
+async def fetch_reddit_comment_records(thread_url: str, sort: str = "", include_replies: bool = False, limit: int = 200,
+                                       strict: bool = False) -> List[Dict[str, Any]]:
+    """Same scrape as fetch_reddit_comments, but keeps each comment's id and metadata.
+    With include_replies, nested replies are flattened too and tagged with their top-level `root_id`.
+    Failures fall back to mock comments unless `strict`, which raises RedditFetchError instead;
+    anything that keeps state across calls must be strict so mock comments never get merged in.
+    """
     # Demo mode: return mock comments for testing
     if not ANTHROPIC_API_KEY:
-        return generate_mock_comments()
+        return generate_mock_comment_records()
     
     url = reddit_json_url(thread_url)
+    params = []
+    if sort:
+        params.append(f"sort={sort}")
+    if include_replies:
+        params.append(f"limit={min(limit, 500)}")
+    if params:
+        url = f"{url}?{'&'.join(params)}"
     headers = {
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
@@ -74,30 +609,140 @@ async def fetch_reddit_comments(thread_url: str) -> List[str]:
         "Sec-Fetch-Site": "none",
         "Cache-Control": "max-age=0"
     }
+
+    async def download() -> List[Dict[str, Any]]:
+        async with httpx.AsyncClient(timeout=upstream_timeout(20)) as client:
+            async with client.stream("GET", url, headers=headers) as r:
+                if r.status_code != 200:
+                    raise RedditFetchError(f"Reddit returned HTTP {r.status_code}")
+                raw = bytearray()
+                async for chunk in r.aiter_bytes():
+                    raw.extend(chunk)
+            # Big payloads are decoded and flattened off the event loop
+            comments, more_ids, link_id = await run_parse_job(len(raw), extract_comment_records, bytes(raw), include_replies, limit)
+            if more_ids and link_id and len(comments) < limit:
+                await expand_more_comments(client, headers, link_id, more_ids, comments, include_replies, limit)
+            return comments
+
     try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            r = await client.get(url, headers=headers)
-            if r.status_code != 200:
-                # Fall back to mock data if Reddit fetch fails
-                return generate_mock_comments()
-            data = r.json()
-        # Reddit JSON: [post, comments]; comments in data[1]['data']['children']
-        comments = []
+        # httpx timeouts apply per read; the request deadline bounds the whole download
+        remaining = time_left()
         try:
-            for child in data[1]["data"]["children"]:
-                body = child["data"].get("body")
-                if body:
-                    comments.append(body)
-        except Exception as e:
-            pass
+            comments = await asyncio.wait_for(download(), timeout=None if remaining is None else max(0.0, remaining))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Deadline exceeded while fetching the thread")
         
         # If no comments found, fall back to mock data
-        if not comments:
-            return generate_mock_comments()
-        return comments[:200]  # cap for speed
+        if not comments and not strict:
+            return generate_mock_comment_records()
+        return comments[:limit]  # cap for speed
+    except DeadlineExceeded:
+        raise
+    except httpx.TimeoutException:
+        if deadline_exceeded():
+            raise DeadlineExceeded("Deadline exceeded while fetching the thread")
+        if strict:
+            raise RedditFetchError("Timed out fetching the thread from Reddit")
+        return generate_mock_comment_records()
+    except Exception as e:
+        # Any other error (or Reddit refusing), fall back to mock data
+        if not strict:
+            return generate_mock_comment_records()
+        if isinstance(e, RedditFetchError):
+            raise
+        raise RedditFetchError(f"Could not fetch the thread from Reddit: {e}") from e
+
+def comment_record(c: Dict[str, Any], root_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    body = c.get("body")
+    if not body:
+        return None
+    comment_id = c.get("id") or hashlib.sha1(body.encode("utf-8")).hexdigest()[:10]
+    return {
+        "id": comment_id,
+        "body": body,
+        "score": c.get("score", 0),
+        "created_utc": c.get("created_utc", 0.0),
+        "parent_id": c.get("parent_id", ""),
+        "depth": c.get("depth", 0),
+        "root_id": root_id or comment_id
+    }
+
+def extract_comment_records(raw: bytes, include_replies: bool = False, limit: int = 200) -> tuple:
+    """Decode a Reddit thread payload and flatten its comments (runs in a worker for big payloads).
+
+    Returns (records, ids behind collapsed "more" stubs, post fullname) so the caller can expand the stubs.
+    """
+    # Reddit JSON: [post, comments]; comments in data[1]['data']['children']
+    comments = []
+    more_ids: List[str] = []
+    link_id = ""
+    try:
+        data = loads_json(raw)
+        link_id = data[0]["data"]["children"][0]["data"].get("name", "")
+        # Depth-first, in thread order; replies only when asked for
+        stack = [(child, None) for child in reversed(data[1]["data"]["children"])]
+        while stack and len(comments) < limit:
+            child, root_id = stack.pop()
+            c = child.get("data", {})
+            if child.get("kind") == "more":
+                if include_replies or root_id is None:
+                    more_ids.extend(c.get("children", []))
+                continue
+            record = comment_record(c, root_id)
+            if record is None:
+                continue
+            comments.append(record)
+            replies = c.get("replies")
+            if include_replies and isinstance(replies, dict):
+                for reply in reversed(replies.get("data", {}).get("children", [])):
+                    stack.append((reply, record["root_id"]))
     except Exception as e:
-        # Any other error, fall back to mock data
-        return generate_mock_comments()
+        pass
+    return comments, more_ids, link_id
+
+async def expand_more_comments(client: httpx.AsyncClient, headers: Dict[str, str], link_id: str, more_ids: List[str],
+                               comments: List[Dict[str, Any]], include_replies: bool, limit: int) -> None:
+    """Fetch the comments hidden behind "load more" stubs through /api/morechildren and append them.
+
+    Reddit returns them flat with parent ids, so each one's root comes from its parent's record.
+    """
+    roots = {c["id"]: c["root_id"] for c in comments}
+    pending = list(more_ids)
+    calls = 0
+    while pending and len(comments) < limit and calls < REDDIT_MORECHILDREN_CALLS:
+        batch, pending = pending[:100], pending[100:]
+        calls += 1
+        r = await client.get(REDDIT_MORECHILDREN_URL, headers=headers, params={
+            "api_type": "json", "link_id": link_id, "children": ",".join(batch), "limit_children": "false",
+        })
+        if r.status_code != 200:
+            break
+        things = r.json().get("json", {}).get("data", {}).get("things", [])
+        for thing in things:
+            c = thing.get("data", {})
+            if thing.get("kind") == "more":
+                pending.extend(c.get("children", []))
+                continue
+            parent = c.get("parent_id", "")
+            top_level = parent.startswith("t3_")
+            if not (include_replies or top_level):
+                continue
+            record = comment_record(c, None if top_level else roots.get(parent[3:]))
+            if record is None or record["id"] in roots:
+                continue
+            roots[record["id"]] = record["root_id"]
+            comments.append(record)
+            if len(comments) >= limit:
+                break
+
+def generate_mock_comment_records() -> List[Dict[str, Any]]:
+    """Mock comments with stable ids, so incremental analysis works in demo mode"""
+    now = time.time()
+    mock = generate_mock_comments()
+    return [
+        {"id": f"mock{i}", "body": body, "score": 1, "created_utc": now - (len(mock) - i) * 60, "parent_id": "", "depth": 0, "root_id": f"mock{i}"}
+        for i, body in enumerate(mock)
+    ]
 
 def generate_mock_comments() -> List[str]:
     """Generate realistic mock Reddit comments for demo purposes"""
@@ -137,6 +782,47 @@ def build_summary_prompt(comments: List[str]) -> List[Dict[str, str]]:
         {"role": "user", "content": user}
     ]
 
+def build_incremental_summary_prompt(previous_summary: str, new_comments: List[str]) -> List[Dict[str, str]]:
+    text = "\n\n".join(f"- {c}" for c in new_comments[:150])
+    system = (
+        "You are Reddit:AI, keeping a running summary of a live Reddit discussion.\n"
+        "Update the previous summary with the new comments. Output 3 concise sentences capturing: "
+        "(1) main viewpoints, (2) any consensus/conflict, (3) overall tone. No usernames. No quotes."
+    )
+    user = f"Previous summary:\n{previous_summary}\n\nNew comments:\n{text}\n\nNow produce the updated 3-sentence summary."
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user}
+    ]
+
+def build_chunk_summary_prompt(comments: List[str]) -> List[Dict[str, str]]:
+    text = "\n\n".join(f"- {c}" for c in comments)
+    system = (
+        "You are Reddit:AI, summarizing one slice of a large Reddit discussion.\n"
+        "Output 2-3 concise sentences capturing the viewpoints, disagreements and tone in this slice. "
+        "No usernames. No quotes."
+    )
+    user = f"Comments:\n{text}\n\nNow produce the summary of this slice."
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user}
+    ]
+
+def build_reduce_summary_prompt(partial_summaries: List[str], final: bool = True) -> List[Dict[str, str]]:
+    text = "\n\n".join(f"- {p}" for p in partial_summaries)
+    system = (
+        "You are Reddit:AI, combining partial summaries of one Reddit discussion into a single summary.\n"
+        + ("Output 3 concise sentences capturing: (1) main viewpoints, "
+           "(2) any consensus/conflict, (3) overall tone. No usernames. No quotes."
+           if final else
+           "Output 2-3 concise sentences that preserve the main viewpoints, conflicts and tone. No usernames. No quotes.")
+    )
+    user = f"Partial summaries:\n{text}\n\nNow produce the combined summary."
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user}
+    ]
+
 def build_analysis_prompt(comments: List[str]) -> List[Dict[str, str]]:
     joined = "\n".join(comments[:200])
     system = (
@@ -163,15 +849,20 @@ async def claude_chat(messages: List[Dict[str,str]], max_tokens: int = 250) -> s
         return generate_mock_response(messages)
     
     # Route to appropriate API based on provider
-    if API_PROVIDER == "anthropic" and ANTHROPIC_API_KEY:
-        return await call_anthropic_api(messages, max_tokens)
-    elif API_PROVIDER == "openai" and OPENAI_API_KEY:
-        return await call_openai_api(messages, max_tokens)
-    elif API_PROVIDER == "gemini" and GEMINI_API_KEY:
-        return await call_gemini_api(messages, max_tokens)
-    else:
-        # Or demo mode
-        return generate_mock_response(messages)
+    try:
+        if API_PROVIDER == "anthropic" and ANTHROPIC_API_KEY:
+            return await call_anthropic_api(messages, max_tokens)
+        elif API_PROVIDER == "openai" and OPENAI_API_KEY:
+            return await call_openai_api(messages, max_tokens)
+        elif API_PROVIDER == "gemini" and GEMINI_API_KEY:
+            return await call_gemini_api(messages, max_tokens)
+        else:
+            # Or demo mode
+            return generate_mock_response(messages)
+    except httpx.TimeoutException:
+        if deadline_exceeded():
+            raise DeadlineExceeded("Deadline exceeded while waiting for the AI provider")
+        raise
 
 async def call_openai_api(messages: List[Dict[str,str]], max_tokens: int) -> str:
     """Call OpenAI API"""
@@ -185,7 +876,7 @@ async def call_openai_api(messages: List[Dict[str,str]], max_tokens: int) -> str
         "Authorization": f"Bearer {OPENAI_API_KEY}",
         "Content-Type": "application/json"
     }
-    async with httpx.AsyncClient(timeout=60) as client:
+    async with httpx.AsyncClient(timeout=upstream_timeout(60)) as client:
         r = await client.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
         if r.status_code != 200:
             raise HTTPException(status_code=502, detail=f"OpenAI error: {r.text}")
@@ -213,7 +904,7 @@ async def call_anthropic_api(messages: List[Dict[str,str]], max_tokens: int) ->
         "Content-Type": "application/json",
         "anthropic-version": "2023-06-01"
     }
-    async with httpx.AsyncClient(timeout=60) as client:
+    async with httpx.AsyncClient(timeout=upstream_timeout(60)) as client:
         r = await client.post("https://api.anthropic.com/v1/messages", headers=headers, json=payload)
         if r.status_code != 200:
             raise HTTPException(status_code=502, detail=f"Anthropic error: {r.text}")
@@ -241,7 +932,7 @@ async def call_gemini_api(messages: List[Dict[str,str]], max_tokens: int) -> str
         "Content-Type": "application/json"
     }
     url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key={GEMINI_API_KEY}"
-    async with httpx.AsyncClient(timeout=60) as client:
+    async with httpx.AsyncClient(timeout=upstream_timeout(60)) as client:
         r = await client.post(url, headers=headers, json=payload)
         if r.status_code != 200:
             raise HTTPException(status_code=502, detail=f"Gemini error: {r.text}")
@@ -275,27 +966,190 @@ def generate_mock_response(messages: List[Dict[str,str]]) -> str:
 
 # ---------- Letta AI Moderation Functions ----------
 
+letta_client_state: Dict[str, Any] = {"client": None}
+
 def get_letta_client():
-    """Initialize Letta client with API key"""
+    """Letta client; the SDK is imported and the client built on first use, then reused"""
     if not LETTA_API_KEY:
         raise HTTPException(status_code=500, detail="Letta API key not configured")
     
+    if letta_client_state["client"] is None:
+        try:
+            from letta_client import Letta
+            letta_client_state["client"] = Letta(token=LETTA_API_KEY)
+        except ImportError:
+            raise HTTPException(status_code=500, detail="Letta SDK not installed. Run: pip install letta")
+    return letta_client_state["client"]
+
+# ---------- Letta agent context management ----------
+# Every messages.create call on a persistent agent grows its history. Per-comment classification
+# goes to a stateless twin (message_buffer_autoclear, same memory blocks) so long-term memory lives
+# only in the blocks; the remaining stateful calls are trimmed by a periodic compaction task,
+# which drops older messages from the context window (they stay in Letta's recall storage).
+# Latency and prompt size are tracked per agent so growth shows up in /api/moderate/health.
+
+letta_agent_stats: Dict[str, Dict[str, Any]] = {}
+letta_classifier_agents: Dict[str, str] = {}
+letta_classifier_lock = threading.Lock()
+# The compaction task is started on the event loop at startup; letta_send (always on a worker
+# thread) only records the client and the counts the task reads
+letta_maintenance: Dict[str, Any] = {"task": None, "client": None}
+# letta_send runs on classification threads concurrently
+letta_stats_lock = threading.Lock()
+
+def get_agent_stats(agent_id: str) -> Dict[str, Any]:
+    stats = letta_agent_stats.get(agent_id)
+    if stats is None:
+        stats = {
+            "calls": 0,
+            "history_messages": 0,
+            "compactions": 0,
+            "last_compacted": None,
+            "stateless": False,
+            "recent": deque(maxlen=50),
+        }
+        letta_agent_stats[agent_id] = stats
+    return stats
+
+def letta_send(client, agent_id: str, content: str):
+    """Send one user message to an agent, recording latency and context size."""
+    started = time.perf_counter()
+    resp = client.agents.messages.create(
+        agent_id=agent_id,
+        messages=[{"role": "user", "content": content}],
+    )
+    latency = time.perf_counter() - started
+    usage = getattr(resp, "usage", None)
+    prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+    with letta_stats_lock:
+        stats = get_agent_stats(agent_id)
+        stats["calls"] += 1
+        if not stats["stateless"]:
+            stats["history_messages"] += len(getattr(resp, "messages", []) or []) + 1
+        stats["recent"].append((latency, prompt_tokens))
+        letta_maintenance["client"] = client
+    return resp
+
+def get_classifier_agent(client, agent_id: str) -> str:
+    """Stateless twin of a moderation agent for per-comment classification; falls back to the agent itself."""
+    if not LETTA_STATELESS_CLASSIFICATION:
+        return agent_id
+    if agent_id in letta_classifier_agents:
+        return letta_classifier_agents[agent_id]
+    with letta_classifier_lock:
+        if agent_id in letta_classifier_agents:
+            return letta_classifier_agents[agent_id]
+        agent_name = next((name for name, aid in LETTA_AGENTS.items() if aid == agent_id), agent_id)
+        classifier_id = LETTA_CLASSIFIER_AGENTS.get(agent_name)
+        if not classifier_id:
+            try:
+                classifier_id = find_or_create_classifier_twin(client, agent_id, agent_name)
+            except Exception as e:
+                print(f"Warning: Could not create stateless classifier for {agent_name}: {e}")
+                classifier_id = agent_id
+        letta_classifier_agents[agent_id] = classifier_id
+        if classifier_id != agent_id:
+            get_agent_stats(classifier_id)["stateless"] = True
+        return classifier_id
+
+def find_or_create_classifier_twin(client, agent_id: str, agent_name: str) -> str:
+    """Reuse the twin an earlier process or deploy created (matched by name); create one only if none exists."""
+    source = client.agents.retrieve(agent_id=agent_id)
+    twin_name = f"{getattr(source, 'name', agent_name)}-classifier"
+    existing = sorted(client.agents.list(name=twin_name) or [], key=lambda a: str(getattr(a, "created_at", "") or ""))
+    if existing:
+        return existing[0].id
+    blocks = getattr(getattr(source, "memory", None), "blocks", None) or []
+    twin = client.agents.create(
+        name=twin_name,
+        system=getattr(source, "system", None),
+        llm_config=getattr(source, "llm_config", None),
+        embedding_config=getattr(source, "embedding_config", None),
+        block_ids=[b.id for b in blocks if getattr(b, "id", None)],
+        message_buffer_autoclear=True,
+        include_base_tools=False,
+    )
+    print(f"Created classifier agent {twin_name} ({twin.id}); pin it with LETTA_CLASSIFIER_AGENTS")
+    return twin.id
+
+def compact_agent_history(client, agent_id: str) -> bool:
+    """Trim the agent's in-context messages to its system prompt plus the last LETTA_KEEP_MESSAGES.
+    Nothing is deleted: trimmed messages stay searchable in the agent's recall memory.
+    """
     try:
-        from letta_client import Letta
-        return Letta(token=LETTA_API_KEY)
-    except ImportError:
-        raise HTTPException(status_code=500, detail="Letta SDK not installed. Run: pip install letta")
+        agent = client.agents.retrieve(agent_id=agent_id)
+        message_ids = list(getattr(agent, "message_ids", None) or [])
+        kept = message_ids
+        if len(message_ids) > LETTA_KEEP_MESSAGES + 1:
+            kept = message_ids[:1] + message_ids[-LETTA_KEEP_MESSAGES:]
+            client.agents.modify(agent_id=agent_id, message_ids=kept)
+    except Exception as e:
+        print(f"Warning: Could not compact agent {agent_id}: {e}")
+        return False
+    with letta_stats_lock:
+        stats = get_agent_stats(agent_id)
+        stats["history_messages"] = max(0, len(kept) - 1)
+        stats["compactions"] += 1
+        stats["last_compacted"] = time.time()
+    return True
+
+def agent_needs_compaction(stats: Dict[str, Any]) -> bool:
+    if stats["stateless"]:
+        return False
+    last_prompt_tokens = stats["recent"][-1][1] if stats["recent"] else 0
+    return stats["history_messages"] >= LETTA_MAX_HISTORY_MESSAGES or last_prompt_tokens >= LETTA_MAX_CONTEXT_TOKENS
+
+async def run_letta_compaction():
+    request_deadline.set(None)
+    while True:
+        await asyncio.sleep(LETTA_COMPACTION_INTERVAL)
+        client = letta_maintenance["client"]
+        if client is None:
+            continue
+        with letta_stats_lock:
+            due = [agent_id for agent_id, stats in letta_agent_stats.items() if agent_needs_compaction(stats)]
+        for agent_id in due:
+            await asyncio.to_thread(compact_agent_history, client, agent_id)
+
+def ensure_letta_compaction():
+    """Start the periodic compaction task on the running event loop, once (call from the loop)."""
+    task = letta_maintenance["task"]
+    if task is not None and not task.done():
+        return
+    letta_maintenance["task"] = asyncio.get_running_loop().create_task(run_letta_compaction())
+
+def letta_context_stats() -> Dict[str, Any]:
+    report = {}
+    for agent_id, stats in letta_agent_stats.items():
+        recent = list(stats["recent"])
+        half = len(recent) // 2
+        def avg(rows, col):
+            return round(sum(r[col] for r in rows) / len(rows), 3) if rows else 0.0
+        report[agent_id] = {
+            "calls": stats["calls"],
+            "stateless": stats["stateless"],
+            "history_messages": stats["history_messages"],
+            "compactions": stats["compactions"],
+            "last_compacted": stats["last_compacted"],
+            "recent_latency_s": avg(recent, 0),
+            "recent_prompt_tokens": avg(recent, 1),
+            # Older vs newer half of the window: roughly equal means calls are staying flat
+            "latency_trend_s": [avg(recent[:half], 0), avg(recent[half:], 0)],
+            "prompt_tokens_trend": [avg(recent[:half], 1), avg(recent[half:], 1)],
+        }
+    return report
 
 async def create_or_get_shared_memory(client):
     """Create or retrieve shared memory block for cross-agent coordination"""
     try:
         # Try to get existing shared memory block
-        shared_memory = client.blocks.get_by_label("shared_thread_memory")
+        shared_memory = await asyncio.to_thread(client.blocks.get_by_label, "shared_thread_memory")
         return shared_memory
     except Exception:
         # Create new shared memory block if it doesn't exist
         try:
-            shared_memory = client.blocks.create(
+            shared_memory = await asyncio.to_thread(
+                client.blocks.create,
                 label="shared_thread_memory",
                 description="Cross-agent shared log for thread moderation decisions.",
                 value="[]"
@@ -356,6 +1210,7 @@ def update_subreddit_summary(client, agent_name: str, new_thread_summary: Dict[s
         prev["rules_triggered"] = int(prev.get("rules_triggered", 0)) + int(new_thread_summary.get("rule_hits", 0))
         prev["overview"] = summarize_recent_activity(prev)
         client.blocks.modify(block_id, value=json.dumps(prev))
+        invalidate_subreddit_overview(agent_name)
 
     except Exception:
         pass
@@ -384,121 +1239,1467 @@ async def describe_subreddit_from_memory(client, subreddit_key: str, memory_data
             "and do not include metrics unless needed. Keep it neutral, readable, and suitable for a sidebar overview.\n\n"
             f"Memory JSON:\n{payload_json}"
         )
-        resp = client.agents.messages.create(
-            agent_id=agent_id,
-            messages=[{"role": "user", "content": prompt}],
-        )
+        resp = await asyncio.to_thread(letta_send, client, agent_id, prompt)
         text = str(resp.messages[-1].content).strip()
         return text
     except Exception:
         return ""
 
-def get_agent_for_subreddit(subreddit: str) -> tuple:
-    import re
-    subreddit = subreddit.lower()
-    patterns = {
-        "worldnews": [
-            r"^worldnews$",
-            r"^news$",
-            r"^politics$",
-            r"^worldpolitics$",
-            r"^geopolitics$",
-            r"^europe$",
-            r"^canada$",
-            r"^australia$",
-            r"^ukpolitics$"
-        ],
-        "askreddit": [
-            r"^askreddit$",
-            r"^ask$",
-            r"^questions$",
-            r"^casualconversation$",
-            r"^unpopularopinion$",
-            r"^changemyview$",
-            r"^explainlikeimfive$",
-            r"^nostupidquestions$",
-            r"^tooafraidtoask$"
+def invalidate_subreddit_overview(subreddit_key: str):
+    """Mark a cached overview as stale so the next page load refreshes it in the background."""
+    entry = subreddit_overview_cache.get(subreddit_key)
+    if entry:
+        entry["refreshed_at"] = 0.0
+
+def subreddit_overview_stale(entry: Dict[str, Any]) -> bool:
+    return time.time() - entry["refreshed_at"] > entry.get("ttl", SUBREDDIT_OVERVIEW_TTL)
+
+async def refresh_subreddit_overview(subreddit_key: str) -> Dict[str, Any]:
+    """Re-read the subreddit memory block and re-narrate it only if its content hash changed."""
+    request_deadline.set(None)  # runs in the background, past the triggering request's budget
+    entry = subreddit_overview_cache.get(subreddit_key)
+    try:
+        client = get_letta_client()
+        block = await asyncio.to_thread(client.blocks.retrieve, subreddit_summaries[subreddit_key])
+        raw = getattr(block, 'value', None) or ""
+        data = json.loads(raw) if raw else {}
+    except Exception as e:
+        print(f"Warning: overview refresh failed for r/{subreddit_key}: {e}")
+        # Cache the failure too, so page loads don't retry Letta until the retry TTL passes
+        entry = {"hash": None, "overview": "", **(entry or {}), "refreshed_at": time.time(), "ttl": SUBREDDIT_OVERVIEW_RETRY_TTL}
+        subreddit_overview_cache[subreddit_key] = entry
+        return entry
+    content_hash = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    if entry and entry["hash"] == content_hash and entry["overview"]:
+        entry["refreshed_at"] = time.time()
+        entry.pop("ttl", None)
+        return entry
+    overview_text = ""
+    if isinstance(data, dict):
+        # Prefer an agent-composed description; fallback to stored overview text
+        agent_view = await describe_subreddit_from_memory(client, subreddit_key, data)
+        overview_text = agent_view.strip() or str(data.get("overview", "")).strip()
+    if not overview_text and entry:
+        # Keep serving the previous narration rather than blanking the sidebar
+        overview_text = entry["overview"]
+    entry = {"hash": content_hash, "overview": overview_text, "refreshed_at": time.time()}
+    subreddit_overview_cache[subreddit_key] = entry
+    return entry
+
+def schedule_subreddit_overview_refresh(subreddit_key: str) -> asyncio.Task:
+    """Start (or join) the single in-flight refresh for a subreddit."""
+    task = subreddit_overview_tasks.get(subreddit_key)
+    if task is None or task.done():
+        task = asyncio.create_task(refresh_subreddit_overview(subreddit_key))
+        subreddit_overview_tasks[subreddit_key] = task
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+# ---------- Scraped corpus storage ----------
+# One post per JSONL line: {"url", "post", "comments"}, written so the bytes up to `meta_length`
+# plus a closing brace parse as the post header alone. The sidecar index is also append-only:
+# one JSON line per post with its byte offset, length, meta_length, subreddit and comment count.
+
+# Pre-forked workers share the files: conversion and appends hold an flock on CORPUS_PATH + ".lock",
+# and each worker reads whatever the others appended to the index (index_size is how far it has read).
+# by_subreddit maps each subreddit to an insertion-ordered dict of its post ids (a set that keeps file order)
+corpus_state: Dict[str, Any] = {"mmap": None, "file": None, "by_id": {}, "by_subreddit": {}, "end": 0, "index_size": 0, "loaded": False}
+corpus_lock = threading.Lock()
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Exclusive flock held across processes (and threads, since each call opens its own descriptor)."""
+    import fcntl
+    with open(path, "a+b") as handle:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+def count_comment_tree(comments: List[Dict[str, Any]]) -> int:
+    """Count comments including nested replies without recursion."""
+    total = 0
+    stack = list(comments)
+    while stack:
+        comment = stack.pop()
+        total += 1
+        stack.extend(comment.get('replies', []))
+    return total
+
+def encode_corpus_record(item: Dict[str, Any]) -> tuple:
+    header = json.dumps({"url": item.get("url"), "post": item.get("post", {})}, ensure_ascii=False)[:-1].encode("utf-8")
+    comments = json.dumps(item.get("comments", []), ensure_ascii=False).encode("utf-8")
+    return header + b', "comments": ' + comments + b'}\n', len(header)
+
+def write_corpus_record(data_file, index_file, item: Dict[str, Any], offset: int) -> Dict[str, Any]:
+    line, meta_length = encode_corpus_record(item)
+    post = item.get("post", {})
+    entry = {
+        "id": post.get("id"),
+        "subreddit": str(post.get("subreddit", "")).lower(),
+        "offset": offset,
+        "length": len(line) - 1,
+        "meta_length": meta_length,
+        "comment_count": count_comment_tree(item.get("comments", []))
+    }
+    data_file.write(line)
+    index_file.write((json.dumps(entry) + "\n").encode("utf-8"))
+    return entry
+
+def convert_corpus(src_path: str = REDDIT_DATA_PATH, dst_path: str = CORPUS_PATH, index_path: str = CORPUS_INDEX_PATH):
+    """One-off conversion of the monolithic JSON array into the JSONL corpus and its index."""
+    with open(src_path, 'r', encoding='utf-8') as f:
+        all_posts = json.load(f)
+    data_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst_path)), suffix='.tmp')
+    index_fd, tmp_index = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix='.tmp')
+    offset = 0
+    try:
+        with open(data_fd, 'wb') as data_file, open(index_fd, 'wb') as index_file:
+            for item in all_posts:
+                entry = write_corpus_record(data_file, index_file, item, offset)
+                offset += entry["length"] + 1
+        # The index goes last: once it exists the data file it points into does too
+        os.replace(tmp_path, dst_path)
+        os.replace(tmp_index, index_path)
+    finally:
+        for path in (tmp_path, tmp_index):
+            if os.path.exists(path):
+                os.remove(path)
+
+def ensure_corpus_files():
+    """Convert the legacy JSON file once, even with several threads or workers asking at the same time."""
+    if os.path.exists(CORPUS_PATH) and os.path.exists(CORPUS_INDEX_PATH):
+        return
+    if not os.path.exists(REDDIT_DATA_PATH):
+        raise FileNotFoundError(CORPUS_PATH)
+    with file_lock(CORPUS_PATH + '.lock'):
+        if not os.path.exists(CORPUS_PATH) or not os.path.exists(CORPUS_INDEX_PATH):
+            convert_corpus(REDDIT_DATA_PATH, CORPUS_PATH, CORPUS_INDEX_PATH)
+
+def index_corpus_entry(entry: Dict[str, Any]):
+    corpus_state["by_id"][entry["id"]] = entry
+    corpus_state["by_subreddit"].setdefault(entry["subreddit"], {})[entry["id"]] = None
+
+def remap_corpus():
+    if corpus_state["mmap"] is not None:
+        corpus_state["mmap"].close()
+        corpus_state["file"].close()
+        corpus_state["mmap"] = corpus_state["file"] = None
+    if os.path.getsize(CORPUS_PATH) == 0:
+        return
+    corpus_state["file"] = open(CORPUS_PATH, 'rb')
+    corpus_state["mmap"] = mmap.mmap(corpus_state["file"].fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_corpus_index() -> List[Dict[str, Any]]:
+    """Index the complete lines appended to the sidecar index since we last read it (caller holds corpus_lock)."""
+    with open(CORPUS_INDEX_PATH, 'rb') as f:
+        f.seek(corpus_state["index_size"])
+        chunk = f.read()
+    # A line another worker is still writing is picked up next time
+    chunk = chunk[:chunk.rfind(b"\n") + 1]
+    entries = [json.loads(line) for line in chunk.splitlines() if line.strip()]
+    for entry in entries:
+        index_corpus_entry(entry)
+        corpus_state["end"] = max(corpus_state["end"], entry["offset"] + entry["length"] + 1)
+    corpus_state["index_size"] += len(chunk)
+    return entries
+
+def open_corpus():
+    """Load the offset index and memory-map the corpus, converting the legacy JSON file if needed.
+    Once loaded, picks up posts other workers have appended since.
+    """
+    if corpus_state["loaded"]:
+        refresh_corpus_index()
+        return
+    ensure_corpus_files()
+    with corpus_lock:
+        if corpus_state["loaded"]:
+            return
+        read_corpus_index()
+        remap_corpus()
+        corpus_state["loaded"] = True
+
+def refresh_corpus_index():
+    """Index records other workers appended; search is fed under its own lock first to keep lock order."""
+    try:
+        if os.path.getsize(CORPUS_INDEX_PATH) <= corpus_state["index_size"]:
+            return
+    except OSError:
+        return
+    with search_lock, corpus_lock:
+        added = read_corpus_index()
+        for entry in added:
+            comment_tree_cache.pop(entry["id"], None)
+            if search_state["loaded"]:
+                index_search_post(entry, loads_json(read_corpus_bytes(entry["offset"], entry["length"])))
+
+def read_corpus_bytes(offset: int, length: int) -> bytes:
+    mm = corpus_state["mmap"]
+    if mm is None or offset + length > len(mm):
+        remap_corpus()
+        mm = corpus_state["mmap"]
+    return mm[offset:offset + length]
+
+def get_corpus_post(post_id: str, with_comments: bool = True):
+    """Return one corpus record (or just its url/post header) by post id, or None."""
+    open_corpus()
+    entry = corpus_state["by_id"].get(post_id)
+    if entry is None:
+        return None
+    if with_comments:
+        return loads_json(read_corpus_bytes(entry["offset"], entry["length"]))
+    return loads_json(read_corpus_bytes(entry["offset"], entry["meta_length"]) + b'}')
+
+def corpus_post_size(post_id: str) -> int:
+    open_corpus()
+    entry = corpus_state["by_id"].get(post_id)
+    return entry["length"] if entry else 0
+
+def get_corpus_subreddit_posts(subreddit: str) -> List[tuple]:
+    """(index entry, url/post header) pairs for a subreddit, without touching comment bytes."""
+    open_corpus()
+    return [
+        (corpus_state["by_id"][post_id], get_corpus_post(post_id, with_comments=False))
+        for post_id in corpus_state["by_subreddit"].get(subreddit.lower(), [])
+    ]
+
+def iter_corpus_posts():
+    """Yield every full record in file order."""
+    open_corpus()
+    for entry in sorted(corpus_state["by_id"].values(), key=lambda e: e["offset"]):
+        yield loads_json(read_corpus_bytes(entry["offset"], entry["length"]))
+
+def append_corpus_post(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Append a newly scraped post; later versions of a post id shadow earlier ones."""
+    open_corpus()
+    with search_lock, corpus_lock, file_lock(CORPUS_PATH + '.lock'):
+        # Catch up with other workers' appends first so the index stays in file order
+        added = read_corpus_index()
+        with open(CORPUS_PATH, 'ab') as data_file, open(CORPUS_INDEX_PATH, 'ab') as index_file:
+            # The offset is only trustworthy while we hold the flock
+            offset = data_file.seek(0, os.SEEK_END)
+            entry = write_corpus_record(data_file, index_file, item, offset)
+            # Readers in other workers trust the index line, so the data must reach the file first
+            data_file.flush()
+            index_file.flush()
+            index_size = index_file.seek(0, os.SEEK_END)
+        index_corpus_entry(entry)
+        corpus_state["end"] = offset + entry["length"] + 1
+        corpus_state["index_size"] = index_size
+        for other in added:
+            comment_tree_cache.pop(other["id"], None)
+            if search_state["loaded"]:
+                index_search_post(other, loads_json(read_corpus_bytes(other["offset"], other["length"])))
+        comment_tree_cache.pop(entry["id"], None)
+        index_search_post(entry, item)
+    return entry
+
+# ---------- Compact comment trees ----------
+# A post's comments as parallel arrays in pre-order, so every subtree is the contiguous
+# range [i, i + subtree_size[i]). Bodies live in one string buffer addressed by offsets;
+# authors are interned. Tree metrics are NumPy passes; nested JSON is rendered on demand.
+
+comment_tree_cache = LRUCache(COMMENT_TREE_CACHE_SIZE)
+
+def build_comment_tree(post_id: str, comments: List[Dict[str, Any]]) -> Dict[str, Any]:
+    ids: List[str] = []
+    author_idx: List[int] = []
+    authors: List[str] = []
+    author_lookup: Dict[str, int] = {}
+    parent: List[int] = []
+    depth: List[int] = []
+    score: List[int] = []
+    created: List[float] = []
+    offsets: List[int] = [0]
+    bodies: List[str] = []
+    # Stored parent_id/depth that disagree with the tree position (e.g. replies to a deleted
+    # comment saved at top level); rendering puts them back, stats use the tree position
+    overrides: Dict[int, Dict[str, Any]] = {}
+    stack = [(c, -1, 0) for c in reversed(comments)]
+    while stack:
+        comment, parent_index, level = stack.pop()
+        index = len(ids)
+        ids.append(str(comment.get('id', '')))
+        author = comment.get('author') or ""
+        if author not in author_lookup:
+            author_lookup[author] = len(authors)
+            authors.append(author)
+        author_idx.append(author_lookup[author])
+        parent.append(parent_index)
+        depth.append(level)
+        stored_parent, stored_depth = comment.get('parent_id'), comment.get('depth')
+        if stored_parent and stored_parent != (f"t1_{ids[parent_index]}" if parent_index >= 0 else f"t3_{post_id}"):
+            overrides.setdefault(index, {})["parent_id"] = stored_parent
+        if stored_depth is not None and stored_depth != level:
+            overrides.setdefault(index, {})["depth"] = stored_depth
+        score.append(int(comment.get('score') or 0))
+        created.append(float(comment.get('created_utc') or 0.0))
+        body = comment.get('body') or ""
+        bodies.append(body)
+        offsets.append(offsets[-1] + len(body))
+        for reply in reversed(comment.get('replies', [])):
+            stack.append((reply, index, level + 1))
+    tree = {
+        "post_id": post_id,
+        "ids": ids,
+        "authors": authors,
+        "author_idx": np.asarray(author_idx, dtype=np.int32),
+        "parent": np.asarray(parent, dtype=np.int32),
+        "depth": np.asarray(depth, dtype=np.int16),
+        "score": np.asarray(score, dtype=np.int64),
+        "created_utc": np.asarray(created, dtype=np.float64),
+        "body_offsets": np.asarray(offsets, dtype=np.int64),
+        "body_buffer": "".join(bodies),
+        "overrides": overrides,
+    }
+    tree["subtree_size"] = compute_subtree_sizes(tree)
+    return tree
+
+def compute_subtree_sizes(tree: Dict[str, Any]) -> np.ndarray:
+    """Accumulate sizes bottom-up one depth level at a time (vectorized within each level)."""
+    parent, depth = tree["parent"], tree["depth"]
+    size = np.ones(len(parent), dtype=np.int64)
+    if not len(parent):
+        return size
+    for level in range(int(depth.max()), 0, -1):
+        at_level = depth == level
+        np.add.at(size, parent[at_level], size[at_level])
+    return size
+
+def get_comment_tree(post_id: str):
+    tree = comment_tree_cache.get(post_id)
+    if tree is None:
+        item = get_corpus_post(post_id)
+        if item is None:
+            return None
+        tree = build_comment_tree(post_id, item.get('comments', []))
+        comment_tree_cache.put(post_id, tree)
+    return tree
+
+def comment_tree_stats(tree: Dict[str, Any], top_n: int = 10, bucket_seconds: float = 3600.0) -> Dict[str, Any]:
+    n = len(tree["ids"])
+    if not n:
+        return {"total_comments": 0, "max_depth": 0, "depth_histogram": [], "top_comments": [], "time_buckets": [], "largest_threads": []}
+    score, created, size = tree["score"], tree["created_utc"], tree["subtree_size"]
+    top_n = min(top_n, n)
+    top = np.argpartition(-score, top_n - 1)[:top_n]
+    top = top[np.argsort(-score[top], kind="stable")]
+    start = float(created.min())
+    buckets = np.bincount(((created - start) // bucket_seconds).astype(np.int64))
+    roots = np.flatnonzero(tree["parent"] == -1)
+    largest = roots[np.argsort(-size[roots], kind="stable")][:top_n]
+    return {
+        "total_comments": n,
+        "max_depth": int(tree["depth"].max()),
+        "depth_histogram": np.bincount(tree["depth"]).tolist(),
+        "top_comments": [
+            {"id": tree["ids"][i], "score": int(score[i]), "depth": int(tree["depth"][i]), "body": comment_body(tree, i)[:200]}
+            for i in top.tolist()
         ],
-        "science": [
-            r"^science$",
-            r"^technology$",
-            r"^futurology$",
-            r"^space$",
-            r"^biology$",
-            r"^chemistry$",
-            r"^physics$",
-            r"^medicine$",
-            r"^askscience$",
-            r"^computerscience$",
-            r"^programming$",
-            r"^machinelearning$",
-            r"^artificial$",
-            r"^environment$",
-            r"^climate$"
+        "time_buckets": [
+            {"start_utc": start + k * bucket_seconds, "count": int(c)} for k, c in enumerate(buckets.tolist())
         ],
-        "askhistorians": [
-            r"^askhistorians$",
-            r"^history$",
-            r"^askhistory$",
-            r"^worldhistory$",
-            r"^medieval$",
-            r"^ancient$",
-            r"^wwii$",
-            r"^wwi$",
-            r"^civilwar$",
-            r"^renaissance$"
-        ]
+        "largest_threads": [{"id": tree["ids"][i], "size": int(size[i])} for i in largest.tolist()],
     }
-    for agent_name, pattern_list in patterns.items():
-        for pattern in pattern_list:
-            if re.match(pattern, subreddit):
-                return agent_name, LETTA_AGENTS[agent_name]
-    return "general", LETTA_AGENTS["general"]
 
-async def moderate_with_agent(client, agent_id: str, thread_text: str, subreddit_name: str):
-    try:
-        response = client.agents.messages.create(
-            agent_id=agent_id,
-            messages=[{
-                "role": "user",
-                "content": f"Moderate this Reddit thread/comment:\n\n{thread_text}\n\nOutput must include only: decision (FINE, NEEDS_WARNING, or VIOLATION), confidence (0-1), and reason."
-            }]
+def comment_body(tree: Dict[str, Any], i: int) -> str:
+    offsets = tree["body_offsets"]
+    return tree["body_buffer"][offsets[i]:offsets[i + 1]]
+
+def render_comment_tree(tree: Dict[str, Any], offset: int = 0, limit: int = None) -> List[Dict[str, Any]]:
+    """Rebuild the nested {..., "replies": [...]} shape for a window of top-level comments."""
+    roots = np.flatnonzero(tree["parent"] == -1)
+    roots = roots[offset:offset + limit if limit is not None else None]
+    post_id, overrides = tree["post_id"], tree.get("overrides", {})
+    rendered: List[Dict[str, Any]] = []
+    nodes: Dict[int, Dict[str, Any]] = {}
+    for root in roots.tolist():
+        for i in range(root, root + int(tree["subtree_size"][root])):
+            p = int(tree["parent"][i])
+            node = {
+                "id": tree["ids"][i],
+                "author": tree["authors"][tree["author_idx"][i]],
+                "body": comment_body(tree, i),
+                "score": int(tree["score"][i]),
+                "created_utc": float(tree["created_utc"][i]),
+                "parent_id": f"t1_{tree['ids'][p]}" if p >= 0 else f"t3_{post_id}",
+                "depth": int(tree["depth"][i]),
+                "replies": []
+            }
+            if i in overrides:
+                node.update(overrides[i])
+            nodes[i] = node
+            if p >= 0:
+                nodes[p]["replies"].append(node)
+            else:
+                rendered.append(node)
+        nodes.clear()
+    return rendered
+
+# ---------- Full-text search ----------
+# BM25 over post titles/selftext and comment bodies. The persisted segment is a single file:
+# an 8-byte header length, a JSON header (array layout, post ids, subreddits, covered corpus
+# end) and raw arrays read straight from the memory map -- sorted term bytes, CSR posting
+# lists and per-document columns. Posts appended since the last merge live in an in-memory
+# delta that is folded into a new segment once it reaches SEARCH_MERGE_DOCS documents.
+
+SEARCH_TOKEN_RE = re.compile(r"[a-z0-9']+", re.IGNORECASE)
+SEARCH_DOC_COLUMNS = {
+    "doc_post": np.int32,
+    "doc_comment": np.int32,
+    "doc_subreddit": np.int32,
+    "doc_created": np.float64,
+    "doc_score": np.int64,
+    "doc_length": np.int32,
+    "doc_offset": np.int64,
+}
+
+search_lock = threading.RLock()
+search_state: Dict[str, Any] = {
+    "loaded": False, "main": None, "delta": None, "columns": None, "corpus_end": 0,
+    "post_ids": [], "post_lookup": {}, "subreddits": [], "subreddit_lookup": {},
+}
+
+def search_tokens(text: str) -> List[str]:
+    tokens = (m.group().lower().strip("'") for m in SEARCH_TOKEN_RE.finditer(text))
+    return [t for t in tokens if t and len(t) <= 40]
+
+def empty_search_delta() -> Dict[str, Any]:
+    return {"postings": {}, "columns": {name: [] for name in SEARCH_DOC_COLUMNS}}
+
+def search_intern(names_key: str, lookup_key: str, value: str) -> int:
+    lookup = search_state[lookup_key]
+    if value not in lookup:
+        lookup[value] = len(search_state[names_key])
+        search_state[names_key].append(value)
+    return lookup[value]
+
+def main_search_docs() -> int:
+    main = search_state["main"]
+    return len(main["doc_post"]) if main else 0
+
+def add_search_document(post_idx: int, comment_idx: int, subreddit_idx: int, created: float, score: int, offset: int, text: str):
+    tokens = search_tokens(text)
+    if not tokens:
+        return
+    delta = search_state["delta"]
+    columns = delta["columns"]
+    doc = main_search_docs() + len(columns["doc_post"])
+    for term, tf in Counter(tokens).items():
+        docs, tfs = delta["postings"].setdefault(term, ([], []))
+        docs.append(doc)
+        tfs.append(tf)
+    for name, value in zip(SEARCH_DOC_COLUMNS, (post_idx, comment_idx, subreddit_idx, created, score, len(tokens), offset)):
+        columns[name].append(value)
+    search_state["columns"] = None
+
+def index_search_record(entry: Dict[str, Any], item: Dict[str, Any]):
+    """Add one corpus record: the post itself plus every comment, in comment-tree pre-order."""
+    post = item.get("post", {})
+    post_idx = search_intern("post_ids", "post_lookup", entry["id"])
+    subreddit_idx = search_intern("subreddits", "subreddit_lookup", entry["subreddit"])
+    add_search_document(
+        post_idx, -1, subreddit_idx, float(post.get("created_utc") or 0.0), int(post.get("score") or 0),
+        entry["offset"], f"{post.get('title') or ''}\n{post.get('selftext') or ''}"
+    )
+    tree = build_comment_tree(entry["id"], item.get("comments", []))
+    for i in range(len(tree["ids"])):
+        add_search_document(
+            post_idx, i, subreddit_idx, float(tree["created_utc"][i]), int(tree["score"][i]),
+            entry["offset"], comment_body(tree, i)
         )
-        agent_reply = response.messages[-1].content
-        decision = "UNKNOWN"
-        confidence = 0.5
-        reason = agent_reply
-        if "VIOLATION" in agent_reply.upper():
-            decision = "VIOLATION"
-        elif "NEEDS_WARNING" in agent_reply.upper() or "WARNING" in agent_reply.upper():
-            decision = "NEEDS_WARNING"
-        elif "FINE" in agent_reply.upper() or "CLEAN" in agent_reply.upper():
-            decision = "FINE"
-        import re
-        confidence_match = re.search(r'confidence[:\s]*([0-9.]+)', agent_reply.lower())
-        if confidence_match:
-            try:
-                confidence = float(confidence_match.group(1))
-            except:
-                pass
-        return {
-            "subreddit": subreddit_name,
-            "agent_id": agent_id,
-            "decision": decision,
-            "confidence": confidence,
-            "reason": reason,
-            "raw_response": agent_reply
+
+def search_live_mask(columns: Dict[str, np.ndarray]) -> np.ndarray:
+    """Documents from a post version that a later append has shadowed are dead."""
+    by_id = corpus_state["by_id"]
+    current = np.asarray([by_id[p]["offset"] if p in by_id else -1 for p in search_state["post_ids"]], dtype=np.int64)
+    if not len(columns["doc_post"]):
+        return np.zeros(0, dtype=bool)
+    return columns["doc_offset"] == current[columns["doc_post"]]
+
+def search_columns() -> Dict[str, Any]:
+    """Main + delta document columns with the live mask and BM25 collection stats (cached until the next append)."""
+    if search_state["columns"] is None:
+        main, delta = search_state["main"], search_state["delta"]["columns"]
+        columns = {
+            name: np.concatenate([main[name] if main else np.zeros(0, dtype=dtype), np.asarray(delta[name], dtype=dtype)])
+            for name, dtype in SEARCH_DOC_COLUMNS.items()
         }
-    except Exception as e:
-        return {
-            "subreddit": subreddit_name,
-            "agent_id": agent_id,
-            "decision": "ERROR",
+        live = search_live_mask(columns)
+        count = int(live.sum())
+        columns["live"] = live
+        columns["live_count"] = count
+        columns["avg_length"] = float(columns["doc_length"][live].mean()) if count else 1.0
+        search_state["columns"] = columns
+    return search_state["columns"]
+
+def lookup_search_term(main: Dict[str, Any], term: bytes) -> int:
+    """Binary search the memory-mapped, byte-sorted term list."""
+    offsets, blob = main["term_offsets"], main["term_blob"]
+    lo, hi = 0, len(offsets) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if blob[offsets[mid]:offsets[mid + 1]].tobytes() < term:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(offsets) - 1 and blob[offsets[lo]:offsets[lo + 1]].tobytes() == term:
+        return lo
+    return -1
+
+def search_postings(term: str) -> tuple:
+    """(doc ids, term frequencies) for a term across the main segment and the delta."""
+    docs, tfs = [], []
+    main = search_state["main"]
+    if main:
+        i = lookup_search_term(main, term.encode("utf-8"))
+        if i >= 0:
+            start, end = main["term_ptr"][i], main["term_ptr"][i + 1]
+            docs.append(main["post_docs"][start:end])
+            tfs.append(main["post_tf"][start:end])
+    pending = search_state["delta"]["postings"].get(term)
+    if pending:
+        docs.append(np.asarray(pending[0], dtype=np.int32))
+        tfs.append(np.asarray(pending[1], dtype=np.int32))
+    if not docs:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    return np.concatenate(docs), np.concatenate(tfs)
+
+def write_search_segment(path: str, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]):
+    layout, position = {}, 0
+    for name, array in arrays.items():
+        position = (position + 7) // 8 * 8
+        layout[name] = [array.dtype.str, position, len(array)]
+        position += array.nbytes
+    header = json.dumps({**meta, "arrays": layout}).encode("utf-8")
+    base = (8 + len(header) + 7) // 8 * 8
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(len(header).to_bytes(8, "little") + header)
+            for name, array in arrays.items():
+                f.seek(base + layout[name][1])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(base + position)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def read_search_meta(path: str) -> Optional[Dict[str, Any]]:
+    """Just the JSON header of a segment, or None if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read(int.from_bytes(f.read(8), "little")))
+    except (OSError, ValueError):
+        return None
+
+def load_search_segment(path: str) -> Dict[str, Any]:
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_length = int.from_bytes(mm[:8], "little")
+    header = json.loads(mm[8:8 + header_length])
+    base = (8 + header_length + 7) // 8 * 8
+    main = {
+        name: np.frombuffer(mm, dtype=np.dtype(dtype), count=count, offset=base + position) if count else np.zeros(0, dtype=np.dtype(dtype))
+        for name, (dtype, position, count) in header["arrays"].items()
+    }
+    return {"meta": header, "main": main}
+
+def corpus_fingerprint(corpus_end: int) -> str:
+    """Hash of the index lines for the records before corpus_end. Appends leave it alone; a rebuilt
+    or rewritten corpus changes it even when the new file is the same size or larger.
+    """
+    digest = hashlib.sha1()
+    with open(CORPUS_INDEX_PATH, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n") or not line.strip():
+                continue
+            if json.loads(line)["offset"] >= corpus_end:
+                break
+            digest.update(line)
+    return digest.hexdigest()
+
+def search_segment_matches(meta: Optional[Dict[str, Any]]) -> bool:
+    """Whether a segment was built from (a prefix of) the corpus on disk now."""
+    return bool(meta) and meta.get("version") == 2 and meta.get("corpus_fingerprint") == corpus_fingerprint(meta["corpus_end"])
+
+def compact_search_index():
+    """Fold the delta into a new on-disk segment, dropping shadowed documents, and remap it."""
+    main, delta = search_state["main"], search_state["delta"]
+    columns = search_columns()
+    main_terms = []
+    if main:
+        offsets, blob = main["term_offsets"], main["term_blob"].tobytes()
+        main_terms = [blob[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    delta_terms = {term.encode("utf-8"): postings for term, postings in delta["postings"].items()}
+    vocab = sorted(set(main_terms) | set(delta_terms))
+    term_index = {term: i for i, term in enumerate(vocab)}
+
+    term_ids, docs, tfs = [], [], []
+    if main_terms:
+        term_map = np.asarray([term_index[t] for t in main_terms], dtype=np.int64)
+        term_ids.append(np.repeat(term_map, np.diff(main["term_ptr"])))
+        docs.append(main["post_docs"])
+        tfs.append(main["post_tf"])
+    for term, (term_docs, term_tfs) in delta_terms.items():
+        term_ids.append(np.full(len(term_docs), term_index[term], dtype=np.int64))
+        docs.append(np.asarray(term_docs, dtype=np.int32))
+        tfs.append(np.asarray(term_tfs, dtype=np.int32))
+    term_ids = np.concatenate(term_ids) if term_ids else np.zeros(0, dtype=np.int64)
+    docs = np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32)
+    tfs = np.concatenate(tfs) if tfs else np.zeros(0, dtype=np.int32)
+
+    # Drop dead documents and renumber the survivors densely
+    live = columns["live"]
+    keep = live[docs]
+    renumber = (np.cumsum(live) - 1).astype(np.int32)
+    term_ids, docs, tfs = term_ids[keep], renumber[docs[keep]], tfs[keep]
+    order = np.lexsort((docs, term_ids))
+    term_ids, docs, tfs = term_ids[order], docs[order], tfs[order]
+    counts = np.bincount(term_ids, minlength=len(vocab))
+    used = np.flatnonzero(counts)
+    vocab = [vocab[i] for i in used]
+    term_lengths = np.fromiter((len(t) for t in vocab), dtype=np.int64, count=len(vocab))
+
+    arrays = {
+        "term_offsets": np.concatenate([[0], np.cumsum(term_lengths)]).astype(np.int64),
+        "term_blob": np.frombuffer(b"".join(vocab), dtype=np.uint8),
+        "term_ptr": np.concatenate([[0], np.cumsum(counts[used])]).astype(np.int64),
+        "post_docs": docs.astype(np.int32),
+        "post_tf": tfs.astype(np.int32),
+    }
+    for name in SEARCH_DOC_COLUMNS:
+        arrays[name] = columns[name][live]
+    meta = {
+        "version": 2, "corpus_end": search_state["corpus_end"], "corpus_fingerprint": corpus_fingerprint(search_state["corpus_end"]),
+        "post_ids": search_state["post_ids"], "subreddits": search_state["subreddits"],
+    }
+    with file_lock(SEARCH_INDEX_PATH + '.lock'):
+        # Another worker has already written a segment covering more of the corpus than we have
+        # indexed; overwriting it would drop those posts, so keep our delta until we catch up
+        on_disk = read_search_meta(SEARCH_INDEX_PATH)
+        if on_disk and on_disk.get("corpus_end", 0) > meta["corpus_end"] and search_segment_matches(on_disk):
+            return
+        write_search_segment(SEARCH_INDEX_PATH, arrays, meta)
+        # Old views keep their own mmap alive until they are garbage collected
+        search_state["main"] = load_search_segment(SEARCH_INDEX_PATH)["main"]
+    search_state["delta"] = empty_search_delta()
+    search_state["columns"] = None
+
+def open_search_index():
+    """Map the persisted segment and index any corpus records appended after it was written."""
+    with search_lock:
+        # Also picks up other workers' appends into the delta once the index is open
+        open_corpus()
+        if search_state["loaded"]:
+            return
+        search_state["delta"] = empty_search_delta()
+        if os.path.exists(SEARCH_INDEX_PATH):
+            segment = load_search_segment(SEARCH_INDEX_PATH)
+            meta = segment["meta"]
+            # A segment from an older format or a rebuilt corpus is ignored and the index starts over
+            if meta.get("corpus_end", 0) <= corpus_state["end"] and search_segment_matches(meta):
+                search_state["main"] = segment["main"]
+                search_state["corpus_end"] = meta["corpus_end"]
+                search_state["post_ids"] = meta["post_ids"]
+                search_state["post_lookup"] = {p: i for i, p in enumerate(meta["post_ids"])}
+                search_state["subreddits"] = meta["subreddits"]
+                search_state["subreddit_lookup"] = {s: i for i, s in enumerate(meta["subreddits"])}
+        stale = sorted(
+            (e for e in corpus_state["by_id"].values() if e["offset"] >= search_state["corpus_end"]),
+            key=lambda e: e["offset"]
+        )
+        for entry in stale:
+            index_search_record(entry, loads_json(read_corpus_bytes(entry["offset"], entry["length"])))
+        search_state["corpus_end"] = corpus_state["end"]
+        if stale:
+            compact_search_index()
+        search_state["loaded"] = True
+
+def index_search_post(entry: Dict[str, Any], item: Dict[str, Any]):
+    """Called after a corpus append; a not-yet-opened index picks the record up when it opens."""
+    with search_lock:
+        if not search_state["loaded"]:
+            return
+        index_search_record(entry, item)
+        # Only as far as this record: a refresh may still be feeding the ones after it
+        search_state["corpus_end"] = max(search_state["corpus_end"], entry["offset"] + entry["length"] + 1)
+        search_state["columns"] = None
+        if len(search_state["delta"]["columns"]["doc_post"]) >= SEARCH_MERGE_DOCS:
+            compact_search_index()
+
+def search_snippet(text: str, terms: set, width: int = None) -> Dict[str, Any]:
+    """A window of text around the first matching term, with [start, end) offsets of every match in it."""
+    width = width or SEARCH_SNIPPET_CHARS
+    matches = [m.span() for m in SEARCH_TOKEN_RE.finditer(text) if m.group().lower().strip("'") in terms]
+    start = max(0, min(matches[0][0] - width // 3, len(text) - width)) if matches else 0
+    end = min(len(text), start + width)
+    return {
+        "snippet": text[start:end],
+        "highlights": [[s - start, e - start] for s, e in matches if s >= start and e <= end]
+    }
+
+def search_corpus(query: str, subreddit: str = "", kind: str = "all", since: float = None, until: float = None,
+                  min_score: int = None, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+    """Rank live documents with BM25, filter, and render the requested page with snippets."""
+    started = time.perf_counter()
+    open_search_index()
+    terms = sorted(set(search_tokens(query)))
+    with search_lock:
+        columns = search_columns()
+        live, lengths = columns["live"], columns["doc_length"]
+        n, avg_length = columns["live_count"], columns["avg_length"]
+        matched_docs, weights = [], []
+        for term in terms:
+            docs, tfs = search_postings(term)
+            keep = live[docs]
+            docs, tfs = docs[keep], tfs[keep].astype(np.float64)
+            if not len(docs):
+                continue
+            idf = math.log(1.0 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = SEARCH_BM25_K1 * (1.0 - SEARCH_BM25_B + SEARCH_BM25_B * lengths[docs] / avg_length)
+            matched_docs.append(docs)
+            weights.append(idf * tfs * (SEARCH_BM25_K1 + 1.0) / (tfs + norm))
+        hits = []
+        total = 0
+        if matched_docs:
+            candidates, inverse = np.unique(np.concatenate(matched_docs), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(weights))
+            mask = np.ones(len(candidates), dtype=bool)
+            if subreddit:
+                mask &= columns["doc_subreddit"][candidates] == search_state["subreddit_lookup"].get(subreddit.lower(), -1)
+            if kind == "post":
+                mask &= columns["doc_comment"][candidates] < 0
+            elif kind == "comment":
+                mask &= columns["doc_comment"][candidates] >= 0
+            if since is not None:
+                mask &= columns["doc_created"][candidates] >= since
+            if until is not None:
+                mask &= columns["doc_created"][candidates] <= until
+            if min_score is not None:
+                mask &= columns["doc_score"][candidates] >= min_score
+            candidates, scores = candidates[mask], scores[mask]
+            total = len(candidates)
+            window = min(total, offset + limit)
+            if window > offset:
+                top = np.argpartition(-scores, window - 1)[:window] if window < total else np.arange(total)
+                top = top[np.argsort(-scores[top], kind="stable")][offset:window]
+                for i in top:
+                    doc = candidates[i]
+                    hits.append({
+                        "post_id": search_state["post_ids"][columns["doc_post"][doc]],
+                        "comment_index": int(columns["doc_comment"][doc]),
+                        "subreddit": search_state["subreddits"][columns["doc_subreddit"][doc]],
+                        "score": int(columns["doc_score"][doc]),
+                        "created_utc": float(columns["doc_created"][doc]),
+                        "bm25": round(float(scores[i]), 4),
+                    })
+
+    # Text for snippets comes from the corpus only for the page being returned
+    term_set = set(terms)
+    results = []
+    for hit in hits:
+        header = get_corpus_post(hit["post_id"], with_comments=False) or {}
+        post = header.get("post", {})
+        comment_index = hit.pop("comment_index")
+        if comment_index < 0:
+            text = f"{post.get('title') or ''}\n{post.get('selftext') or ''}"
+            hit.update({"type": "post", "comment_id": None})
+        else:
+            tree = get_comment_tree(hit["post_id"])
+            text = comment_body(tree, comment_index)
+            hit.update({"type": "comment", "comment_id": tree["ids"][comment_index], "author": tree["authors"][tree["author_idx"][comment_index]]})
+        hit.update({"title": post.get("title"), "url": header.get("url"), **search_snippet(text, term_set)})
+        results.append(hit)
+    return {
+        "query": query,
+        "terms": terms,
+        "total": total,
+        "offset": offset,
+        "results": results,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+# ---------- Local sentiment ----------
+# A small valence lexicon with negation flipping, normalized to [-1, 1]. Cheap enough to score
+# every comment in the corpus; used wherever a per-comment sentiment is needed without an LLM.
+
+SENTIMENT_LEXICON = {
+    "love": 3, "loved": 3, "amazing": 3, "awesome": 3, "excellent": 3, "fantastic": 3, "wonderful": 3,
+    "great": 2, "good": 2, "nice": 2, "happy": 2, "glad": 2, "beautiful": 2, "best": 2, "brilliant": 3,
+    "thanks": 2, "thank": 2, "agree": 1, "agreed": 1, "interesting": 1, "helpful": 2, "hope": 1,
+    "fun": 2, "cool": 1, "impressive": 2, "congrats": 3, "congratulations": 3, "win": 2, "success": 2,
+    "correct": 1, "fair": 1, "support": 1, "safe": 1, "promising": 2, "enjoy": 2, "enjoyed": 2,
+    "bad": -2, "terrible": -3, "awful": -3, "horrible": -3, "worst": -3, "hate": -3, "hated": -3,
+    "stupid": -2, "idiot": -3, "idiots": -3, "dumb": -2, "wrong": -2, "sad": -2, "angry": -2,
+    "disgusting": -3, "pathetic": -3, "garbage": -3, "trash": -2, "sucks": -2, "fail": -2, "failed": -2,
+    "problem": -1, "problems": -1, "fear": -2, "scared": -2, "worried": -2, "concerned": -1, "crisis": -2,
+    "disaster": -3, "died": -2, "dead": -2, "death": -2, "kill": -3, "killed": -3, "war": -2, "lies": -2,
+    "lie": -2, "corrupt": -3, "scam": -3, "annoying": -2, "boring": -2, "disagree": -1, "ridiculous": -2,
+    "unfortunately": -1, "skeptical": -1, "overhyped": -2, "ugly": -2, "toxic": -3,
+}
+SENTIMENT_NEGATIONS = {"not", "no", "never", "isn't", "wasn't", "don't", "doesn't", "didn't", "can't", "won't", "aren't", "nothing", "hardly"}
+
+def sentiment_score(text: str) -> float:
+    total = 0.0
+    words = re.findall(r"[a-z']+", text.lower())
+    for i, word in enumerate(words):
+        valence = SENTIMENT_LEXICON.get(word)
+        if valence is None:
+            continue
+        if any(w in SENTIMENT_NEGATIONS for w in words[max(0, i - 3):i]):
+            valence = -0.75 * valence
+        total += valence
+    return total / math.sqrt(total * total + 15.0)
+
+# ---------- Related threads ----------
+# One row per corpus thread: TF-IDF of the title (boosted) and comments, randomly projected to
+# RELATED_DIM dimensions, next to standardized engagement/sentiment features; rows are unit
+# length so cosine similarity is a dot product. Random-hyperplane LSH tables give candidates,
+# with an exact scan when they come back thin. Vocabulary, IDF and feature scaling are frozen at
+# build time; posts appended later are embedded with them until enough have accumulated to
+# warrant a rebuild.
+
+RELATED_FEATURES = [
+    "log_score", "log_comments", "max_depth", "reply_ratio", "log_comment_score", "velocity",
+    "sentiment_mean", "sentiment_std", "positive_share", "negative_share",
+]
+RELATED_STOPWORDS = set(
+    "a an the and or but if then than so of to in on at by for with from as is are was were be been being "
+    "it its it's this that these those there their they them he she his her we our you your i me my mine "
+    "do does did done have has had not no yes just also very really can could would should will may might "
+    "about into over under more most some any all what which who whom when where why how up out get got "
+    "like one im i'm dont don't that's what's people think know even much well make made way still".split()
+)
+
+related_lock = threading.RLock()
+related_state: Dict[str, Any] = {"model": None, "vectors": None, "raw": None, "threads": [], "rows": {}, "buckets": [], "corpus_end": -1, "added": 0}
+
+def thread_profile(title: str, selftext: str, score: int, bodies: List[str], scores: np.ndarray,
+                   created: np.ndarray, depth: np.ndarray, post_created: float = 0.0) -> Dict[str, Any]:
+    """Term counts plus the raw engagement/sentiment features for one thread."""
+    counts = Counter()
+    for token in search_tokens(title):
+        if token not in RELATED_STOPWORDS:
+            counts[token] += 3
+    for text in [selftext, *bodies]:
+        counts.update(t for t in search_tokens(text) if t not in RELATED_STOPWORDS and len(t) > 2)
+    sentiments = np.fromiter((sentiment_score(b) for b in bodies), dtype=np.float64, count=len(bodies))
+    n = len(bodies)
+    if n:
+        start = post_created or float(created.min())
+        hours = max(1.0, (float(created.max()) - start) / 3600.0)
+        features = [
+            math.log1p(max(score, 0)), math.log1p(n), float(depth.max()), float((depth > 0).mean()),
+            float(np.log1p(np.maximum(scores, 0)).mean()), math.log1p(n / hours),
+            float(sentiments.mean()), float(sentiments.std()),
+            float((sentiments > 0.05).mean()), float((sentiments < -0.05).mean()),
+        ]
+    else:
+        features = [math.log1p(max(score, 0))] + [0.0] * (len(RELATED_FEATURES) - 1)
+    return {"counts": counts, "features": np.asarray(features, dtype=np.float64)}
+
+def corpus_thread_profile(item: Dict[str, Any]) -> Dict[str, Any]:
+    post = item.get("post", {})
+    tree = build_comment_tree(str(post.get("id")), item.get("comments", []))
+    bodies = [comment_body(tree, i) for i in range(len(tree["ids"]))]
+    return thread_profile(
+        post.get("title") or "", post.get("selftext") or "", int(post.get("score") or 0), bodies,
+        tree["score"], tree["created_utc"], tree["depth"], float(post.get("created_utc") or 0.0)
+    )
+
+def records_thread_profile(records: List[Dict[str, Any]], title: str = "") -> Dict[str, Any]:
+    """Profile for a live thread fetched from Reddit (comment records only)."""
+    return thread_profile(
+        title, "", 0, [r["body"] for r in records],
+        np.asarray([r.get("score") or 0 for r in records], dtype=np.int64),
+        np.asarray([r.get("created_utc") or 0.0 for r in records], dtype=np.float64),
+        np.asarray([r.get("depth") or 0 for r in records], dtype=np.int16),
+    )
+
+def fit_related_model(profiles: List[Dict[str, Any]]) -> Dict[str, Any]:
+    n = len(profiles)
+    df = Counter()
+    for profile in profiles:
+        df.update(profile["counts"].keys())
+    min_df = 2 if n >= 20 else 1
+    terms = [t for t, d in df.items() if d >= min_df and d <= max(1, 0.5 * n)]
+    terms.sort(key=lambda t: (-df[t], t))
+    terms = terms[:RELATED_VOCAB_SIZE]
+    rng = np.random.default_rng(20251101)
+    raw = np.stack([p["features"] for p in profiles]) if n else np.zeros((0, len(RELATED_FEATURES)))
+    dim = RELATED_DIM + len(RELATED_FEATURES)
+    return {
+        "vocab": {t: i for i, t in enumerate(terms)},
+        "terms": terms,
+        "idf": np.asarray([math.log((1 + n) / (1 + df[t])) + 1.0 for t in terms], dtype=np.float64),
+        "projection": (rng.standard_normal((len(terms), RELATED_DIM)) / math.sqrt(RELATED_DIM)).astype(np.float32),
+        "mean": raw.mean(axis=0) if n else np.zeros(len(RELATED_FEATURES)),
+        "std": (raw.std(axis=0) if n else np.ones(len(RELATED_FEATURES))) + 1e-9,
+        "planes": rng.standard_normal((RELATED_LSH_TABLES, dim, RELATED_LSH_BITS)).astype(np.float32),
+    }
+
+def embed_thread(model: Dict[str, Any], profile: Dict[str, Any]) -> tuple:
+    """(unit vector, top keywords) for a profile under a fitted model."""
+    columns = [model["vocab"][t] for t in profile["counts"] if t in model["vocab"]]
+    text = np.zeros(RELATED_DIM, dtype=np.float32)
+    keywords = []
+    if columns:
+        columns = np.asarray(columns, dtype=np.int64)
+        tf = np.asarray([profile["counts"][model["terms"][c]] for c in columns], dtype=np.float64)
+        weights = (1.0 + np.log(tf)) * model["idf"][columns]
+        weights /= np.linalg.norm(weights)
+        text = weights.astype(np.float32) @ model["projection"][columns]
+        text /= np.linalg.norm(text) or 1.0
+        keywords = [model["terms"][c] for c in columns[np.argsort(-weights, kind="stable")[:10]]]
+    scaled = (profile["features"] - model["mean"]) / model["std"]
+    features = (RELATED_FEATURE_WEIGHT / math.sqrt(len(RELATED_FEATURES))) * scaled
+    vector = np.concatenate([text, features.astype(np.float32)])
+    return vector / (np.linalg.norm(vector) or 1.0), keywords
+
+def lsh_codes(model: Dict[str, Any], vectors: np.ndarray) -> np.ndarray:
+    """(rows, tables) bucket codes from the sign of each random hyperplane."""
+    bits = np.einsum("nd,tdb->ntb", vectors, model["planes"]) > 0
+    return (bits * (1 << np.arange(RELATED_LSH_BITS))).sum(axis=2)
+
+def related_thread_entry(entry: Dict[str, Any], item: Dict[str, Any], keywords: List[str]) -> Dict[str, Any]:
+    post = item.get("post", {})
+    return {
+        "post_id": entry["id"], "subreddit": entry["subreddit"], "offset": entry["offset"],
+        "title": post.get("title"), "url": item.get("url"), "keywords": keywords,
+    }
+
+def build_related_index():
+    open_corpus()
+    entries = sorted(corpus_state["by_id"].values(), key=lambda e: e["offset"])
+    items = [loads_json(read_corpus_bytes(e["offset"], e["length"])) for e in entries]
+    profiles = [corpus_thread_profile(item) for item in items]
+    model = fit_related_model(profiles)
+    embedded = [embed_thread(model, p) for p in profiles]
+    dim = RELATED_DIM + len(RELATED_FEATURES)
+    vectors = np.stack([v for v, _ in embedded]) if embedded else np.zeros((0, dim), dtype=np.float32)
+    buckets = [dict() for _ in range(RELATED_LSH_TABLES)]
+    for row, codes in enumerate(lsh_codes(model, vectors)):
+        for table, code in enumerate(codes):
+            buckets[table].setdefault(int(code), set()).add(row)
+    related_state.update(
+        model=model, vectors=vectors, buckets=buckets, added=0, corpus_end=corpus_state["end"],
+        raw=np.stack([p["features"] for p in profiles]) if profiles else np.zeros((0, len(RELATED_FEATURES))),
+        threads=[related_thread_entry(e, item, kw) for e, item, (_, kw) in zip(entries, items, embedded)],
+        rows={e["id"]: row for row, e in enumerate(entries)},
+    )
+
+def add_related_thread(entry: Dict[str, Any], item: Dict[str, Any]):
+    """Embed an appended (or re-scraped) post with the frozen model, replacing its old row."""
+    model = related_state["model"]
+    profile = corpus_thread_profile(item)
+    vector, keywords = embed_thread(model, profile)
+    row = related_state["rows"].get(entry["id"])
+    if row is None:
+        row = len(related_state["threads"])
+        related_state["threads"].append(None)
+        related_state["vectors"] = np.vstack([related_state["vectors"], vector[None, :]])
+        related_state["raw"] = np.vstack([related_state["raw"], profile["features"][None, :]])
+        related_state["rows"][entry["id"]] = row
+    else:
+        for table, code in enumerate(lsh_codes(model, related_state["vectors"][row:row + 1])[0]):
+            related_state["buckets"][table].get(int(code), set()).discard(row)
+        related_state["vectors"][row] = vector
+        related_state["raw"][row] = profile["features"]
+    related_state["threads"][row] = related_thread_entry(entry, item, keywords)
+    for table, code in enumerate(lsh_codes(model, vector[None, :])[0]):
+        related_state["buckets"][table].setdefault(int(code), set()).add(row)
+    related_state["added"] += 1
+
+def ensure_related_index():
+    """Build on first use; afterwards fold in corpus appends, rebuilding once they pile up."""
+    with related_lock:
+        open_corpus()
+        if related_state["model"] is None:
+            build_related_index()
+            return
+        if related_state["corpus_end"] == corpus_state["end"]:
+            return
+        fresh = sorted(
+            (e for e in corpus_state["by_id"].values() if e["offset"] >= related_state["corpus_end"]),
+            key=lambda e: e["offset"]
+        )
+        if related_state["added"] + len(fresh) > RELATED_REBUILD_FRACTION * max(1, len(related_state["threads"])):
+            build_related_index()
+            return
+        for entry in fresh:
+            add_related_thread(entry, loads_json(read_corpus_bytes(entry["offset"], entry["length"])))
+        related_state["corpus_end"] = corpus_state["end"]
+
+def related_threads(post_id: str, k: int = 10, subreddit: str = "") -> Optional[Dict[str, Any]]:
+    """Nearest threads to a corpus post by cosine similarity; None if the post is unknown."""
+    started = time.perf_counter()
+    ensure_related_index()
+    with related_lock:
+        row = related_state["rows"].get(post_id)
+        if row is None:
+            return None
+        vectors, threads = related_state["vectors"], related_state["threads"]
+        query = vectors[row]
+        candidates = set()
+        for table, code in enumerate(lsh_codes(related_state["model"], query[None, :])[0]):
+            candidates |= related_state["buckets"][table].get(int(code), set())
+        method = "lsh"
+        if subreddit:
+            candidates = {c for c in candidates if threads[c]["subreddit"] == subreddit.lower()}
+        candidates.discard(row)
+        if len(candidates) < k:
+            # Too few bucket neighbours: scan everything (still one matrix-vector product)
+            method = "exact"
+            candidates = [c for c in range(len(threads)) if c != row and (not subreddit or threads[c]["subreddit"] == subreddit.lower())]
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarity = vectors[candidates] @ query
+        top = np.argsort(-similarity, kind="stable")[:k]
+        related = [
+            {**{key: threads[c][key] for key in ("post_id", "subreddit", "title", "url", "keywords")}, "similarity": round(float(s), 4)}
+            for c, s in zip(candidates[top], similarity[top])
+        ]
+    return {
+        "post_id": post_id,
+        "related": related,
+        "method": method,
+        "candidates": int(len(candidates)),
+        "took_ms": round((time.perf_counter() - started) * 1000, 3)
+    }
+
+def local_thread_analysis(raw: np.ndarray, keywords: List[str]) -> Dict[str, Any]:
+    """The locally computable subset of the LLM analysis, plus an engagement score."""
+    f = dict(zip(RELATED_FEATURES, raw.tolist()))
+    mean, positive, negative = f["sentiment_mean"], f["positive_share"], f["negative_share"]
+    if positive > 0.25 and negative > 0.25:
+        overall = "mixed"
+    elif mean > 0.05:
+        overall = "positive"
+    elif mean < -0.05:
+        overall = "negative"
+    else:
+        overall = "neutral"
+    z = (raw - related_state["model"]["mean"]) / related_state["model"]["std"]
+    engagement = float(np.mean([z[RELATED_FEATURES.index(name)] for name in ("log_score", "log_comments", "reply_ratio", "velocity")]))
+    return {
+        "sentiment_overall": overall,
+        "sentiment_score": round(mean, 3),
+        "top_keywords": keywords,
+        "controversy_score": round(min(1.0, 2.0 * min(positive, negative) + f["sentiment_std"] / 2.0), 3),
+        "engagement_score": round(engagement, 3),
+        "features": {name: round(value, 4) for name, value in f.items()},
+    }
+
+# ---------- Sentiment timelines ----------
+# Per-thread accumulators over fixed base buckets of TIMELINE_BASE_SECONDS (doubled whenever a
+# thread's span would need more than TIMELINE_MAX_BASE_BUCKETS). A comment is scored once, the
+# first time it is seen; any requested window is a reshape-sum of the base buckets and rolling
+# values are differences of cumulative sums.
+
+TIMELINE_FIELDS = ("count", "sentiment_sum", "toxic", "positive", "negative", "score_sum")
+# Key of the untrained, lexicon-seeded cascade model used as a toxicity scorer
+TIMELINE_TOXICITY_MODEL = "__timeline__"
+
+timeline_cache = LRUCache(TIMELINE_CACHE_SIZE)
+timeline_lock = threading.Lock()
+
+def new_timeline_state() -> Dict[str, Any]:
+    return {
+        "seen": set(), "start": None, "base": TIMELINE_BASE_SECONDS,
+        "buckets": {field: np.zeros(0, dtype=np.float64) for field in TIMELINE_FIELDS},
+    }
+
+def coarsen_timeline(state: Dict[str, Any]):
+    """Double the base bucket width, merging neighbouring buckets."""
+    base = state["base"] * 2
+    start = math.floor(state["start"] / base) * base
+    lead = int(round((state["start"] - start) / state["base"]))
+    for field, values in state["buckets"].items():
+        values = np.concatenate([np.zeros(lead), values])
+        values = np.pad(values, (0, len(values) % 2))
+        state["buckets"][field] = values.reshape(-1, 2).sum(axis=1)
+    state["base"], state["start"] = base, start
+
+def extend_timeline(state: Dict[str, Any], ids: List[str], created: np.ndarray, scores: np.ndarray, body_at) -> int:
+    """Score and bucket the comments not seen before; returns how many were added."""
+    seen = state["seen"]
+    fresh = np.flatnonzero(np.fromiter((cid not in seen for cid in ids), dtype=bool, count=len(ids)))
+    if not len(fresh):
+        return 0
+    bodies = [body_at(i) for i in fresh]
+    created, scores = created[fresh].astype(np.float64), scores[fresh].astype(np.float64)
+    sentiment = np.fromiter((sentiment_score(b) for b in bodies), dtype=np.float64, count=len(bodies))
+    toxic = np.fromiter((cascade_score(TIMELINE_TOXICITY_MODEL, b) >= TIMELINE_TOXIC_THRESHOLD for b in bodies), dtype=np.float64, count=len(bodies))
+    seen.update(ids[i] for i in fresh)
+
+    lo, hi = float(created.min()), float(created.max())
+    if state["start"] is None:
+        state["start"] = math.floor(lo / state["base"]) * state["base"]
+    if lo < state["start"]:
+        shift = math.ceil((state["start"] - lo) / state["base"])
+        for field, values in state["buckets"].items():
+            state["buckets"][field] = np.concatenate([np.zeros(shift), values])
+        state["start"] -= shift * state["base"]
+    while (hi - state["start"]) // state["base"] + 1 > TIMELINE_MAX_BASE_BUCKETS:
+        coarsen_timeline(state)
+    slots = ((created - state["start"]) // state["base"]).astype(np.int64)
+    size = int(slots.max()) + 1
+    for field, values in zip(TIMELINE_FIELDS, (np.ones(len(fresh)), sentiment, toxic, sentiment > 0.05, sentiment < -0.05, scores)):
+        buckets = state["buckets"][field]
+        if len(buckets) < size:
+            buckets = state["buckets"][field] = np.pad(buckets, (0, size - len(buckets)))
+        np.add.at(buckets, slots, values)
+    return len(fresh)
+
+def rolling_sum(values: np.ndarray, windows: int) -> np.ndarray:
+    totals = np.concatenate([[0.0], np.cumsum(values)])
+    ends = np.arange(1, len(values) + 1)
+    return totals[ends] - totals[np.maximum(0, ends - windows)]
+
+def nullable(values: np.ndarray, digits: int = 4) -> List[Optional[float]]:
+    return [None if math.isnan(v) else round(v, digits) for v in values.tolist()]
+
+def render_timeline(state: Dict[str, Any], window: float, rolling: int, max_points: int) -> Dict[str, Any]:
+    """Aggregate the base buckets into `window`-second points (widened to fit `max_points`)."""
+    buckets = state["buckets"]
+    n = len(buckets["count"])
+    total = float(buckets["count"].sum())
+    if not n or not total:
+        return {"start": None, "window_seconds": window, "rolling_windows": rolling, "points": [], "total_comments": 0, "overall": {}}
+    factor = max(1, int(round(window / state["base"])))
+    factor = max(factor, math.ceil(n / max_points))
+    agg = {field: np.pad(values, (0, (-n) % factor)).reshape(-1, factor).sum(axis=1) for field, values in buckets.items()}
+    count = agg["count"]
+    rolled = {field: rolling_sum(agg[field], rolling) for field in ("count", "sentiment_sum", "toxic")}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sentiment = agg["sentiment_sum"] / count
+        toxicity = agg["toxic"] / count
+        avg_score = agg["score_sum"] / count
+        rolling_sentiment = rolled["sentiment_sum"] / rolled["count"]
+        rolling_toxicity = rolled["toxic"] / rolled["count"]
+    width = factor * state["base"]
+    times = state["start"] + width * np.arange(len(count))
+    columns = zip(
+        times.tolist(), count.astype(np.int64).tolist(), nullable(sentiment), nullable(rolling_sentiment),
+        np.round(rolled["count"] / np.minimum(np.arange(1, len(count) + 1), rolling), 3).tolist(),
+        nullable(toxicity), nullable(rolling_toxicity), nullable(avg_score, 2)
+    )
+    keys = ("t", "count", "sentiment", "rolling_sentiment", "rolling_volume", "toxicity", "rolling_toxicity", "avg_score")
+    return {
+        "start": state["start"],
+        "window_seconds": width,
+        "rolling_windows": rolling,
+        "points": [dict(zip(keys, column)) for column in columns],
+        "total_comments": int(total),
+        "overall": {
+            "sentiment_score": round(float(buckets["sentiment_sum"].sum() / total), 4),
+            "toxicity_ratio": round(float(buckets["toxic"].sum() / total), 4),
+            "positive_share": round(float(buckets["positive"].sum() / total), 4),
+            "negative_share": round(float(buckets["negative"].sum() / total), 4),
+        },
+    }
+
+def update_timeline(key: str, ids: List[str], created: np.ndarray, scores: np.ndarray, body_at,
+                    window: float, rolling: int, max_points: int) -> Dict[str, Any]:
+    with timeline_lock:
+        state = timeline_cache.get(key)
+        if state is None:
+            state = new_timeline_state()
+            timeline_cache.put(key, state)
+        added = extend_timeline(state, ids, created, scores, body_at)
+        return {**render_timeline(state, window, rolling, max_points), "new_comments": added}
+
+# ---------- Subreddit → agent routing ----------
+
+ROUTING_VECTOR_DIM = 4096
+
+routing_state: Dict[str, Any] = {
+    "mtime": None,
+    "checked_at": 0.0,
+    "exact": {},
+    "pattern": None,
+    "pattern_agents": {},
+    "threshold": 0.08,
+    "profiles": None,
+    "profile_thread": None,
+    # Bumped on every reload; a profile build started under an older config discards its result
+    "generation": 0,
+}
+routing_lock = threading.Lock()
+routing_cache = LRUCache(ROUTING_CACHE_SIZE)
+
+def load_routing_table(force: bool = False):
+    """(Re)load the routing config when its mtime changes; checked at most once a second."""
+    now = time.time()
+    if not force and now - routing_state["checked_at"] < 1.0:
+        return
+    routing_state["checked_at"] = now
+    try:
+        mtime = os.path.getmtime(AGENT_ROUTING_PATH)
+    except OSError:
+        mtime = None
+    if not force and mtime == routing_state["mtime"] and routing_state["pattern"] is not None:
+        return
+    config = {}
+    if mtime is not None:
+        try:
+            with open(AGENT_ROUTING_PATH, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except Exception as e:
+            print(f"Warning: Could not load routing config: {e}")
+            if routing_state["pattern"] is not None:
+                return
+    exact = {}
+    alternatives = []
+    pattern_agents = {}
+    for agent_name, spec in config.get("agents", {}).items():
+        if agent_name not in LETTA_AGENTS:
+            continue
+        for name in spec.get("subreddits", []):
+            exact.setdefault(name.lower(), agent_name)
+        for pattern in spec.get("patterns", []):
+            group = f"g{len(alternatives)}"
+            alternatives.append(f"(?P<{group}>{pattern})")
+            pattern_agents[group] = agent_name
+    with routing_lock:
+        routing_state.update({
+            "mtime": mtime,
+            "exact": exact,
+            # One compiled alternation instead of a re.match per pattern
+            "pattern": re.compile("|".join(alternatives) or r"(?!)"),
+            "pattern_agents": pattern_agents,
+            "threshold": float(config.get("similarity_threshold", 0.08)),
+            "profiles": None,
+            "generation": routing_state["generation"] + 1,
+        })
+        routing_cache.clear()
+
+def lexical_vector(texts: List[str]) -> np.ndarray:
+    """Hash character trigrams of every word into a fixed-size, log-scaled, L2-normalised vector."""
+    vec = np.zeros(ROUTING_VECTOR_DIM, dtype=np.float32)
+    for text in texts:
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                vec[zlib.crc32(padded[i:i + 3].encode()) % ROUTING_VECTOR_DIM] += 1.0
+    vec = np.log1p(vec)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def iter_comment_bodies(comments: List[Dict[str, Any]]):
+    """Yield comment bodies of a nested comment tree without recursion."""
+    stack = list(comments)
+    while stack:
+        comment = stack.pop()
+        body = comment.get('body')
+        if body:
+            yield body
+        stack.extend(comment.get('replies', []))
+
+def build_agent_profiles():
+    """Precompute one lexical profile per agent from its subreddits' posts in the scraped corpus.
+    If the routing config is reloaded while building, the result is dropped and the build starts over.
+    """
+    while True:
+        generation = routing_state["generation"]
+        profiles = compute_agent_profiles()
+        with routing_lock:
+            if routing_state["generation"] == generation:
+                routing_state["profiles"] = profiles
+                return
+
+def compute_agent_profiles() -> tuple:
+    texts_by_agent: Dict[str, List[str]] = {}
+    for name, agent_name in routing_state["exact"].items():
+        # Known subreddit names are weighted in so short names still land near their agent
+        texts_by_agent.setdefault(agent_name, []).extend([name] * 20)
+    try:
+        all_posts = list(iter_corpus_posts())
+    except Exception:
+        all_posts = []
+    for item in all_posts:
+        post = item.get('post', {})
+        agent_name = route_known_subreddit(str(post.get('subreddit', '')).lower())
+        if not agent_name:
+            continue
+        texts = texts_by_agent.setdefault(agent_name, [])
+        texts.append(post.get('title') or "")
+        texts.append(post.get('selftext') or "")
+        texts.extend(iter_comment_bodies(item.get('comments', [])))
+    names = sorted(texts_by_agent)
+    if not names:
+        return names, np.zeros((0, ROUTING_VECTOR_DIM), dtype=np.float32)
+    matrix = np.stack([lexical_vector(texts_by_agent[n]) for n in names])
+    # Centre on the mean profile so trigrams every community shares stop dominating the score
+    matrix = matrix - matrix.mean(axis=0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return names, matrix / norms
+
+def route_known_subreddit(subreddit: str):
+    agent_name = routing_state["exact"].get(subreddit)
+    if agent_name:
+        return agent_name
+    match = routing_state["pattern"].fullmatch(subreddit)
+    if match:
+        return routing_state["pattern_agents"][match.lastgroup]
+    return None
+
+def schedule_agent_profiles():
+    """Build the agent profiles in a background thread (reads the whole corpus) unless one is running."""
+    thread = routing_state.get("profile_thread")
+    if thread is None or not thread.is_alive():
+        thread = threading.Thread(target=build_agent_profiles, name="routing-profiles", daemon=True)
+        routing_state["profile_thread"] = thread
+        thread.start()
+
+def route_by_similarity(subreddit: str):
+    if routing_state["profiles"] is None:
+        # Never build on the request path; unknown names go to "general" until the profiles exist
+        schedule_agent_profiles()
+        return None
+    names, matrix = routing_state["profiles"]
+    if not names:
+        return None
+    scores = matrix @ lexical_vector([subreddit])
+    best = int(np.argmax(scores))
+    if scores[best] >= routing_state["threshold"]:
+        return names[best]
+    return None
+
+def get_agent_for_subreddit(subreddit: str) -> tuple:
+    subreddit = subreddit.lower()
+    load_routing_table()
+    agent_name = routing_cache.get(subreddit)
+    if agent_name is None:
+        agent_name = route_known_subreddit(subreddit) or route_by_similarity(subreddit) or "general"
+        if routing_state["profiles"] is not None:
+            routing_cache.put(subreddit, agent_name)
+    return agent_name, LETTA_AGENTS[agent_name]
+
+async def moderate_with_agent(client, agent_id: str, thread_text: str, subreddit_name: str):
+    try:
+        response = await asyncio.wait_for(asyncio.to_thread(
+            letta_send,
+            client,
+            agent_id,
+            f"Moderate this Reddit thread/comment:\n\n{thread_text}\n\nOutput must include only: decision (FINE, NEEDS_WARNING, or VIOLATION), confidence (0-1), and reason."
+        ), timeout=upstream_timeout(60))
+        agent_reply = response.messages[-1].content
+        decision = "UNKNOWN"
+        confidence = 0.5
+        reason = agent_reply
+        if "VIOLATION" in agent_reply.upper():
+            decision = "VIOLATION"
+        elif "NEEDS_WARNING" in agent_reply.upper() or "WARNING" in agent_reply.upper():
+            decision = "NEEDS_WARNING"
+        elif "FINE" in agent_reply.upper() or "CLEAN" in agent_reply.upper():
+            decision = "FINE"
+        import re
+        confidence_match = re.search(r'confidence[:\s]*([0-9.]+)', agent_reply.lower())
+        if confidence_match:
+            try:
+                confidence = float(confidence_match.group(1))
+            except:
+                pass
+        return {
+            "subreddit": subreddit_name,
+            "agent_id": agent_id,
+            "decision": decision,
+            "confidence": confidence,
+            "reason": reason,
+            "raw_response": agent_reply
+        }
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        return {
+            "subreddit": subreddit_name,
+            "agent_id": agent_id,
+            "decision": "TIMEOUT",
+            "confidence": 0.0,
+            "reason": "Deadline reached before the agent answered",
+            "raw_response": ""
+        }
+    except Exception as e:
+        return {
+            "subreddit": subreddit_name,
+            "agent_id": agent_id,
+            "decision": "ERROR",
             "confidence": 0.0,
             "reason": f"Agent error: {str(e)}",
             "raw_response": ""
         }
 
+def multi_agent_decision(verdict_counts: Dict[str, int], total_agents: int) -> str:
+    if verdict_counts.get("VIOLATION", 0) > total_agents / 2:
+        return "PLATFORM_VIOLATION"
+    if verdict_counts.get("NEEDS_WARNING", 0) > 0:
+        return "GLOBAL_WARNING"
+    if verdict_counts.get("FINE", 0) > 0:
+        return "CLEAN"
+    return "INCONCLUSIVE"
+
+def quorum_settled(verdicts: List[str], pending: int) -> bool:
+    """True once no combination of the pending agents' answers could change the ensemble decision."""
+    total = len(verdicts) + pending
+    base = {"VIOLATION": 0, "NEEDS_WARNING": 0, "FINE": 0, "ERROR": 0}
+    for v in verdicts:
+        if v in base:
+            base[v] += 1
+    outcomes = set()
+    for v in range(pending + 1):
+        for w in range(pending - v + 1):
+            for f in range(pending - v - w + 1):
+                counts = {"VIOLATION": base["VIOLATION"] + v, "NEEDS_WARNING": base["NEEDS_WARNING"] + w, "FINE": base["FINE"] + f}
+                outcomes.add(multi_agent_decision(counts, total))
+                if len(outcomes) > 1:
+                    return False
+    return True
+
+async def moderate_with_ensemble(client, agents: List[tuple], thread_text: str) -> Dict[str, Any]:
+    """Query several agents concurrently; stop as soon as the quorum decision is settled."""
+    tasks = {
+        asyncio.create_task(moderate_with_agent(client, agent_id, thread_text, agent_name)): (agent_name, agent_id)
+        for agent_name, agent_id in agents
+    }
+    decisions: List[Dict[str, Any]] = []
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        decisions.extend(task.result() for task in done)
+        if pending and quorum_settled([d["decision"] for d in decisions], len(pending)):
+            break
+    for task in pending:
+        task.cancel()
+        agent_name, agent_id = tasks[task]
+        # Kept in the list so majority thresholds still count every ensemble member
+        decisions.append({
+            "subreddit": agent_name,
+            "agent_id": agent_id,
+            "decision": "SKIPPED",
+            "confidence": 0.0,
+            "reason": "Quorum reached before this agent answered",
+            "raw_response": ""
+        })
+    return {
+        "decisions": decisions,
+        "agents": [name for name, _ in agents],
+        "answered": len(agents) - len(pending),
+        "skipped": len(pending),
+        "early_exit": bool(pending)
+    }
+
+def ensemble_agents(agent_subreddit: str, option) -> List[tuple]:
+    names = [agent_subreddit, "general"]
+    if isinstance(option, dict):
+        names += [n for n in option.get("agents", []) if n in LETTA_AGENTS]
+    unique = []
+    for name in names:
+        if name not in unique:
+            unique.append(name)
+    return [(name, LETTA_AGENTS[name]) for name in unique]
+
 async def aggregate_moderation_verdicts(decisions: List[Dict[str, Any]], comment_count: int = 0):
     if not decisions:
         return {"final_decision": "NO_DATA", "confidence": 0.0, "reason": "No agent responses"}
@@ -554,14 +2755,7 @@ async def aggregate_moderation_verdicts(decisions: List[Dict[str, Any]], comment
             verdict_counts[verdict] += 1
             total_confidence += confidence
             valid_responses += 1
-    if verdict_counts["VIOLATION"] > len(decisions) / 2:
-        final_decision = "PLATFORM_VIOLATION"
-    elif verdict_counts["NEEDS_WARNING"] > 0:
-        final_decision = "GLOBAL_WARNING"
-    elif verdict_counts["FINE"] > 0:
-        final_decision = "CLEAN"
-    else:
-        final_decision = "INCONCLUSIVE"
+    final_decision = multi_agent_decision(verdict_counts, len(decisions))
     avg_confidence = total_confidence / valid_responses if valid_responses > 0 else 0.0
     return {
         "final_decision": final_decision,
@@ -607,42 +2801,1086 @@ def compute_counts_from_classifications(classifications: List[Dict[str, Any]]) -
             counts[label] += 1
     return counts
 
-def classify_comments_with_letta(client, agent_id: str, comments: List[str], max_items: int = 50) -> List[Dict[str, Any]]:
-    results = []
+# ---------- Moderation verdict cache ----------
+# Exact hits are keyed by a hash of the normalised text; near-duplicates (copypasta with small
+# edits) are found through a MinHash LSH index and reused when the estimated Jaccard similarity
+# of their word shingles clears VERDICT_SIMILARITY_THRESHOLD. Everything is scoped per agent.
+
+MINHASH_PRIME = (1 << 31) - 1
+_minhash_rng = np.random.default_rng(20251027)
+MINHASH_A = _minhash_rng.integers(1, MINHASH_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _minhash_rng.integers(0, MINHASH_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+verdict_caches: Dict[str, Dict[str, Any]] = {}
+# Classification threads read and update the caches concurrently
+verdict_cache_lock = threading.RLock()
+
+def normalize_comment_text(text: str) -> str:
+    lowered = text.lower()
+    # Links stay in the key (host and path), so the same words pointing somewhere else are a different comment
+    links = [re.sub(r"^https?://(www\.)?", "", url).split("?")[0].rstrip("/.,)") for url in re.findall(r"https?://\S+", lowered)]
+    words = re.findall(r"[a-z0-9']+", re.sub(r"https?://\S+", " ", lowered))
+    return " ".join(words + links)
+
+def minhash_signature(normalized: str) -> np.ndarray:
+    words = normalized.split()
+    if len(words) >= 3:
+        shingles = {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+    else:
+        # Very short comments: fall back to character 4-grams
+        shingles = {normalized[i:i + 4] for i in range(max(1, len(normalized) - 3))}
+    hashes = np.fromiter((zlib.crc32(sh.encode("utf-8")) & MINHASH_PRIME for sh in shingles), dtype=np.uint64, count=len(shingles))
+    return (((MINHASH_A[:, None] * hashes[None, :]) + MINHASH_B[:, None]) % MINHASH_PRIME).min(axis=1)
+
+def signature_bands(signature: np.ndarray) -> List[tuple]:
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [(b, signature[b * rows:(b + 1) * rows].tobytes()) for b in range(MINHASH_BANDS)]
+
+def get_verdict_cache(agent_id: str) -> Dict[str, Any]:
+    with verdict_cache_lock:
+        cache = verdict_caches.get(agent_id)
+        if cache is None:
+            buckets: Dict[tuple, set] = {}
+
+            def drop_from_buckets(key: str, entry: Dict[str, Any]):
+                for band in signature_bands(entry["signature"]):
+                    members = buckets.get(band)
+                    if members:
+                        members.discard(key)
+                        if not members:
+                            del buckets[band]
+
+            cache = {
+                "entries": LRUCache(VERDICT_CACHE_SIZE, on_evict=drop_from_buckets),
+                "buckets": buckets,
+                "drop": drop_from_buckets,
+                "stats": {"exact_hits": 0, "near_hits": 0, "misses": 0},
+            }
+            verdict_caches[agent_id] = cache
+        return cache
+
+def near_verdict_reusable(entry: Dict[str, Any], normalized: str) -> bool:
+    """A near-duplicate may reuse a FINE verdict only if it adds no words and no risk terms; anything
+    appended to benign copypasta ("... and you should kill yourself") has to be classified on its own.
+    """
+    if entry["label"] != "FINE":
+        return True
+    words = normalized.split()
+    return not (set(words) - entry["tokens"]) and not cascade_matches(words, CASCADE_RISK_TERMS)
+
+def lookup_verdict(agent_id: str, text: str):
+    """Return a cached {"label", "reason", "cached", "similarity"} for this text, or None."""
+    cache = get_verdict_cache(agent_id)
+    normalized = normalize_comment_text(text)
+    key = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+    signature = minhash_signature(normalized) if normalized else None
+    with verdict_cache_lock:
+        entries, now = cache["entries"], time.time()
+        entry = entries.get(key)
+        if entry is not None and entry["expires_at"] > now:
+            cache["stats"]["exact_hits"] += 1
+            return {"label": entry["label"], "reason": entry["reason"], "cached": "exact", "similarity": 1.0}
+        if signature is not None:
+            candidates = set()
+            for band in signature_bands(signature):
+                candidates.update(cache["buckets"].get(band, ()))
+            best, best_similarity = None, 0.0
+            for candidate in candidates:
+                other = entries.get(candidate)
+                if other is None or other["expires_at"] <= now:
+                    continue
+                similarity = float(np.mean(other["signature"] == signature))
+                if similarity > best_similarity:
+                    best, best_similarity = other, similarity
+            if best is not None and best_similarity >= VERDICT_SIMILARITY_THRESHOLD and near_verdict_reusable(best, normalized):
+                cache["stats"]["near_hits"] += 1
+                return {"label": best["label"], "reason": best["reason"], "cached": "near", "similarity": round(best_similarity, 3)}
+        cache["stats"]["misses"] += 1
+        return None
+
+def store_verdict(agent_id: str, text: str, label: str, reason: str):
+    if label not in ("VIOLATION", "NEEDS_WARNING", "FINE"):
+        return
+    normalized = normalize_comment_text(text)
+    if not normalized:
+        return
+    cache = get_verdict_cache(agent_id)
+    key = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+    signature = minhash_signature(normalized)
+    entry = {
+        "label": label, "reason": reason, "signature": signature, "tokens": frozenset(normalized.split()),
+        "expires_at": time.time() + VERDICT_CACHE_TTL,
+    }
+    with verdict_cache_lock:
+        previous = cache["entries"].pop(key, None)
+        if previous is not None:
+            cache["drop"](key, previous)
+        cache["entries"].put(key, entry)
+        for band in signature_bands(signature):
+            cache["buckets"].setdefault(band, set()).add(key)
+
+def verdict_cache_stats() -> Dict[str, Any]:
+    stats = {}
+    with verdict_cache_lock:
+        caches = list(verdict_caches.items())
+    for agent_id, cache in caches:
+        counts = cache["stats"]
+        lookups = counts["exact_hits"] + counts["near_hits"] + counts["misses"]
+        hits = counts["exact_hits"] + counts["near_hits"]
+        stats[agent_id] = {**counts, "entries": len(cache["entries"]), "hit_rate": round(hits / lookups, 3) if lookups else 0.0}
+    return stats
+
+# ---------- Local pre-filter cascade ----------
+# A hashed-feature logistic scorer per agent, seeded from a small lexicon and updated online
+# from every label the agent returns. Comments scoring below CASCADE_FINE_BELOW or above
+# CASCADE_VIOLATION_ABOVE are labeled locally; only the uncertain band reaches the agent.
+# A low score alone is never enough for FINE: the comment must contain no risk term, and until
+# the scorer has seen CASCADE_MIN_LABELS real labels it must also contain a benign marker.
+
+CASCADE_FEATURE_DIM = 1 << 16
+CASCADE_BIAS = -2.0
+
+CASCADE_LEXICON = {
+    # insults / harassment
+    "idiot": 2.5, "idiots": 2.5, "moron": 2.5, "stupid": 1.5, "dumbass": 2.5, "pathetic": 1.2,
+    "shut up": 2.0, "loser": 1.5, "trash": 1.0, "garbage": 0.8, "scum": 2.5, "clown": 1.0,
+    # threats
+    "kill yourself": 6.0, "kys": 6.0, "i will find you": 5.0, "hope you die": 6.0, "deserve to die": 5.0,
+    "go die": 5.0, "die in a fire": 6.0, "should be shot": 6.0, "should be killed": 6.0, "kill": 1.5,
+    # slurs / dehumanizing language
+    "fuck you": 3.0, "retard": 3.0, "retarded": 2.5, "subhuman": 4.0, "vermin": 3.0,
+    "cunt": 3.5, "faggot": 5.0, "tranny": 4.0, "nigger": 6.0, "kike": 6.0, "towelhead": 5.0,
+    # spam
+    "buy now": 3.0, "click here": 3.0, "free money": 3.5, "dm me": 2.0, "promo code": 3.0,
+    "check out my": 2.0, "onlyfans": 3.5, "crypto giveaway": 4.0,
+    # benign markers
+    "thank you": -2.0, "thanks": -2.0, "agreed": -1.5, "great point": -1.5, "interesting": -1.0,
+    "good question": -1.5, "source": -0.8, "study": -0.6, "i think": -0.6, "in my experience": -1.0,
+    "lol": -0.8, "haha": -0.8, "congrats": -2.0, "well said": -1.8, "makes sense": -1.8,
+    "__url__": 0.8, "__shouting__": 1.2, "__exclaim__": 0.6,
+}
+CASCADE_RISK_TERMS = [term for term, weight in CASCADE_LEXICON.items() if weight > 0 and not term.startswith("__")]
+# Positive evidence for FINE; hedges like "i think" or "interesting" are too easy to wrap abuse in
+CASCADE_BENIGN_TERMS = [
+    "thank you", "thanks", "agreed", "great point", "good question", "in my experience",
+    "congrats", "well said", "makes sense",
+]
+
+cascade_models: Dict[str, Dict[str, Any]] = {}
+
+def cascade_words(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+def cascade_matches(words: List[str], terms: List[str]) -> List[str]:
+    """Lexicon terms (single words or phrases) that occur in the comment on word boundaries."""
+    padded = f" {' '.join(words)} "
+    return [term for term in terms if f" {term} " in padded]
+
+def cascade_features(text: str) -> np.ndarray:
+    """Hashed unigram + bigram indices plus a few shape features."""
+    words = cascade_words(text)
+    grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])] + [" ".join(words[i:i + 3]) for i in range(len(words) - 2)]
+    if len(words) <= 4:
+        grams.append("__short__")
+    if re.search(r"https?://", text):
+        grams.append("__url__")
+    letters = [ch for ch in text if ch.isalpha()]
+    if len(letters) > 12 and sum(ch.isupper() for ch in letters) / len(letters) > 0.6:
+        grams.append("__shouting__")
+    if "!!!" in text:
+        grams.append("__exclaim__")
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) % CASCADE_FEATURE_DIM for g in grams), dtype=np.int64, count=len(grams)))
+
+def get_cascade_model(agent_id: str) -> Dict[str, Any]:
+    model = cascade_models.get(agent_id)
+    if model is None:
+        weights = np.zeros(CASCADE_FEATURE_DIM, dtype=np.float32)
+        for term, weight in CASCADE_LEXICON.items():
+            weights[zlib.crc32(term.encode("utf-8")) % CASCADE_FEATURE_DIM] += weight
+        model = {"weights": weights, "bias": CASCADE_BIAS, "trained": 0}
+        cascade_models[agent_id] = model
+    return model
+
+def cascade_score(agent_id: str, text: str) -> float:
+    """Probability-like score that the comment is a violation."""
+    model = get_cascade_model(agent_id)
+    z = model["bias"] + float(model["weights"][cascade_features(text)].sum())
+    return 1.0 / (1.0 + np.exp(-z))
+
+def train_cascade(agent_id: str, text: str, label: str):
+    """One SGD step towards the agent's label (NEEDS_WARNING counts as the uncertain middle)."""
+    target = {"VIOLATION": 1.0, "NEEDS_WARNING": 0.5, "FINE": 0.0}.get(label)
+    if target is None:
+        return
+    model = get_cascade_model(agent_id)
+    error = cascade_score(agent_id, text) - target
+    model["weights"][cascade_features(text)] -= CASCADE_LEARNING_RATE * error
+    model["bias"] -= CASCADE_LEARNING_RATE * 0.1 * error
+    model["trained"] += 1
+
+def cascade_label(agent_id: str, text: str, thresholds: Dict[str, float]):
+    """Return a local {"label", "reason", "local_score"} if confident, else None."""
+    score = cascade_score(agent_id, text)
+    if score <= thresholds["fine_below"]:
+        words = cascade_words(text)
+        fitted = get_cascade_model(agent_id)["trained"] >= CASCADE_MIN_LABELS
+        if not cascade_matches(words, CASCADE_RISK_TERMS) and (fitted or cascade_matches(words, CASCADE_BENIGN_TERMS)):
+            return {"label": "FINE", "reason": "Labeled locally: no risk signals detected.", "local_score": round(score, 4)}
+        return None
+    if score >= thresholds["violation_above"]:
+        return {"label": "VIOLATION", "reason": "Labeled locally: strong abuse or spam signals.", "local_score": round(score, 4)}
+    return None
+
+def cascade_thresholds(overrides: Dict[str, Any] = None) -> Dict[str, float]:
+    overrides = overrides or {}
+    return {
+        "fine_below": float(overrides.get("fine_below", CASCADE_FINE_BELOW)),
+        "violation_above": float(overrides.get("violation_above", CASCADE_VIOLATION_ABOVE)),
+    }
+
+def count_stages(classifications: List[Dict[str, Any]]) -> Dict[str, int]:
+    stages = {"cache": 0, "local": 0, "agent": 0}
+    for c in classifications:
+        stage = c.get("stage")
+        if stage in stages:
+            stages[stage] += 1
+    return stages
+
+def classify_one_with_agent(client, classifier_id: str, text: str) -> Dict[str, Any]:
+    """Ask the classifier twin for one comment's label (blocking; runs on a classification thread)."""
+    if deadline_exceeded():
+        return {"text": text, "label": "TIMEOUT", "reason": "Deadline reached before classification", "stage": "timeout"}
+    try:
+        resp = letta_send(
+            client,
+            classifier_id,
+            "Classify this single Reddit comment strictly into one of: VIOLATION, NEEDS_WARNING, FINE.\n"
+            "Return ONLY compact JSON: {\"label\": <VIOLATION|NEEDS_WARNING|FINE>, \"reason\": <short rationale 8-20 words>}.\n\n"
+            f"Comment: \n{text}"
+        )
+        agent_reply = resp.messages[-1].content
+        label = "FINE"
+        reason = agent_reply
+        try:
+            parsed = json.loads(agent_reply)
+            label = str(parsed.get("label", "FINE")).upper()
+            reason = str(parsed.get("reason", reason))
+        except Exception:
+            up = agent_reply.upper()
+            if "VIOLATION" in up:
+                label = "VIOLATION"
+            elif "WARNING" in up or "NEEDS_WARNING" in up:
+                label = "NEEDS_WARNING"
+            else:
+                label = "FINE"
+        return {"text": text, "label": label, "reason": reason, "stage": "agent"}
+    except Exception as e:
+        return {"text": text, "label": "ERROR", "reason": f"Agent error: {str(e)}", "stage": "agent"}
+
+def classify_comments_with_letta(client, agent_id: str, comments: List[str], max_items: int = 50, cascade: Dict[str, float] = None) -> List[Dict[str, Any]]:
+    """Label comments as cheaply as possible: verdict cache, then the local cascade
+    (when `cascade` thresholds are given), and only then the agent. Each result records its `stage`.
+    Blocking; agent calls fan out over up to MODERATION_CONCURRENCY threads, so call it via asyncio.to_thread.
+    """
     selected = comments[:max_items]
-    for text in selected:
+    results: List[Optional[Dict[str, Any]]] = [None] * len(selected)
+    pending = []
+    for i, text in enumerate(selected):
+        cached = lookup_verdict(agent_id, text)
+        if cached is not None:
+            results[i] = {"text": text, **cached, "stage": "cache"}
+            continue
+        local = cascade_label(agent_id, text, cascade) if cascade else None
+        if local is not None:
+            results[i] = {"text": text, **local, "stage": "local"}
+            continue
+        pending.append(i)
+    if pending:
         try:
-            resp = client.agents.messages.create(
-                agent_id=agent_id,
-                messages=[{
-                    "role": "user",
-                    "content": (
-                        "Classify this single Reddit comment strictly into one of: VIOLATION, NEEDS_WARNING, FINE.\n"
-                        "Return ONLY compact JSON: {\"label\": <VIOLATION|NEEDS_WARNING|FINE>, \"reason\": <short rationale 8-20 words>}.\n\n"
-                        f"Comment: \n{text}"
-                    )
-                }]
-            )
-            agent_reply = resp.messages[-1].content
-            label = "FINE"
-            reason = agent_reply
-            try:
-                parsed = json.loads(agent_reply)
-                label = str(parsed.get("label", "FINE")).upper()
-                reason = str(parsed.get("reason", reason))
-            except Exception:
-                up = agent_reply.upper()
-                if "VIOLATION" in up:
-                    label = "VIOLATION"
-                elif "WARNING" in up or "NEEDS_WARNING" in up:
-                    label = "NEEDS_WARNING"
-                else:
-                    label = "FINE"
-            results.append({"text": text, "label": label, "reason": reason})
+            classifier_id = get_classifier_agent(client, agent_id)
         except Exception as e:
-            results.append({"text": text, "label": "ERROR", "reason": f"Agent error: {str(e)}"})
+            classifier_id = None
+            for i in pending:
+                results[i] = {"text": selected[i], "label": "ERROR", "reason": f"Agent error: {str(e)}", "stage": "agent"}
+        if classifier_id is not None:
+            # Each call gets a copy of this context so the request deadline is visible on the worker thread
+            with ThreadPoolExecutor(max_workers=min(MODERATION_CONCURRENCY, len(pending))) as pool:
+                futures = [
+                    pool.submit(contextvars.copy_context().run, classify_one_with_agent, client, classifier_id, selected[i])
+                    for i in pending
+                ]
+                for i, future in zip(pending, futures):
+                    results[i] = future.result()
+            # Cache and scorer updates stay on this thread, in comment order
+            for i in pending:
+                if results[i]["stage"] == "agent" and results[i]["label"] != "ERROR":
+                    store_verdict(agent_id, selected[i], results[i]["label"], results[i]["reason"])
+                    train_cascade(agent_id, selected[i], results[i]["label"])
     return results
 
+# ---------- Sampled moderation estimates ----------
+# Instead of classifying the first N comments, draw a stratified sample (depth × score × time),
+# classify only that, and extrapolate verdict counts with confidence intervals. The sample grows
+# (Neyman allocation) until every label's interval half-width is within the margin or the budget is hit.
+
+VERDICT_LABELS = ["VIOLATION", "NEEDS_WARNING", "FINE", "ERROR"]
+
+def stratify_comments(records: List[Dict[str, Any]]) -> Dict[tuple, List[int]]:
+    if not records:
+        return {}
+    scores = np.asarray([_as_float(r.get("score")) for r in records])
+    created = np.asarray([_as_float(r.get("created_utc")) for r in records])
+    depths = np.minimum(np.asarray([int(r.get("depth") or 0) for r in records]), 2)
+    score_cuts = np.quantile(scores, [1 / 3, 2 / 3])
+    score_bins = np.searchsorted(score_cuts, scores, side="right")
+    time_bins = (created > np.median(created)).astype(int)
+    strata: Dict[tuple, List[int]] = {}
+    for i, key in enumerate(zip(depths.tolist(), score_bins.tolist(), time_bins.tolist())):
+        strata.setdefault(key, []).append(i)
+    return strata
+
+def normal_quantile(confidence: float) -> float:
+    """Two-sided z for the given confidence level (bisection on erf, no SciPy needed)."""
+    target = confidence
+    lo, hi = 0.0, 10.0
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if math.erf(mid / math.sqrt(2)) < target:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+def estimate_label_shares(strata: Dict[tuple, List[int]], labels: Dict[int, str], total: int, z: float) -> Dict[str, Dict[str, float]]:
+    """Stratified proportion estimate per label with a finite-population-corrected normal interval.
+    Strata with no sample yet are estimated from the sampled ones (shares are renormalized so they
+    still sum to 1) and add the worst-case variance of a single draw, so the margin check cannot stop on them.
+    """
+    sampled_weight = sum(len(m) for m in strata.values() if any(i in labels for i in m)) / total
+    estimates = {}
+    for label in VERDICT_LABELS:
+        share, variance = 0.0, 0.0
+        for members in strata.values():
+            weight = len(members) / total
+            sampled = [i for i in members if i in labels]
+            if not sampled:
+                variance += weight ** 2 * 0.25
+                continue
+            hits = sum(1 for i in sampled if labels[i] == label)
+            n_h, N_h = len(sampled), len(members)
+            share += weight * hits / n_h
+            # Add-one smoothing keeps the variance honest when a stratum's sample is all one label
+            p_smooth = (hits + 1) / (n_h + 2)
+            variance += weight ** 2 * p_smooth * (1 - p_smooth) / n_h * (1 - n_h / N_h)
+        share = share / sampled_weight if sampled_weight else 0.0
+        half_width = z * math.sqrt(variance)
+        estimates[label] = {"share": share, "low": max(0.0, share - half_width), "high": min(1.0, share + half_width), "half_width": half_width}
+    return estimates
+
+def allocate_sample(strata: Dict[tuple, List[int]], labels: Dict[int, str], size: int, rng) -> List[int]:
+    """Pick `size` more unsampled comments: one from every stratum not sampled yet (largest first),
+    then the rest proportional to N_h * spread of the stratum's labels.
+    """
+    unsampled = sorted(
+        (key for key, members in strata.items() if not any(i in labels for i in members)),
+        key=lambda key: len(strata[key]), reverse=True
+    )
+    picked: List[int] = [rng.choice(strata[key]) for key in unsampled[:size]]
+    size -= len(picked)
+    if size <= 0:
+        return picked
+    taken = set(picked)
+    weights = {}
+    for key, members in strata.items():
+        remaining = [i for i in members if i not in labels and i not in taken]
+        if not remaining:
+            continue
+        sampled = [labels[i] for i in members if i in labels]
+        if sampled:
+            flagged = sum(1 for l in sampled if l != "FINE")
+            p = (flagged + 1) / (len(sampled) + 2)
+            weights[key] = len(members) * math.sqrt(p * (1 - p))
+        else:
+            weights[key] = len(members) * 0.5
+    total_weight = sum(weights.values())
+    extra: List[int] = []
+    for key, weight in sorted(weights.items(), key=lambda kv: kv[1], reverse=True):
+        remaining = [i for i in strata[key] if i not in labels and i not in taken]
+        quota = max(1, round(size * weight / total_weight)) if total_weight else 1
+        extra.extend(rng.sample(remaining, min(quota, len(remaining))))
+        if len(extra) >= size:
+            break
+    return picked + extra[:size]
+
+def apportion_counts(shares: Dict[str, float], total: int) -> Dict[str, int]:
+    """Round shares of `total` to whole counts that still add up to `total` (largest remainder)."""
+    exact = {label: share * total for label, share in shares.items()}
+    counts = {label: int(math.floor(value)) for label, value in exact.items()}
+    leftover = total - sum(counts.values())
+    for label in sorted(exact, key=lambda label: exact[label] - counts[label], reverse=True)[:max(0, leftover)]:
+        counts[label] += 1
+    return counts
+
+def estimate_verdicts_by_sampling(client, agent_id: str, records: List[Dict[str, Any]], options: Dict[str, Any], cascade: Dict[str, float] = None, seed: str = "") -> Dict[str, Any]:
+    total = len(records)
+    budget = min(int(options.get("budget", SAMPLING_BUDGET)), total)
+    margin = float(options.get("margin", SAMPLING_MARGIN))
+    confidence = float(options.get("confidence", SAMPLING_CONFIDENCE))
+    z = normal_quantile(confidence)
+    rng = random.Random(seed)
+    strata = stratify_comments(records)
+    labels: Dict[int, str] = {}
+    classifications: List[Dict[str, Any]] = []
+    rounds = 0
+    batch = min(int(options.get("initial", SAMPLING_INITIAL)), budget)
+    estimates = {}
+    while batch > 0:
+        picked = allocate_sample(strata, labels, batch, rng)
+        if not picked:
+            break
+        batch_results = classify_comments_with_letta(client, agent_id, [records[i]["body"] for i in picked], max_items=len(picked), cascade=cascade)
+        for i, result in zip(picked, batch_results):
+            classifications.append({**result, "id": records[i].get("id")})
+            if result.get("label") == "TIMEOUT":
+                # Not part of the sample: it was never classified
+                continue
+            labels[i] = result.get("label", "ERROR") if result.get("label") in VERDICT_LABELS else "ERROR"
+        rounds += 1
+        if labels:
+            estimates = estimate_label_shares(strata, labels, total, z)
+        if deadline_exceeded() or (estimates and max(e["half_width"] for e in estimates.values()) <= margin):
+            break
+        batch = min(int(options.get("step", SAMPLING_STEP)), budget - len(labels))
+    if not estimates:
+        estimates = {label: {"share": 0.0, "low": 0.0, "high": 1.0, "half_width": 1.0} for label in VERDICT_LABELS}
+    breakdown = apportion_counts({label: e["share"] for label, e in estimates.items()}, total) if labels else {label: 0 for label in estimates}
+    intervals = {label: [int(math.floor(e["low"] * total)), int(math.ceil(e["high"] * total))] for label, e in estimates.items()}
+    return {
+        "classifications": classifications,
+        "verdict_breakdown": breakdown,
+        "verdict_intervals": intervals,
+        "sampling": {
+            "population": total,
+            "sampled": len(labels),
+            "strata": len(strata),
+            "rounds": rounds,
+            "confidence": confidence,
+            "max_half_width": round(max((e["half_width"] for e in estimates.values()), default=0.0), 4),
+            "target_margin": margin,
+        },
+    }
+
+# ---------- Incremental thread analysis ----------
+
+thread_analysis_states = LRUCache(THREAD_STATE_CACHE_SIZE)
+thread_summary_states = LRUCache(THREAD_STATE_CACHE_SIZE)
+
+EMOTION_KEYS = ["angry", "happy", "sad", "fearful", "surprised"]
+
+def thread_key(thread_url: str) -> str:
+    """Normalise a thread URL so trailing slashes, .json and query strings share one state entry."""
+    parsed = urlparse(thread_url)
+    path = parsed.path
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    return f"{parsed.netloc.lower()}{path.rstrip('/').lower()}"
+
+def get_thread_state(states: LRUCache, thread_url: str) -> Dict[str, Any]:
+    key = thread_key(thread_url)
+    state = states.get(key)
+    if state is None:
+        state = {"seen_ids": set(), "count": 0, "lock": asyncio.Lock()}
+        states.put(key, state)
+    return state
+
+def split_new_comments(state: Dict[str, Any], records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [r for r in records if r["id"] not in state["seen_ids"]]
+
+def parse_analysis(content: str) -> Dict[str, Any]:
+    try:
+        return json.loads(content)
+    except Exception:
+        return {"raw": content}
+
+def _as_float(value, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def merge_analysis(state: Dict[str, Any], delta: Dict[str, Any], new_count: int) -> Dict[str, Any]:
+    """Fold the analysis of `new_count` new comments into the thread's running aggregates."""
+    if "raw" in delta or new_count <= 0:
+        return state.get("analysis", delta)
+    old_count = state["count"]
+    total = old_count + new_count
+    prev = state.get("analysis") or {}
+
+    def weighted(key: str) -> float:
+        if key not in prev:
+            return _as_float(delta.get(key))
+        return (_as_float(prev.get(key)) * old_count + _as_float(delta.get(key)) * new_count) / total
+
+    # Keywords: rank-decayed weights scaled by batch size, so large batches count more
+    keyword_counts = state.setdefault("keyword_counts", {})
+    for rank, keyword in enumerate(delta.get("top_keywords", []) or []):
+        k = str(keyword).lower()
+        keyword_counts[k] = keyword_counts.get(k, 0.0) + new_count / (rank + 1)
+    top_keywords = [k for k, _ in sorted(keyword_counts.items(), key=lambda kv: kv[1], reverse=True)[:10]]
+
+    prev_emotions = prev.get("emotion_breakdown") or {}
+    new_emotions = delta.get("emotion_breakdown") or {}
+    emotion_breakdown = {
+        e: round((_as_float(prev_emotions.get(e)) * old_count + _as_float(new_emotions.get(e)) * new_count) / total, 1)
+        if prev_emotions else _as_float(new_emotions.get(e))
+        for e in EMOTION_KEYS
+    }
+
+    sentiment_score = weighted("sentiment_score")
+    controversy_score = weighted("controversy_score")
+    if sentiment_score > 0.2:
+        sentiment_overall = "positive"
+    elif sentiment_score < -0.2:
+        sentiment_overall = "negative"
+    else:
+        sentiment_overall = "mixed" if controversy_score > 0.5 else "neutral"
+
+    def latest_first(key: str, limit: int) -> List[str]:
+        merged = []
+        for item in list(delta.get(key, []) or []) + list(prev.get(key, []) or []):
+            if item not in merged:
+                merged.append(item)
+        return merged[:limit]
+
+    return {
+        "sentiment_overall": sentiment_overall,
+        "sentiment_score": round(sentiment_score, 3),
+        "top_keywords": top_keywords,
+        "toxicity_ratio": round(weighted("toxicity_ratio"), 3),
+        "controversy_score": round(controversy_score, 3),
+        "themes": latest_first("themes", 5),
+        "key_opinions": latest_first("key_opinions", 3),
+        "emotion_breakdown": emotion_breakdown
+    }
+
+def is_significant_delta(state: Dict[str, Any], new_count: int) -> bool:
+    if not state.get("summary"):
+        return new_count > 0
+    return new_count >= max(SUMMARY_DELTA_MIN_COMMENTS, int(state["count"] * SUMMARY_DELTA_MIN_RATIO))
+
+async def analyze_thread_incremental(thread_url: str) -> Dict[str, Any]:
+    """Analyze only comments not seen before and merge them into the stored aggregates."""
+    state = get_thread_state(thread_analysis_states, thread_url)
+    result = await analyze_new_comments(state, thread_url)
+    result.pop("new_comments")
+    return result
+
+async def analyze_new_comments(state: Dict[str, Any], thread_url: str) -> Dict[str, Any]:
+    async with state["lock"]:
+        records = await fetch_reddit_comment_records(thread_url, sort="new", strict=True)
+        new_records = split_new_comments(state, records)
+        unparsed = 0
+        if new_records:
+            content = await claude_chat(build_analysis_prompt([r["body"] for r in new_records]), max_tokens=400)
+            delta = parse_analysis(content)
+            if "raw" in delta:
+                # Leave these comments unseen so the next call analyzes them again
+                unparsed = len(new_records)
+                new_records = []
+            else:
+                state["analysis"] = merge_analysis(state, delta, len(new_records))
+                state["seen_ids"].update(r["id"] for r in new_records)
+                state["count"] += len(new_records)
+        return {
+            "analysis": state.get("analysis", {}),
+            "count": state["count"],
+            "new_count": len(new_records),
+            "new_comments": new_records,
+            "retry_pending": unparsed,
+            "incremental": True
+        }
+
+async def summarize_thread_incremental(thread_url: str) -> Dict[str, Any]:
+    """Re-summarize only when enough new comments arrived; otherwise return the stored summary."""
+    state = get_thread_state(thread_summary_states, thread_url)
+    async with state["lock"]:
+        records = await fetch_reddit_comment_records(thread_url, sort="new", strict=True)
+        new_records = split_new_comments(state, records)
+        pending = state.setdefault("pending", [])
+        pending.extend(r["body"] for r in new_records)
+        state["seen_ids"].update(r["id"] for r in new_records)
+        regenerated = is_significant_delta(state, len(pending))
+        if regenerated:
+            if state.get("summary"):
+                messages = build_incremental_summary_prompt(state["summary"], pending)
+            else:
+                messages = build_summary_prompt(pending)
+            state["summary"] = (await claude_chat(messages)).strip()
+            state["count"] += len(pending)
+            state["pending"] = []
+        return {
+            "summary": state.get("summary", ""),
+            "count": state["count"] + len(state["pending"]),
+            "new_count": len(new_records),
+            "regenerated": regenerated,
+            "incremental": True
+        }
+
+# ---------- Map-reduce summarization ----------
+
+summary_chunk_cache = LRUCache(SUMMARY_CHUNK_CACHE_SIZE)
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def chunk_comments_by_subtree(records: List[Dict[str, Any]], max_tokens: int = SUMMARY_CHUNK_TOKENS) -> List[List[Dict[str, Any]]]:
+    """Pack whole reply subtrees into token-sized chunks.
+    Boundaries are content-defined (a hash of the subtree root), so new comments only
+    change the chunk holding their subtree instead of shifting every later chunk.
+    """
+    subtrees: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        subtrees.setdefault(record.get("root_id") or record["id"], []).append(record)
+    chunks: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    current_tokens = 0
+    for root_id, subtree in subtrees.items():
+        subtree_tokens = sum(estimate_tokens(r["body"]) for r in subtree)
+        if current and current_tokens + subtree_tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        if subtree_tokens > max_tokens:
+            # Oversized subtree: split it on its own so it doesn't drag neighbours along
+            piece, piece_tokens = [], 0
+            for record in subtree:
+                tokens = estimate_tokens(record["body"])
+                if piece and piece_tokens + tokens > max_tokens:
+                    chunks.append(piece)
+                    piece, piece_tokens = [], 0
+                piece.append(record)
+                piece_tokens += tokens
+            if piece:
+                chunks.append(piece)
+            continue
+        current.extend(subtree)
+        current_tokens += subtree_tokens
+        if current_tokens >= max_tokens // 2 and zlib.crc32(root_id.encode("utf-8")) % SUMMARY_CHUNK_BOUNDARY == 0:
+            chunks.append(current)
+            current, current_tokens = [], 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+def chunk_cache_key(chunk: List[Dict[str, Any]]) -> str:
+    digest = hashlib.sha1()
+    for record in chunk:
+        digest.update(record["id"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(record["body"].encode("utf-8"))
+        digest.update(b"\1")
+    return digest.hexdigest()
+
+async def summarize_map_reduce(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarize every comment: chunk summaries run concurrently (and are cached), then get reduced."""
+    # Reddit's own ordering shifts between polls; a stable order keeps unchanged chunks (and their cache keys) stable
+    records = sorted(records, key=lambda r: (r.get("created_utc") or 0.0, r["id"]))
+    chunks = chunk_comments_by_subtree(records)
+    semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+    cached_chunks = 0
+
+    async def summarize_chunk(chunk: List[Dict[str, Any]]) -> str:
+        nonlocal cached_chunks
+        key = chunk_cache_key(chunk)
+        cached = summary_chunk_cache.get(key)
+        if cached is not None:
+            cached_chunks += 1
+            return cached
+        async with semaphore:
+            partial = (await claude_chat(build_chunk_summary_prompt([r["body"] for r in chunk]))).strip()
+        summary_chunk_cache.put(key, partial)
+        return partial
+
+    async def reduce_group(group: List[str], final: bool) -> str:
+        async with semaphore:
+            return (await claude_chat(build_reduce_summary_prompt(group, final=final))).strip()
+
+    partials = list(await asyncio.gather(*(summarize_chunk(c) for c in chunks)))
+    # Reduce level by level until the partial summaries fit one prompt
+    while len(partials) > 1 and sum(estimate_tokens(p) for p in partials) > SUMMARY_CHUNK_TOKENS:
+        groups, group, group_tokens = [], [], 0
+        for partial in partials:
+            tokens = estimate_tokens(partial)
+            if group and group_tokens + tokens > SUMMARY_CHUNK_TOKENS:
+                groups.append(group)
+                group, group_tokens = [], 0
+            group.append(partial)
+            group_tokens += tokens
+        if group:
+            groups.append(group)
+        partials = list(await asyncio.gather(*(reduce_group(g, final=False) for g in groups)))
+    summary = await reduce_group(partials, final=True) if partials else ""
+    return {"summary": summary, "count": len(records), "chunks": len(chunks), "cached_chunks": cached_chunks, "mode": "map_reduce"}
+
+# ---------- Thread watch scheduler ----------
+
+def close_watch(key: str, watch: Dict[str, Any]):
+    """Tell every subscriber of an evicted or abandoned watch to disconnect."""
+    for queue in list(watch["subscribers"]):
+        queue.put_nowait(None)
+    watch["subscribers"].clear()
+
+thread_watches = LRUCache(WATCH_CACHE_SIZE, on_evict=close_watch)
+watch_scheduler: Dict[str, Any] = {"task": None, "wake": None, "polls": set()}
+# Pre-forked workers (serve.py) each run this scheduler. With a shared directory, a thread is polled
+# by whichever worker holds its flock lease; the poll state is saved there and the others reuse it.
+watch_shared: Dict[str, Any] = {"dir": os.getenv("WATCH_SHARED_DIR") or None}
+
+def watch_shared_path(key: str) -> str:
+    return os.path.join(watch_shared["dir"], hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+def acquire_watch_lease(key: str):
+    """Non-blocking per-thread lock shared by all workers; returns the open file, or None if held elsewhere."""
+    import fcntl
+    lease = open(watch_shared_path(key) + ".lock", "a+b")
+    try:
+        fcntl.flock(lease.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lease.close()
+        return None
+    return lease
+
+def release_watch_lease(lease):
+    import fcntl
+    fcntl.flock(lease.fileno(), fcntl.LOCK_UN)
+    lease.close()
+
+def load_watch_shared(key: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(watch_shared_path(key) + ".json", "rb") as f:
+            return loads_json(f.read())
+    except (OSError, ValueError):
+        return None
+
+def save_watch_shared(key: str, data: Dict[str, Any]):
+    path = watch_shared_path(key) + ".json"
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def adopt_watch_shared(watch: Dict[str, Any], shared: Dict[str, Any]):
+    """Take over another worker's newer poll state, so this worker neither re-fetches nor re-analyzes it."""
+    watch["state"].update(seen_ids=set(shared["seen_ids"]), count=shared["count"], keyword_counts=shared.get("keyword_counts", {}))
+    if shared["analysis"] is not None:
+        watch["state"]["analysis"] = shared["analysis"]
+    watch["seq"] = shared["seq"]
+    watch["rate"] = shared["rate"]
+    watch["interval"] = shared["interval"]
+    watch["last_poll"] = shared["polled_at"]
+
+def watch_update(watch: Dict[str, Any], new_comments: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "type": "update",
+        "thread_url": watch["url"],
+        "new_comments": new_comments,
+        "analysis": watch["state"].get("analysis", {}),
+        "count": watch["state"]["count"],
+        "interval": watch["interval"]
+    }
+
+def subscribe_thread(thread_url: str) -> asyncio.Queue:
+    key = thread_key(thread_url)
+    watch = thread_watches.get(key)
+    if watch is None:
+        watch = {
+            "key": key,
+            "url": thread_url,
+            "seq": 0,
+            "subscribers": set(),
+            "state": {"seen_ids": set(), "count": 0, "lock": asyncio.Lock()},
+            "interval": WATCH_MIN_INTERVAL,
+            "rate": 0.0,
+            "last_poll": 0.0,
+            "next_poll": 0.0,
+            "polling": False
+        }
+        thread_watches.put(key, watch)
+    queue: asyncio.Queue = asyncio.Queue()
+    watch["subscribers"].add(queue)
+    if watch["state"].get("analysis") is not None:
+        queue.put_nowait(watch_snapshot(watch))
+    ensure_watch_scheduler()
+    return queue
+
+def unsubscribe_thread(thread_url: str, queue: asyncio.Queue):
+    key = thread_key(thread_url)
+    watch = thread_watches.get(key)
+    if watch is None:
+        return
+    watch["subscribers"].discard(queue)
+    if not watch["subscribers"]:
+        thread_watches.pop(key, None)
+
+def watch_snapshot(watch: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "snapshot",
+        "thread_url": watch["url"],
+        "analysis": watch["state"].get("analysis", {}),
+        "count": watch["state"]["count"],
+        "interval": watch["interval"]
+    }
+
+def next_watch_interval(watch: Dict[str, Any], new_count: int, elapsed: float) -> float:
+    """Aim for roughly WATCH_TARGET_NEW_COMMENTS per poll: hot threads speed up, quiet ones back off."""
+    if watch["last_poll"] and elapsed > 0:
+        watch["rate"] = 0.5 * watch["rate"] + 0.5 * (new_count / elapsed)
+    if new_count == 0 or watch["rate"] <= 0:
+        interval = watch["interval"] * 2
+    else:
+        interval = WATCH_TARGET_NEW_COMMENTS / watch["rate"]
+    return max(WATCH_MIN_INTERVAL, min(WATCH_MAX_INTERVAL, interval))
+
+async def poll_watched_thread(watch: Dict[str, Any]):
+    """One upstream fetch per thread per interval (across all workers), fanned out to every subscriber."""
+    watch["polling"] = True
+    lease = None
+    try:
+        if watch_shared["dir"]:
+            lease = await asyncio.to_thread(acquire_watch_lease, watch["key"])
+            if lease is None:
+                # Another worker is polling this thread right now; pick up its result next time
+                return
+            shared = await asyncio.to_thread(load_watch_shared, watch["key"])
+            if shared and shared["seq"] > watch["seq"]:
+                adopt_watch_shared(watch, shared)
+                if time.time() - shared["polled_at"] < shared["interval"]:
+                    if shared["new_comments"]:
+                        for queue in list(watch["subscribers"]):
+                            queue.put_nowait(watch_update(watch, shared["new_comments"]))
+                    return
+        now = time.time()
+        elapsed = now - watch["last_poll"] if watch["last_poll"] else 0.0
+        result = await analyze_new_comments(watch["state"], watch["url"])
+        watch["interval"] = next_watch_interval(watch, result["new_count"], elapsed)
+        watch["last_poll"] = now
+        if lease is not None:
+            watch["seq"] += 1
+            state = watch["state"]
+            await asyncio.to_thread(save_watch_shared, watch["key"], {
+                "seq": watch["seq"], "polled_at": now, "interval": watch["interval"], "rate": watch["rate"],
+                "seen_ids": list(state["seen_ids"]), "count": state["count"], "analysis": state.get("analysis"),
+                "keyword_counts": state.get("keyword_counts", {}), "new_comments": result["new_comments"],
+            })
+        if result["new_count"]:
+            for queue in list(watch["subscribers"]):
+                queue.put_nowait(watch_update(watch, result["new_comments"]))
+    except Exception as e:
+        print(f"Warning: watch poll failed for {watch['url']}: {e}")
+        watch["interval"] = min(WATCH_MAX_INTERVAL, watch["interval"] * 2)
+    finally:
+        if lease is not None:
+            release_watch_lease(lease)
+        watch["next_poll"] = time.time() + watch["interval"]
+        watch["polling"] = False
+
+async def run_watch_scheduler():
+    """Shared loop: poll every due watch concurrently, then sleep until the next one is due."""
+    request_deadline.set(None)
+    while thread_watches:
+        now = time.time()
+        for watch in list(thread_watches.values()):
+            if not watch["polling"] and watch["next_poll"] <= now:
+                task = asyncio.create_task(poll_watched_thread(watch))
+                watch_scheduler["polls"].add(task)
+                task.add_done_callback(watch_scheduler["polls"].discard)
+        pending = [w["next_poll"] for w in thread_watches.values() if not w["polling"]]
+        delay = max(0.5, min(pending) - time.time()) if pending else WATCH_MIN_INTERVAL
+        watch_scheduler["wake"].clear()
+        try:
+            await asyncio.wait_for(watch_scheduler["wake"].wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+    watch_scheduler["task"] = None
+
+def ensure_watch_scheduler():
+    if watch_scheduler["wake"] is None:
+        watch_scheduler["wake"] = asyncio.Event()
+    if watch_scheduler["task"] is None or watch_scheduler["task"].done():
+        watch_scheduler["task"] = asyncio.create_task(run_watch_scheduler())
+    watch_scheduler["wake"].set()
+
+# ---------- Unified thread insights ----------
+
+async def run_dag(stages: Dict[str, tuple], wanted: List[str], on_result=None) -> tuple:
+    """Run the stages `wanted` depends on, each exactly once, as soon as their inputs are ready.
+    `stages` maps name -> (dependency names, fn(results) -> value). Async fns run on the loop;
+    plain fns run in a worker thread so CPU-bound stages don't hold up sibling branches.
+    Returns (results, timings).
+    """
+    needed, stack = set(), list(wanted)
+    while stack:
+        name = stack.pop()
+        if name not in needed:
+            needed.add(name)
+            stack.extend(stages[name][0])
+    results: Dict[str, Any] = {}
+    timings: Dict[str, float] = {}
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def run(name: str):
+        deps, fn = stages[name]
+        await asyncio.gather(*(tasks[d] for d in deps))
+        started = time.perf_counter()
+        if inspect.iscoroutinefunction(fn):
+            results[name] = await fn(results)
+        else:
+            results[name] = await asyncio.to_thread(fn, results)
+        timings[name] = round(time.perf_counter() - started, 3)
+        if on_result:
+            await on_result(name, results[name])
+
+    # All tasks exist before any of them runs, so dependencies can be awaited by name
+    for name in needed:
+        tasks[name] = asyncio.create_task(run(name))
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return results, timings
+
+INSIGHT_OUTPUTS = ["summary", "analysis", "moderation"]
+
+def build_insight_stages(thread_url: str, body: Dict[str, Any], outputs: List[str]) -> Dict[str, tuple]:
+    async def fetch(results):
+        options = moderation_fetch_options(body) if "moderation" in outputs else {}
+        return await fetch_reddit_comment_records(thread_url, **options)
+
+    def normalize(results):
+        records = [r for r in results["fetch"] if str(r.get("body", "")).strip()]
+        return {"records": records, "comments": [r["body"] for r in records]}
+
+    async def summary(results):
+        comments = results["normalize"]["comments"]
+        if not comments:
+            return "No comments found or thread unavailable."
+        prompt = await asyncio.to_thread(build_summary_prompt, comments)
+        return (await claude_chat(prompt)).strip()
+
+    async def analysis(results):
+        comments = results["normalize"]["comments"]
+        if not comments:
+            return {"sentiment_overall": "neutral", "top_keywords": [], "toxicity_ratio": 0, "themes": []}
+        prompt = await asyncio.to_thread(build_analysis_prompt, comments)
+        return parse_analysis(await claude_chat(prompt, max_tokens=400))
+
+    async def moderation(results):
+        records = results["normalize"]["records"]
+        if not records:
+            return {"error": "No comments found or thread unavailable"}
+        # A moderation failure shouldn't take the summary and analysis down with it
+        try:
+            return await run_moderation(thread_url, records, body)
+        except HTTPException as e:
+            return {"error": e.detail}
+        except Exception as e:
+            return {"error": f"Moderation failed: {str(e)}"}
+
+    async def aggregate(results):
+        out = {"thread_url": thread_url, "count": len(results["normalize"]["comments"])}
+        for name in outputs:
+            out[name] = results[name]
+        return out
+
+    return {
+        "fetch": ([], fetch),
+        "normalize": (["fetch"], normalize),
+        "summary": (["normalize"], summary),
+        "analysis": (["normalize"], analysis),
+        "moderation": (["normalize"], moderation),
+        "aggregate": (["normalize"] + outputs, aggregate),
+    }
+
+# ---------- Serving runtime ----------
+# backend/serve.py imports this module once, calls preload_shared_state() and forks workers, which
+# then share the warmed indexes copy-on-write (and the mmap'd corpus/search files through the page
+# cache). Under plain `uvicorn backend.main:app` the same state is still built lazily on first use.
+
+serving_state: Dict[str, Any] = {
+    "role": "single", "worker": None, "import_seconds": None, "preload_seconds": None,
+    "preload_steps": {}, "forked_at": None,
+}
+
+def preload_shared_state() -> Dict[str, Any]:
+    """Warm everything workers only read; failures are recorded and left to lazy loading."""
+    steps = [
+        ("corpus", open_corpus),
+        ("search_index", open_search_index),
+        ("related_index", ensure_related_index),
+        ("routing", lambda: (load_routing_table(force=True), build_agent_profiles())),
+        ("cascade_models", lambda: [get_cascade_model(a) for a in [*LETTA_AGENTS.values(), TIMELINE_TOXICITY_MODEL]]),
+    ]
+    started = time.perf_counter()
+    for name, step in steps:
+        step_started = time.perf_counter()
+        try:
+            step()
+            serving_state["preload_steps"][name] = round(time.perf_counter() - step_started, 4)
+        except Exception as e:
+            serving_state["preload_steps"][name] = f"failed: {e}"
+    serving_state["preload_seconds"] = round(time.perf_counter() - started, 4)
+    return serving_state
+
+def mark_worker(index: int):
+    """Called in each forked worker before it starts serving."""
+    serving_state.update(role="worker", worker=index, forked_at=time.time())
+    # Connection pools and executors must not be shared across a fork
+    letta_client_state["client"] = None
+    json_parse_pool["executor"] = None
+
+def process_memory(pid="self") -> Dict[str, float]:
+    """RSS/PSS and shared vs private memory in MB from /proc (Linux); peak RSS elsewhere."""
+    try:
+        fields = {}
+        with open(f"/proc/{pid}/smaps_rollup", 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3 and parts[0].endswith(":"):
+                    fields[parts[0][:-1]] = int(parts[1]) / 1024.0
+        return {
+            "rss_mb": round(fields.get("Rss", 0.0), 1),
+            "pss_mb": round(fields.get("Pss", 0.0), 1),
+            "shared_mb": round(fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0), 1),
+            "private_mb": round(fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0), 1),
+        }
+    except (OSError, ValueError):
+        if pid != "self":
+            return {}
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is KB on Linux, bytes on macOS
+        return {"max_rss_mb": round(peak / (2 ** 20 if peak > 2 ** 32 else 1024.0), 1)}
+
+def sibling_worker_pids() -> List[int]:
+    try:
+        ppid = os.getppid()
+        with open(f"/proc/{ppid}/task/{ppid}/children", 'r') as f:
+            return [int(pid) for pid in f.read().split()]
+    except (OSError, ValueError):
+        return [os.getpid()]
+
+@app.on_event("startup")
+async def warm_routing_profiles():
+    """Single-process servers build the similarity profiles at startup; serve.py already preloaded them."""
+    load_routing_table()
+    if routing_state["profiles"] is None:
+        schedule_agent_profiles()
+
+@app.on_event("startup")
+async def start_letta_maintenance():
+    if LETTA_API_KEY:
+        ensure_letta_compaction()
+
 @app.get("/health")
 async def health():
     active_key = None
@@ -656,11 +3894,27 @@ async def health():
         "key_prefix": active_key
     }
 
+@app.get("/health/runtime")
+async def runtime_health():
+    """Cold-start timings and memory for this process and, under serve.py, every sibling worker."""
+    workers = {}
+    if serving_state["role"] == "worker":
+        workers = {pid: process_memory(pid) for pid in sibling_worker_pids()}
+    loop_lag = {"max_blocked_ms": round(loop_lag_state["max_lag"] * 1000, 1), "recent_stalls": list(loop_lag_state["stalls"])}
+    return {**serving_state, "pid": os.getpid(), "memory": process_memory(), "workers": workers, "loop_lag": loop_lag}
+
 @app.post("/api/summarize")
 async def summarize(body: Dict[str, Any] = Body(...)):
     thread_url = body.get("thread_url")
     if not thread_url:
         raise HTTPException(status_code=400, detail="thread_url is required")
+    if body.get("incremental"):
+        return await summarize_thread_incremental(thread_url)
+    if body.get("mode") == "map_reduce":
+        records = await fetch_reddit_comment_records(thread_url, sort="old", include_replies=True, limit=SUMMARY_MAX_COMMENTS)
+        if not records:
+            return {"summary": "No comments found or thread unavailable.", "count": 0}
+        return await summarize_map_reduce(records)
     comments = await fetch_reddit_comments(thread_url)
     if not comments:
         return {"summary": "No comments found or thread unavailable.", "count": 0}
@@ -672,6 +3926,8 @@ async def analyze(body: Dict[str, Any] = Body(...)):
     thread_url = body.get("thread_url")
     if not thread_url:
         raise HTTPException(status_code=400, detail="thread_url is required")
+    if body.get("incremental"):
+        return await analyze_thread_incremental(thread_url)
     comments = await fetch_reddit_comments(thread_url)
     if not comments:
         return {"analysis": {"sentiment_overall":"neutral","top_keywords":[],"toxicity_ratio":0,"themes":[]}, "count": 0}
@@ -684,35 +3940,167 @@ async def analyze(body: Dict[str, Any] = Body(...)):
 
 @app.post("/api/compare")
 async def compare_threads(body: Dict[str, Any] = Body(...)):
+    """Compare 2-5 threads with the LLM, or with `"local": true` rank any number of threads
+    (`thread_urls`, `post_ids` and/or a whole `subreddit`) by precomputed local features.
+    """
+    if body.get("local"):
+        return await compare_threads_locally(body)
     urls = body.get("thread_urls", [])
     if not urls or len(urls) < 2:
         raise HTTPException(status_code=400, detail="At least 2 thread URLs required")
     if len(urls) > 5:
         raise HTTPException(status_code=400, detail="Maximum 5 threads allowed")
-    results = []
-    for url in urls:
+    set_request_deadline(body.get("timeout"), override=True)
+
+    async def compare_one(url: str) -> Dict[str, Any]:
         comments = await fetch_reddit_comments(url)
         if not comments:
-            results.append({
+            return {
                 "url": url,
                 "summary": "No data available",
                 "analysis": {},
                 "count": 0
-            })
-            continue
-        summary_content = await claude_chat(build_summary_prompt(comments))
-        analysis_content = await claude_chat(build_analysis_prompt(comments), max_tokens=400)
+            }
+        summary_content, analysis_content = await asyncio.gather(
+            claude_chat(build_summary_prompt(comments)),
+            claude_chat(build_analysis_prompt(comments), max_tokens=400)
+        )
         try:
             analysis = json.loads(analysis_content)
         except Exception:
             analysis = {"raw": analysis_content}
-        results.append({
+        return {
             "url": url,
             "summary": summary_content.strip(),
             "analysis": analysis,
             "count": len(comments)
-        })
-    return {"threads": results}
+        }
+
+    results = []
+    outcomes = await gather_until_deadline([lambda u=url: compare_one(u) for url in urls])
+    for url, (status, value) in zip(urls, outcomes):
+        if status == "ok":
+            results.append(value)
+        elif status == "timeout":
+            results.append({"url": url, "summary": "Timed out", "analysis": {}, "count": 0, "timed_out": True})
+        else:
+            if isinstance(value, HTTPException):
+                raise value
+            raise HTTPException(status_code=500, detail=f"Comparison failed: {str(value)}")
+    return {"threads": results, "timed_out": sum(1 for r in results if r.get("timed_out"))}
+
+COMPARE_RANKINGS = ("engagement", "sentiment", "controversy", "similarity")
+
+def select_local_compare_rows(body: Dict[str, Any]) -> tuple:
+    """Corpus rows and external URLs to compare, plus the explicitly listed thread similarity is measured from."""
+    rows, external = [], []
+    anchor = None
+    with related_lock:
+        if body.get("subreddit"):
+            key = str(body["subreddit"]).lower()
+            rows.extend(r for r, t in enumerate(related_state["threads"]) if t["subreddit"] == key)
+        for post_id in body.get("post_ids", []):
+            if post_id not in related_state["rows"]:
+                raise HTTPException(status_code=404, detail=f"Post not found: {post_id}")
+            rows.append(related_state["rows"][post_id])
+            anchor = anchor or ("row", related_state["rows"][post_id])
+        for url in body.get("thread_urls", []):
+            match = re.search(r"/comments/([a-z0-9]+)", url)
+            row = related_state["rows"].get(match.group(1)) if match else None
+            if row is None:
+                external.append(url)
+                anchor = anchor or ("url", url)
+            else:
+                rows.append(row)
+                anchor = anchor or ("row", row)
+    return list(dict.fromkeys(rows)), external, anchor
+
+def load_local_compare_threads(rows: List[int]) -> tuple:
+    threads = []
+    with related_lock:
+        model = related_state["model"]
+        for row in rows:
+            thread = related_state["threads"][row]
+            threads.append({
+                "post_id": thread["post_id"], "url": thread["url"], "title": thread["title"], "subreddit": thread["subreddit"],
+                "vector": related_state["vectors"][row], "raw": related_state["raw"][row], "keywords": thread["keywords"],
+            })
+    return model, threads
+
+def rank_local_compare_threads(model, threads: List[Dict[str, Any]], fetched: List[tuple], rank_by: str, anchor_index: Optional[int]) -> Dict[str, Any]:
+    """Embed fetched threads, then score and rank everything (CPU-bound; runs in a worker thread)."""
+    for url, records in fetched:
+        profile = records_thread_profile(records)
+        vector, keywords = embed_thread(model, profile)
+        threads.append({"post_id": None, "url": url, "title": None, "subreddit": None, "vector": vector, "raw": profile["features"], "keywords": keywords})
+    vectors = np.stack([t.pop("vector") for t in threads])
+    similarity = vectors @ vectors.T
+    for thread in threads:
+        thread["analysis"] = local_thread_analysis(thread.pop("raw"), thread.pop("keywords"))
+    if rank_by == "similarity":
+        # Similarity to the first listed thread (or the subreddit centroid when none was listed or loaded)
+        reference = vectors[anchor_index] if anchor_index is not None else vectors.mean(axis=0)
+        keys = vectors @ reference
+    elif rank_by == "sentiment":
+        keys = np.asarray([t["analysis"]["sentiment_score"] for t in threads])
+    else:
+        keys = np.asarray([t["analysis"][f"{rank_by}_score"] for t in threads])
+    order = np.argsort(-keys, kind="stable")
+    ranked = [{"rank": rank + 1, **threads[i], "rank_value": round(float(keys[i]), 4)} for rank, i in enumerate(order)]
+    result = {"threads": ranked, "rank_by": rank_by, "count": len(ranked), "local": True}
+    if len(threads) <= 50:
+        result["similarity"] = np.round(similarity[np.ix_(order, order)], 3).tolist()
+    return result
+
+async def compare_threads_locally(body: Dict[str, Any]) -> Dict[str, Any]:
+    """LLM-free comparison: corpus threads come straight from the related-threads index, other
+    URLs are fetched once and embedded with the same frozen model.
+    """
+    started = time.perf_counter()
+    rank_by = body.get("rank_by", "engagement")
+    if rank_by not in COMPARE_RANKINGS:
+        raise HTTPException(status_code=400, detail=f"rank_by must be one of: {', '.join(COMPARE_RANKINGS)}")
+    set_request_deadline(body.get("timeout"), override=True)
+    try:
+        await asyncio.to_thread(ensure_related_index)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Reddit data not found")
+
+    # related_lock is a threading lock; everything holding it stays off the event loop
+    rows, external, anchor = await asyncio.to_thread(select_local_compare_rows, body)
+    if len(rows) + len(external) < 2:
+        raise HTTPException(status_code=400, detail="At least 2 threads required")
+    if len(rows) + len(external) > COMPARE_LOCAL_MAX_THREADS:
+        raise HTTPException(status_code=400, detail=f"Maximum {COMPARE_LOCAL_MAX_THREADS} threads allowed")
+
+    model, threads = await asyncio.to_thread(load_local_compare_threads, rows)
+    outcomes = await gather_until_deadline([
+        lambda u=url: fetch_reddit_comment_records(u, include_replies=True, limit=SAMPLING_MAX_COMMENTS, strict=True)
+        for url in external
+    ])
+    fetched, timed_out, failed = [], [], []
+    for url, (status, value) in zip(external, outcomes):
+        if status == "error":
+            failed.append(url)
+        elif status != "ok" or not value:
+            timed_out.append(url)
+        else:
+            fetched.append((url, value))
+    if not threads and not fetched:
+        if failed and not timed_out:
+            raise RedditFetchError("None of the threads could be fetched from Reddit")
+        raise HTTPException(status_code=504, detail="No threads could be loaded before the deadline")
+
+    anchor_index = None
+    if anchor and anchor[0] == "row":
+        anchor_index = rows.index(anchor[1])
+    elif anchor and anchor[1] in dict(fetched):
+        anchor_index = len(rows) + [url for url, _ in fetched].index(anchor[1])
+    result = await asyncio.to_thread(rank_local_compare_threads, model, threads, fetched, rank_by, anchor_index)
+    result["timed_out"] = len(timed_out)
+    result["failed"] = len(failed)
+    result["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
 
 @app.post("/api/batch")
 async def batch_analyze(body: Dict[str, Any] = Body(...)):
@@ -721,43 +4109,173 @@ async def batch_analyze(body: Dict[str, Any] = Body(...)):
         raise HTTPException(status_code=400, detail="thread_urls array is required")
     if len(urls) > 20:
         raise HTTPException(status_code=400, detail="Maximum 20 threads allowed in batch")
-    results = []
-    for url in urls:
-        try:
-            comments = await fetch_reddit_comments(url)
-            if not comments:
-                results.append({
-                    "url": url,
-                    "status": "failed",
-                    "error": "No comments found"
-                })
-                continue
-            summary_content = await claude_chat(build_summary_prompt(comments))
-            analysis_content = await claude_chat(build_analysis_prompt(comments), max_tokens=400)
-            try:
-                analysis = json.loads(analysis_content)
-            except Exception:
-                analysis = {"raw": analysis_content}
-            results.append({
-                "url": url,
-                "status": "success",
-                "summary": summary_content.strip(),
-                "analysis": analysis,
-                "count": len(comments)
-            })
-        except Exception as e:
-            results.append({
+    set_request_deadline(body.get("timeout"), override=True)
+
+    async def analyze_one(url: str) -> Dict[str, Any]:
+        comments = await fetch_reddit_comments(url)
+        if not comments:
+            return {
                 "url": url,
-                "status": "error",
-                "error": str(e)
-            })
+                "status": "failed",
+                "error": "No comments found"
+            }
+        summary_content, analysis_content = await asyncio.gather(
+            claude_chat(build_summary_prompt(comments)),
+            claude_chat(build_analysis_prompt(comments), max_tokens=400)
+        )
+        try:
+            analysis = json.loads(analysis_content)
+        except Exception:
+            analysis = {"raw": analysis_content}
+        return {
+            "url": url,
+            "status": "success",
+            "summary": summary_content.strip(),
+            "analysis": analysis,
+            "count": len(comments)
+        }
+
+    results = []
+    outcomes = await gather_until_deadline([lambda u=url: analyze_one(u) for url in urls])
+    for url, (status, value) in zip(urls, outcomes):
+        if status == "ok":
+            results.append(value)
+        elif status == "timeout":
+            results.append({"url": url, "status": "timeout", "error": "Deadline reached before this thread finished"})
+        else:
+            results.append({"url": url, "status": "error", "error": str(value)})
     return {
         "total": len(urls),
         "successful": len([r for r in results if r.get("status") == "success"]),
         "failed": len([r for r in results if r.get("status") != "success"]),
+        "timed_out": len([r for r in results if r.get("status") == "timeout"]),
         "results": results
     }
 
+@app.websocket("/ws/watch")
+async def watch_thread(websocket: WebSocket):
+    """Subscribe to a thread: `?thread_url=...` or a first message {"thread_url": ...}.
+    Pushes new comments and updated metrics whenever the shared scheduler sees them.
+    """
+    await websocket.accept()
+    thread_url = websocket.query_params.get("thread_url")
+    try:
+        if not thread_url:
+            thread_url = (await websocket.receive_json()).get("thread_url")
+    except Exception:
+        thread_url = None
+    if not thread_url:
+        await websocket.close(code=1008, reason="thread_url is required")
+        return
+    queue = subscribe_thread(thread_url)
+
+    async def push_updates():
+        while True:
+            update = await queue.get()
+            if update is None:
+                await websocket.close(code=1001, reason="Watch evicted")
+                return
+            await websocket.send_json(update)
+
+    async def wait_for_disconnect():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+    tasks = [asyncio.create_task(push_updates()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        unsubscribe_thread(thread_url, queue)
+
+@app.post("/api/insights")
+async def thread_insights(body: Dict[str, Any] = Body(...)):
+    """Fetch a thread once and run summary, analysis and/or moderation on it in parallel.
+    `outputs` picks the branches (default summary + analysis); `stream: true` returns NDJSON,
+    one line per branch as soon as it finishes, then the aggregate.
+    """
+    thread_url = body.get("thread_url")
+    if not thread_url:
+        raise HTTPException(status_code=400, detail="thread_url is required")
+    outputs = body.get("outputs") or ["summary", "analysis"]
+    unknown = [o for o in outputs if o not in INSIGHT_OUTPUTS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown outputs: {', '.join(unknown)}")
+    outputs = [o for o in INSIGHT_OUTPUTS if o in outputs]
+    set_request_deadline(body.get("timeout"), override=True)
+    stages = build_insight_stages(thread_url, body, outputs)
+    if not body.get("stream"):
+        results, timings = await run_dag(stages, ["aggregate"])
+        return {**results["aggregate"], "timings": timings}
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_result(name: str, value: Any):
+        if name in outputs:
+            await queue.put({"stage": name, "result": value})
+
+    async def stream():
+        task = asyncio.create_task(run_dag(stages, ["aggregate"], on_result=on_result))
+        task.add_done_callback(lambda t: queue.put_nowait(None))
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                yield json.dumps(item) + "\n"
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                yield json.dumps({"stage": "error", "detail": str(task.exception())}) + "\n"
+                return
+            results, timings = task.result()
+            yield json.dumps({"stage": "aggregate", "result": {**results["aggregate"], "timings": timings}}) + "\n"
+        finally:
+            task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/api/timeline")
+async def get_sentiment_timeline(post_id: str = "", thread_url: str = "", window: float = 3600.0,
+                                 rolling: int = 3, max_points: int = 200):
+    """Sentiment, volume and toxicity per time window for a corpus post or a live thread.
+    Each comment is scored once per thread; repeat calls only score comments that are new.
+    """
+    if bool(post_id) == bool(thread_url):
+        raise HTTPException(status_code=400, detail="Pass exactly one of post_id or thread_url")
+    options = (max(1.0, window), max(1, rolling), max(1, min(max_points, 2000)))
+    try:
+        if post_id:
+            size = await asyncio.to_thread(corpus_post_size, post_id)
+            tree = await run_parse_job(size, get_comment_tree, post_id, allow_process=False)
+            if tree is None:
+                raise HTTPException(status_code=404, detail="Post not found")
+            result = await asyncio.to_thread(
+                update_timeline, f"post:{post_id}", tree["ids"], tree["created_utc"], tree["score"],
+                lambda i: comment_body(tree, i), *options
+            )
+        else:
+            # The timeline is kept per thread, so a failed fetch must not bucket mock comments into it
+            records = await fetch_reddit_comment_records(thread_url, include_replies=True, limit=SAMPLING_MAX_COMMENTS, strict=True)
+            result = await asyncio.to_thread(
+                update_timeline, f"url:{thread_key(thread_url)}", [r["id"] for r in records],
+                np.asarray([r.get("created_utc") or 0.0 for r in records], dtype=np.float64),
+                np.asarray([r.get("score") or 0 for r in records], dtype=np.float64),
+                lambda i: records[i]["body"], *options
+            )
+        return {"post_id": post_id or None, "thread_url": thread_url or None, **result}
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Reddit data not found")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error building timeline: {str(e)}")
+
 @app.get("/api/stats")
 async def get_stats():
     return {
@@ -768,62 +4286,115 @@ async def get_stats():
         "last_24h": 156
     }
 
+def moderation_fetch_options(body: Dict[str, Any]) -> Dict[str, Any]:
+    # Sampling needs the full reply tree; otherwise moderate top-level comments as before
+    if body.get("sampling"):
+        return {"include_replies": True, "limit": SAMPLING_MAX_COMMENTS}
+    return {}
+
+async def run_moderation(thread_url: str, records: List[Dict[str, Any]], body: Dict[str, Any], client=None) -> Dict[str, Any]:
+    """Moderate already-fetched comment records (shared by /api/moderate and /api/insights)."""
+    # "cascade": false sends every comment to the agent; an object overrides the thresholds
+    cascade_option = body.get("cascade", CASCADE_ENABLED)
+    cascade = None
+    if cascade_option:
+        cascade = cascade_thresholds(cascade_option if isinstance(cascade_option, dict) else None)
+    # "sampling": true (or an options object) estimates verdict counts from a stratified sample
+    sampling_option = body.get("sampling")
+    # "ensemble": true (or {"agents": [...]}) also asks the general agent (and any extras) concurrently
+    ensemble_option = body.get("ensemble")
+    client = client or get_letta_client()
+    detected_subreddit = extract_subreddit_from_url(thread_url)
+    agent_subreddit, agent_id = get_agent_for_subreddit(detected_subreddit)
+    comments = [r["body"] for r in records]
+    thread_text = f"Reddit Thread: {thread_url}\n\nComments:\n" + "\n\n".join(comments[:50])
+    shared_memory = await create_or_get_shared_memory(client)
+    ensemble = None
+    agents = ensemble_agents(agent_subreddit, ensemble_option) if ensemble_option else []
+    if len(agents) > 1:
+        ensemble = await moderate_with_ensemble(client, agents, thread_text)
+        moderation_results = ensemble.pop("decisions")
+        # Decisions arrive in completion order; the routed agent's answer leads when it has one
+        result = next(
+            (d for d in moderation_results if d.get("subreddit") == agent_subreddit and d.get("decision") != "SKIPPED"),
+            moderation_results[0]
+        )
+    else:
+        result = await moderate_with_agent(client, agent_id, thread_text, agent_subreddit)
+        moderation_results = [result]
+    try:
+        await asyncio.to_thread(
+            client.blocks.modify,
+            block_id=shared_memory.id,
+            value=json.dumps(moderation_results)
+        )
+    except Exception as e:
+        print(f"Warning: Could not update shared memory: {e}")
+    final_decision = await aggregate_moderation_verdicts(moderation_results, len(comments))
+    sampling = None
+    try:
+        if LETTA_API_KEY and sampling_option:
+            estimate = await asyncio.to_thread(
+                estimate_verdicts_by_sampling, client, agent_id, records,
+                sampling_option if isinstance(sampling_option, dict) else {},
+                cascade=cascade, seed=thread_url
+            )
+            comment_classifications = estimate["classifications"]
+            sampling = {**estimate["sampling"], "verdict_intervals": estimate["verdict_intervals"]}
+        elif LETTA_API_KEY:
+            comment_classifications = await asyncio.to_thread(
+                classify_comments_with_letta, client, agent_id, comments, max_items=50, cascade=cascade
+            )
+        else:
+            raise RuntimeError("Letta unavailable")
+    except Exception:
+        comment_classifications = assign_labels_by_counts(
+            comments,
+            final_decision.get("verdict_breakdown", {}),
+            seed_basis=str(result.get("reason", "")) + str(len(comments)),
+            base_reason=str(result.get("reason", ""))
+        )
+    if sampling is not None:
+        recomputed_counts = estimate["verdict_breakdown"]
+        final_decision["verdict_intervals"] = estimate["verdict_intervals"]
+    else:
+        recomputed_counts = compute_counts_from_classifications(comment_classifications)
+    final_decision["verdict_breakdown"] = recomputed_counts
+    try:
+        new_thread_summary = {
+            "topic": extract_topic_from_url(thread_url),
+            "rule_hits": int(recomputed_counts.get("VIOLATION", 0)) + int(recomputed_counts.get("NEEDS_WARNING", 0))
+        }
+        await asyncio.to_thread(update_subreddit_summary, client, agent_subreddit, new_thread_summary)
+    except Exception:
+        pass
+    return {
+        "thread_url": thread_url,
+        "detected_subreddit": detected_subreddit,
+        "agent_used": agent_subreddit,
+        "comment_count": len(comments),
+        "agent_decisions": moderation_results,
+        "final_decision": final_decision,
+        "shared_memory_id": shared_memory.id,
+        "comment_classifications": comment_classifications,
+        "verdict_cache": verdict_cache_stats().get(agent_id, {}),
+        "classification_stages": count_stages(comment_classifications),
+        "sampling": sampling,
+        "ensemble": ensemble
+    }
+
 @app.post("/api/moderate")
 async def moderate_content(body: Dict[str, Any] = Body(...)):
     thread_url = body.get("thread_url")
     if not thread_url:
         raise HTTPException(status_code=400, detail="thread_url is required")
+    set_request_deadline(body.get("timeout"), override=True)
     try:
         client = get_letta_client()
-        detected_subreddit = extract_subreddit_from_url(thread_url)
-        agent_subreddit, agent_id = get_agent_for_subreddit(detected_subreddit)
-        comments = await fetch_reddit_comments(thread_url)
-        if not comments:
+        records = await fetch_reddit_comment_records(thread_url, **moderation_fetch_options(body))
+        if not records:
             raise HTTPException(status_code=400, detail="No comments found or thread unavailable")
-        thread_text = f"Reddit Thread: {thread_url}\n\nComments:\n" + "\n\n".join(comments[:50])
-        shared_memory = await create_or_get_shared_memory(client)
-        result = await moderate_with_agent(client, agent_id, thread_text, agent_subreddit)
-        moderation_results = [result]
-        try:
-            client.blocks.modify(
-                block_id=shared_memory.id,
-                value=json.dumps(moderation_results)
-            )
-        except Exception as e:
-            print(f"Warning: Could not update shared memory: {e}")
-        final_decision = await aggregate_moderation_verdicts(moderation_results, len(comments))
-        try:
-            if LETTA_API_KEY:
-                comment_classifications = classify_comments_with_letta(client, agent_id, comments, max_items=50)
-            else:
-                raise RuntimeError("Letta unavailable")
-        except Exception:
-            comment_classifications = assign_labels_by_counts(
-                comments,
-                final_decision.get("verdict_breakdown", {}),
-                seed_basis=str(result.get("reason", "")) + str(len(comments)),
-                base_reason=str(result.get("reason", ""))
-            )
-        recomputed_counts = compute_counts_from_classifications(comment_classifications)
-        final_decision["verdict_breakdown"] = recomputed_counts
-        try:
-            new_thread_summary = {
-                "topic": extract_topic_from_url(thread_url),
-                "rule_hits": int(recomputed_counts.get("VIOLATION", 0)) + int(recomputed_counts.get("NEEDS_WARNING", 0))
-            }
-            update_subreddit_summary(client, agent_subreddit, new_thread_summary)
-        except Exception:
-            pass
-        return {
-            "thread_url": thread_url,
-            "detected_subreddit": detected_subreddit,
-            "agent_used": agent_subreddit,
-            "comment_count": len(comments),
-            "agent_decisions": moderation_results,
-            "final_decision": final_decision,
-            "shared_memory_id": shared_memory.id,
-            "comment_classifications": comment_classifications
-        }
+        return await run_moderation(thread_url, records, body, client=client)
     except HTTPException:
         raise
     except Exception as e:
@@ -846,7 +4417,9 @@ async def moderation_health():
             "agents_available": True,
             "agent_count": len(LETTA_AGENTS),
             "shared_memory_id": shared_memory.id,
-            "agents": list(LETTA_AGENTS.keys())
+            "agents": list(LETTA_AGENTS.keys()),
+            "verdict_cache": verdict_cache_stats(),
+            "agent_context": letta_context_stats()
         }
     except Exception as e:
         return {
@@ -867,18 +4440,15 @@ async def get_subreddit_summary(name: str):
 
     overview_text = ""
 
-    # Try Letta block + have agent narrate from memory
+    # Serve the cached narration; refresh it off the request path when stale
     try:
         if LETTA_API_KEY:
-            client = get_letta_client()
-            block_id = subreddit_summaries[key]
-            block = client.blocks.retrieve(block_id)
-            raw = getattr(block, 'value', None)
-            data = json.loads(raw) if raw else {}
-            if isinstance(data, dict):
-                # Prefer an agent-composed description; fallback to stored overview text
-                agent_view = await describe_subreddit_from_memory(client, key, data)
-                overview_text = agent_view.strip() or str(data.get("overview", "")).strip()
+            entry = subreddit_overview_cache.get(key)
+            if entry is None:
+                entry = await schedule_subreddit_overview_refresh(key)
+            elif subreddit_overview_stale(entry):
+                schedule_subreddit_overview_refresh(key)
+            overview_text = entry["overview"]
     except Exception:
         pass
 
@@ -906,40 +4476,18 @@ async def get_subreddit_posts(name: str):
     if key not in allowed:
         raise HTTPException(status_code=404, detail="Subreddit not supported in this MVP")
     
-    # Load the scraped Reddit comments JSON
+    # Read post headers for this subreddit straight from the memory-mapped corpus
     try:
-        json_path = os.path.join(os.path.dirname(__file__), 'reddit_comments.json')
-        with open(json_path, 'r', encoding='utf-8') as f:
-            all_posts = json.load(f)
-        
-        # Filter posts by subreddit
-        subreddit_posts = [
-            post for post in all_posts 
-            if post.get('post', {}).get('subreddit', '').lower() == key
-        ]
-        
-        # Transform to frontend format
         transformed_posts = []
-        for item in subreddit_posts:
+        for entry, item in await asyncio.to_thread(get_corpus_subreddit_posts, key):
             post = item.get('post', {})
-            comments = item.get('comments', [])
-            
-            # Count total comments including replies
-            def count_comments(comment_list):
-                total = len(comment_list)
-                for comment in comment_list:
-                    total += count_comments(comment.get('replies', []))
-                return total
-            
-            total_comments = count_comments(comments)
-            
             transformed_posts.append({
                 'id': post.get('id'),
                 'title': post.get('title'),
                 'author': post.get('author'),
                 'score': post.get('score'),
                 'created_utc': post.get('created_utc'),
-                'num_comments': total_comments,
+                'num_comments': entry['comment_count'],
                 'url': item.get('url'),
                 'selftext': post.get('selftext', ''),
                 'subreddit': post.get('subreddit')
@@ -955,26 +4503,60 @@ async def get_subreddit_posts(name: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading posts: {str(e)}")
 
+@app.get("/api/search")
+async def search(q: str, subreddit: str = "", type: str = "all", since: Optional[float] = None,
+                 until: Optional[float] = None, min_score: Optional[int] = None, limit: int = 20, offset: int = 0):
+    """BM25 search over post titles/selftext and comment bodies, with filters and highlighted snippets.
+    `type` is "all", "post" or "comment"; `since`/`until` are unix timestamps.
+    """
+    if not search_tokens(q):
+        raise HTTPException(status_code=400, detail="Query has no searchable terms")
+    if type not in ("all", "post", "comment"):
+        raise HTTPException(status_code=400, detail="type must be one of: all, post, comment")
+    try:
+        return await asyncio.to_thread(
+            search_corpus, q, subreddit=subreddit, kind=type, since=since, until=until,
+            min_score=min_score, limit=max(1, min(limit, 100)), offset=max(0, offset)
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Reddit data not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
+@app.post("/api/corpus/posts")
+async def ingest_corpus_post(body: Dict[str, Any] = Body(...), x_admin_token: str = Header("")):
+    """Append a scraped post ({"url", "post", "comments"}) to the corpus without rewriting it.
+    Requires CORPUS_ADMIN_TOKEN in the X-Admin-Token header.
+    """
+    token = x_admin_token.encode("utf-8")
+    if not CORPUS_ADMIN_TOKEN or not hmac.compare_digest(token, CORPUS_ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Corpus ingestion needs a valid X-Admin-Token")
+    post = body.get("post")
+    if not isinstance(post, dict) or not post.get("id") or not post.get("subreddit"):
+        raise HTTPException(status_code=400, detail="post.id and post.subreddit are required")
+    if not isinstance(body.get("comments", []), list):
+        raise HTTPException(status_code=400, detail="comments must be a list")
+    item = {"url": body.get("url"), "post": post, "comments": body.get("comments", [])}
+    entry = await asyncio.to_thread(append_corpus_post, item)
+    return {"id": entry["id"], "subreddit": entry["subreddit"], "comment_count": entry["comment_count"]}
+
 @app.get("/api/post/{post_id}")
-async def get_post_with_comments(post_id: str):
-    """Return a single post with all its comments (with hierarchical structure)."""
+async def get_post_with_comments(post_id: str, offset: int = 0, limit: Optional[int] = None):
+    """Return a single post with all its comments (with hierarchical structure).
+    `offset`/`limit` page through top-level comments; only that window is rendered.
+    """
     try:
-        json_path = os.path.join(os.path.dirname(__file__), 'reddit_comments.json')
-        with open(json_path, 'r', encoding='utf-8') as f:
-            all_posts = json.load(f)
-        
-        # Find the post by ID
-        post_data = None
-        for item in all_posts:
-            if item.get('post', {}).get('id') == post_id:
-                post_data = item
-                break
+        # Only this post's bytes are read from the memory-mapped corpus
+        post_data = await asyncio.to_thread(get_corpus_post, post_id, False)
         
         if not post_data:
             raise HTTPException(status_code=404, detail="Post not found")
         
         post = post_data.get('post', {})
-        comments = post_data.get('comments', [])
+        # Parsing a large post into its comment tree happens off the event loop
+        size = await asyncio.to_thread(corpus_post_size, post_id)
+        tree = await run_parse_job(size, get_comment_tree, post_id, allow_process=False)
+        comments = render_comment_tree(tree, offset=max(0, offset), limit=limit)
         
         return {
             'post': {
@@ -996,3 +4578,35 @@ async def get_post_with_comments(post_id: str):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading post: {str(e)}")
+
+@app.get("/api/post/{post_id}/related")
+async def get_related_threads(post_id: str, k: int = 10, subreddit: str = ""):
+    """Nearest corpus threads by topic (TF-IDF) and engagement/sentiment profile."""
+    try:
+        result = await asyncio.to_thread(related_threads, post_id, max(1, min(k, 100)), subreddit)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Reddit data not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error finding related threads: {str(e)}")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    return result
+
+@app.get("/api/post/{post_id}/tree-stats")
+async def get_post_tree_stats(post_id: str, top: int = 10, bucket_seconds: float = 3600.0):
+    """Subtree sizes, depth histogram, top comments by score and time-bucket counts for a post."""
+    try:
+        size = await asyncio.to_thread(corpus_post_size, post_id)
+        tree = await run_parse_job(size, get_comment_tree, post_id, allow_process=False)
+        if tree is None:
+            raise HTTPException(status_code=404, detail="Post not found")
+        stats = comment_tree_stats(tree, top_n=max(1, top), bucket_seconds=max(1.0, bucket_seconds))
+        return {"post_id": post_id, **stats}
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Reddit data not found")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error loading post: {str(e)}")
+
+serving_state["import_seconds"] = round(time.perf_counter() - MODULE_LOAD_STARTED, 4)
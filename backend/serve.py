@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Pre-fork production server for the Reddit:AI backend (POSIX only).
+
+    python backend/serve.py --workers 4 --port 8000
+
+The parent imports the app once, maps the corpus, builds the search / related-thread / routing
+indexes and freezes the heap for the garbage collector, then forks uvicorn workers that share
+one listening socket. Workers inherit the warmed state copy-on-write instead of each paying the
+warm-up, and dead workers are restarted (with exponential backoff when they keep dying right
+after start-up, so a broken deploy doesn't turn into a fork storm). Live-thread watches are
+coordinated across workers through a shared directory; see the README for the state that is
+still per worker. Cold-start timings and per-worker memory are printed
+here and served from /health/runtime.
+"""
+
+import argparse
+import gc
+import os
+import signal
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import_started = time.perf_counter()
+import uvicorn  # noqa: E402
+import main  # noqa: E402
+import_seconds = time.perf_counter() - import_started
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the backend with preloaded, forked workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    parser.add_argument("--report-after", type=float, default=5.0,
+                        help="seconds after startup to print per-worker memory (0 disables)")
+    parser.add_argument("--min-uptime", type=float, default=10.0,
+                        help="a worker that dies sooner than this counts as a crash loop and is restarted with backoff")
+    parser.add_argument("--max-backoff", type=float, default=60.0,
+                        help="longest delay, in seconds, before restarting a crash-looping worker")
+    return parser.parse_args()
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(index: int, sock: socket.socket, args):
+    # Drop the parent's handlers; uvicorn installs its own for graceful shutdown
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    main.mark_worker(index)
+    config = uvicorn.Config(main.app, log_level=args.log_level, timeout_keep_alive=5)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def report_memory(workers):
+    parent = main.process_memory()
+    print(f"[serve] parent pid={os.getpid()} {parent}", flush=True)
+    for pid, index in sorted(workers.items(), key=lambda item: item[1]):
+        print(f"[serve] worker {index} pid={pid} {main.process_memory(pid)}", flush=True)
+
+
+def serve():
+    args = parse_args()
+    main.serving_state["role"] = "parent"
+    main.preload_shared_state()
+    # Keep the collector from touching (and so un-sharing) everything allocated so far
+    gc.collect()
+    gc.freeze()
+    sock = bind_socket(args.host, args.port)
+    # Workers take turns polling each watched thread and share the result through this directory
+    watch_dir = None
+    if not main.watch_shared["dir"]:
+        watch_dir = tempfile.mkdtemp(prefix="reddit-ai-watch-")
+        main.watch_shared["dir"] = watch_dir
+
+    workers = {}
+    started_at = {}
+    failures = {}
+    respawn_at = {}
+    state = {"stopping": False}
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(index, sock, args)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = index
+        started_at[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        state["stopping"] = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    fork_started = time.perf_counter()
+    for index in range(max(1, args.workers)):
+        spawn(index)
+    steps = ", ".join(f"{name} {value}s" if isinstance(value, float) else f"{name} {value}"
+                      for name, value in main.serving_state["preload_steps"].items())
+    print(
+        f"[serve] import {import_seconds:.3f}s, preload {main.serving_state['preload_seconds']}s ({steps}), "
+        f"forked {len(workers)} workers in {time.perf_counter() - fork_started:.3f}s "
+        f"on {args.host}:{args.port}",
+        flush=True,
+    )
+
+    report_at = time.monotonic() + args.report_after if args.report_after > 0 else None
+    while workers or (respawn_at and not state["stopping"]):
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid == 0:
+            now = time.monotonic()
+            if report_at is not None and now >= report_at:
+                report_at = None
+                report_memory(workers)
+            for index, due in list(respawn_at.items()):
+                if state["stopping"]:
+                    respawn_at.clear()
+                elif now >= due:
+                    del respawn_at[index]
+                    spawn(index)
+            time.sleep(0.5)
+            continue
+        index = workers.pop(pid, None)
+        uptime = time.monotonic() - started_at.pop(pid, time.monotonic())
+        if index is not None and not state["stopping"]:
+            # Crash loops back off exponentially; a worker that ran for a while restarts at once
+            failures[index] = failures.get(index, 0) + 1 if uptime < args.min_uptime else 0
+            delay = min(args.max_backoff, 2.0 ** (failures[index] - 1)) if failures[index] else 0.0
+            print(f"[serve] worker {index} (pid {pid}) exited with status {status} after {uptime:.1f}s; "
+                  f"restarting in {delay:.0f}s", flush=True)
+            respawn_at[index] = time.monotonic() + delay
+    sock.close()
+    if watch_dir:
+        shutil.rmtree(watch_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    serve()
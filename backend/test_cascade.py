@@ -0,0 +1,41 @@
+import pytest
+
+import main
+
+ABUSIVE = [
+    "fuck you retard",
+    "I think all immigrants are vermin and should be shot",
+    "interesting, now go die in a fire you subhuman",
+    "lol kys",
+    "retard",
+]
+
+
+@pytest.fixture
+def agent(request):
+    agent_id = f"test-{request.node.name}"
+    yield agent_id
+    main.cascade_models.pop(agent_id, None)
+
+
+def test_cascade_is_opt_in():
+    assert main.CASCADE_ENABLED is False
+
+
+@pytest.mark.parametrize("text", ABUSIVE)
+def test_abusive_short_comments_are_never_labeled_fine(agent, text):
+    thresholds = main.cascade_thresholds()
+    local = main.cascade_label(agent, text, thresholds)
+    assert local is None or local["label"] != "FINE"
+    # Even a permissive threshold can't turn a risk term into FINE
+    local = main.cascade_label(agent, text, {"fine_below": 0.99, "violation_above": 1.0})
+    assert local is None
+
+
+def test_fine_needs_benign_evidence_until_the_model_is_fitted(agent):
+    thresholds = {"fine_below": 0.5, "violation_above": 0.99}
+    assert main.cascade_label(agent, "ok", thresholds) is None
+    assert main.cascade_label(agent, "Thanks, well said", thresholds)["label"] == "FINE"
+    main.get_cascade_model(agent)["trained"] = main.CASCADE_MIN_LABELS
+    assert main.cascade_label(agent, "ok", thresholds)["label"] == "FINE"
+    assert main.cascade_label(agent, "fuck you retard", thresholds) is None
@@ -0,0 +1,52 @@
+import itertools
+
+import main
+
+
+def comment(cid, parent, depth, score=1, created=0.0, replies=()):
+    return {"id": cid, "author": f"u{cid}", "body": f"body {cid}", "score": score, "created_utc": created,
+            "parent_id": parent, "depth": depth, "replies": list(replies)}
+
+
+def test_rendering_matches_the_stored_nested_comments():
+    for item in itertools.islice(main.iter_corpus_posts(), 10):
+        comments = item.get("comments", [])
+        tree = main.build_comment_tree(item["post"]["id"], comments)
+        assert main.render_comment_tree(tree) == comments
+        assert main.comment_tree_stats(tree)["total_comments"] == main.count_comment_tree(comments)
+
+
+def test_paging_renders_a_window_of_top_level_comments():
+    comments = [comment(f"r{i}", "t3_p", 0, replies=[comment(f"r{i}x", f"t1_r{i}", 1)]) for i in range(5)]
+    tree = main.build_comment_tree("p", comments)
+    assert main.render_comment_tree(tree, offset=1, limit=2) == comments[1:3]
+
+
+def test_orphans_keep_their_stored_parent_and_depth():
+    # A reply whose parent was deleted is stored at top level but still points at the missing comment
+    comments = [
+        comment("a", "t3_p", 0, replies=[comment("b", "t1_a", 1)]),
+        comment("orphan", "t1_gone", 2, score=9, replies=[comment("c", "t1_orphan", 3)]),
+    ]
+    tree = main.build_comment_tree("p", comments)
+    assert main.render_comment_tree(tree) == comments
+    # Stats use the position in the tree: the orphan is a root of a two-comment thread
+    stats = main.comment_tree_stats(tree)
+    assert stats["depth_histogram"] == [2, 2]
+    assert stats["largest_threads"] == [{"id": "a", "size": 2}, {"id": "orphan", "size": 2}]
+    assert stats["top_comments"][0]["id"] == "orphan"
+
+
+def test_missing_parent_and_depth_are_filled_in_from_the_tree():
+    comments = [{"id": "a", "body": "x", "replies": [{"id": "b", "body": "y", "replies": []}]}]
+    rendered = main.render_comment_tree(main.build_comment_tree("p", comments))
+    assert rendered[0]["parent_id"] == "t3_p" and rendered[0]["depth"] == 0
+    reply = rendered[0]["replies"][0]
+    assert reply["parent_id"] == "t1_a" and reply["depth"] == 1
+    assert reply["author"] == "" and reply["score"] == 0
+
+
+def test_empty_tree():
+    tree = main.build_comment_tree("p", [])
+    assert main.render_comment_tree(tree) == []
+    assert main.comment_tree_stats(tree)["total_comments"] == 0
@@ -0,0 +1,39 @@
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def test_similarity_is_anchored_on_the_first_listed_post():
+    main.ensure_related_index()
+    anchor = next(t for t in main.related_state["threads"] if t["subreddit"] == "askhistorians")
+    r = client.post("/api/compare", json={
+        "local": True, "rank_by": "similarity", "subreddit": "worldnews", "post_ids": [anchor["post_id"]],
+    })
+    assert r.status_code == 200
+    ranked = r.json()["threads"]
+    assert len(ranked) == 4
+    assert ranked[0]["post_id"] == anchor["post_id"]
+    assert abs(ranked[0]["rank_value"] - 1.0) < 1e-3
+
+
+def test_unknown_post_is_a_404():
+    r = client.post("/api/compare", json={"local": True, "post_ids": ["nope", "nope2"]})
+    assert r.status_code == 404
+
+
+def test_external_threads_that_fail_to_fetch_are_not_ranked(monkeypatch):
+    async def refused(url, **options):
+        assert options.get("strict")
+        raise main.RedditFetchError("Reddit returned HTTP 429")
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", refused)
+    r = client.post("/api/compare", json={
+        "local": True, "subreddit": "worldnews", "thread_urls": ["https://www.reddit.com/r/x/comments/zzfail1/t/"],
+    })
+    assert r.status_code == 200
+    body = r.json()
+    assert body["failed"] == 1 and body["timed_out"] == 0
+    assert all(t.get("url") != "https://www.reddit.com/r/x/comments/zzfail1/t/" for t in body["threads"])
+    assert all(not str(t.get("post_id", "")).startswith("mock") for t in body["threads"])
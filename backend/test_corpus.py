@@ -0,0 +1,93 @@
+import os
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+ADMIN = {"X-Admin-Token": "secret"}
+
+
+@pytest.fixture(autouse=True)
+def admin_token(monkeypatch):
+    monkeypatch.setattr(main, "CORPUS_ADMIN_TOKEN", "secret")
+
+
+def test_ingested_post_is_readable_without_rewriting_the_corpus():
+    main.open_corpus()
+    size_before = main.corpus_state["end"]
+    subreddit = next(iter(main.subreddit_summaries))
+    item = {
+        "url": "https://www.reddit.com/r/test/comments/ingest1/",
+        "post": {"id": "ingest1", "subreddit": subreddit, "title": "Ingested"},
+        "comments": [{"id": "k1", "body": "first", "replies": [{"id": "k2", "body": "reply", "replies": []}]}],
+    }
+    r = client.post("/api/corpus/posts", json=item, headers=ADMIN)
+    assert r.status_code == 200 and r.json()["comment_count"] == 2
+    assert main.corpus_state["end"] > size_before
+
+    post = client.get("/api/post/ingest1").json()
+    assert post["post"]["title"] == "Ingested"
+    listed = [p["id"] for p in client.get(f"/api/subreddit/{subreddit}/posts").json()["posts"]]
+    assert listed.count("ingest1") == 1
+
+    # A re-scrape shadows the earlier record without listing the post twice
+    item["post"]["title"] = "Updated"
+    client.post("/api/corpus/posts", json=item, headers=ADMIN)
+    assert client.get("/api/post/ingest1").json()["post"]["title"] == "Updated"
+    listed = [p["id"] for p in client.get(f"/api/subreddit/{subreddit}/posts").json()["posts"]]
+    assert listed.count("ingest1") == 1
+
+
+def test_ingest_requires_a_post_id():
+    assert client.post("/api/corpus/posts", json={"post": {"subreddit": "x"}}, headers=ADMIN).status_code == 400
+
+
+def test_ingest_requires_the_admin_token(monkeypatch):
+    item = {"post": {"id": "noauth", "subreddit": "x"}}
+    assert client.post("/api/corpus/posts", json=item).status_code == 403
+    assert client.post("/api/corpus/posts", json=item, headers={"X-Admin-Token": "wrong"}).status_code == 403
+    monkeypatch.setattr(main, "CORPUS_ADMIN_TOKEN", "")
+    assert client.post("/api/corpus/posts", json=item, headers={"X-Admin-Token": ""}).status_code == 403
+    assert "noauth" not in main.corpus_state["by_id"]
+
+
+def test_posts_appended_by_another_worker_are_picked_up():
+    main.open_corpus()
+    subreddit = next(iter(main.subreddit_summaries))
+    # Another worker appends straight to the shared files
+    other = {"url": None, "post": {"id": "otherworker", "subreddit": subreddit, "title": "From elsewhere"}, "comments": []}
+    with open(main.CORPUS_PATH, "ab") as data_file, open(main.CORPUS_INDEX_PATH, "ab") as index_file:
+        main.write_corpus_record(data_file, index_file, other, data_file.seek(0, os.SEEK_END))
+    mine = {"url": None, "post": {"id": "thisworker", "subreddit": subreddit, "title": "From here"}, "comments": []}
+    assert client.post("/api/corpus/posts", json=mine, headers=ADMIN).status_code == 200
+
+    assert client.get("/api/post/otherworker").json()["post"]["title"] == "From elsewhere"
+    assert client.get("/api/post/thisworker").json()["post"]["title"] == "From here"
+    entries = sorted(main.corpus_state["by_id"].values(), key=lambda e: e["offset"])
+    assert [e["id"] for e in entries[-2:]] == ["otherworker", "thisworker"]
+    assert entries[-1]["offset"] == entries[-2]["offset"] + entries[-2]["length"] + 1
+
+
+def test_concurrent_first_use_converts_once(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "CORPUS_PATH", str(tmp_path / "corpus.jsonl"))
+    monkeypatch.setattr(main, "CORPUS_INDEX_PATH", str(tmp_path / "corpus.jsonl.idx"))
+    errors = []
+
+    def convert():
+        try:
+            main.ensure_corpus_files()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=convert) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(os.listdir(tmp_path)) == ["corpus.jsonl", "corpus.jsonl.idx", "corpus.jsonl.lock"]
+    with open(main.CORPUS_INDEX_PATH, "rb") as f:
+        assert len(f.read().splitlines()) > 0
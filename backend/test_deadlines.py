@@ -0,0 +1,38 @@
+import contextvars
+
+import main
+
+
+def in_fresh_context(fn):
+    return contextvars.copy_context().run(fn)
+
+
+def test_client_timeout_replaces_the_endpoint_default():
+    def scenario():
+        main.request_deadline.set(None)
+        main.set_request_deadline(60)
+        main.set_request_deadline(300, override=True)
+        return main.time_left()
+
+    assert 290 < in_fresh_context(scenario) <= 300
+
+
+def test_client_timeout_is_clamped_to_the_maximum():
+    def scenario():
+        main.request_deadline.set(None)
+        main.set_request_deadline(60)
+        main.set_request_deadline(main.REQUEST_DEADLINE_MAX * 10, override=True)
+        return main.time_left()
+
+    assert in_fresh_context(scenario) <= main.REQUEST_DEADLINE_MAX
+
+
+def test_server_defaults_only_tighten():
+    def scenario():
+        main.request_deadline.set(None)
+        main.set_request_deadline(60)
+        main.set_request_deadline(300)
+        main.set_request_deadline("not a number", override=True)
+        return main.time_left()
+
+    assert in_fresh_context(scenario) <= 60
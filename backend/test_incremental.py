@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+import main
+
+
+def records(n):
+    return [{"id": f"c{i}", "body": f"comment {i}", "score": 1, "created_utc": float(i)} for i in range(n)]
+
+
+def test_unparseable_delta_leaves_comments_for_the_next_call(monkeypatch):
+    replies = iter(["not json", json.dumps({"sentiment_score": 0.5, "top_keywords": ["x"]})])
+
+    async def fake_fetch(url, sort="", strict=False):
+        return records(3)
+
+    async def fake_chat(messages, max_tokens=250):
+        return next(replies)
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", fake_fetch)
+    monkeypatch.setattr(main, "claude_chat", fake_chat)
+    state = main.get_thread_state(main.thread_analysis_states, "https://reddit.com/r/x/comments/retry/t/")
+
+    first = asyncio.run(main.analyze_new_comments(state, "https://reddit.com/r/x/comments/retry/t/"))
+    assert first["new_count"] == 0 and first["retry_pending"] == 3
+    assert state["count"] == 0 and not state["seen_ids"]
+
+    second = asyncio.run(main.analyze_new_comments(state, "https://reddit.com/r/x/comments/retry/t/"))
+    assert second["new_count"] == 3 and second["count"] == 3
+    assert second["analysis"]["sentiment_score"] == 0.5
+
+
+def test_failed_fetch_leaves_the_state_unchanged(monkeypatch):
+    async def refused(url, sort="", strict=False):
+        assert strict
+        raise main.RedditFetchError("Reddit returned HTTP 429")
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", refused)
+    url = "https://reddit.com/r/x/comments/refused/t/"
+    state = main.get_thread_state(main.thread_analysis_states, url)
+    state.update({"analysis": {"sentiment_score": 0.2}, "count": 4, "seen_ids": {"a", "b", "c", "d"}})
+    try:
+        asyncio.run(main.analyze_new_comments(state, url))
+    except main.RedditFetchError:
+        pass
+    assert state["count"] == 4 and state["seen_ids"] == {"a", "b", "c", "d"}
+    assert state["analysis"] == {"sentiment_score": 0.2}
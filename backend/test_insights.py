@@ -0,0 +1,50 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import main
+from test_moderation import FakeBlocks, fake_send
+
+CLAUDE_DELAY = 0.3
+
+
+def test_summary_and_moderation_branches_overlap(monkeypatch):
+    records = [{"id": f"c{i}", "body": f"distinct comment number {i}"} for i in range(40)]
+
+    async def fake_fetch(url, **options):
+        return records
+
+    async def fake_chat(messages, max_tokens=250):
+        await asyncio.sleep(CLAUDE_DELAY)
+        return json.dumps({"sentiment_overall": "neutral"})
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", fake_fetch)
+    monkeypatch.setattr(main, "claude_chat", fake_chat)
+    monkeypatch.setattr(main, "LETTA_API_KEY", "test")
+    monkeypatch.setattr(main, "letta_send", fake_send)
+    monkeypatch.setattr(main, "get_letta_client", lambda: SimpleNamespace(blocks=FakeBlocks()))
+    monkeypatch.setattr(main, "get_classifier_agent", lambda client, agent_id: "classifier")
+    monkeypatch.setattr(main, "lookup_verdict", lambda agent_id, text: None)
+    monkeypatch.setattr(main, "store_verdict", lambda *args: None)
+
+    url = "https://www.reddit.com/r/worldnews/comments/abc/t/"
+    body = {"thread_url": url, "cascade": False}
+    stages = main.build_insight_stages(url, body, ["summary", "moderation"])
+
+    async def scenario():
+        finished = {}
+        started = time.perf_counter()
+
+        async def on_result(name, value):
+            finished[name] = time.perf_counter() - started
+
+        results, timings = await main.run_dag(stages, ["aggregate"], on_result=on_result)
+        return results, timings, finished
+
+    results, timings, finished = asyncio.run(scenario())
+    assert results["aggregate"]["moderation"]["classification_stages"]["agent"] == 40
+    # The summary branch completes while moderation is still running, not after it
+    assert finished["summary"] < finished["moderation"]
+    assert timings["summary"] < CLAUDE_DELAY * 2
+    assert finished["aggregate"] < timings["summary"] + timings["moderation"]
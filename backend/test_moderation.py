@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import main
+
+AGENT_DELAY = 0.05
+
+
+class FakeBlocks:
+    def get_by_label(self, label):
+        time.sleep(AGENT_DELAY)
+        return SimpleNamespace(id="block-shared", value="[]")
+
+    def retrieve(self, block_id):
+        time.sleep(AGENT_DELAY)
+        return SimpleNamespace(id=block_id, value="{}")
+
+    def modify(self, block_id, value=None):
+        time.sleep(AGENT_DELAY)
+
+
+def fake_send(client, agent_id, content):
+    # Blocking like the Letta SDK
+    time.sleep(AGENT_DELAY)
+    reply = json.dumps({"label": "FINE", "reason": "ordinary comment"}) if "single Reddit comment" in content else "FINE confidence: 0.9"
+    return SimpleNamespace(messages=[SimpleNamespace(content=reply)])
+
+
+def test_moderation_keeps_the_event_loop_free(monkeypatch):
+    monkeypatch.setattr(main, "LETTA_API_KEY", "test")
+    monkeypatch.setattr(main, "letta_send", fake_send)
+    monkeypatch.setattr(main, "get_classifier_agent", lambda client, agent_id: "classifier")
+    monkeypatch.setattr(main, "lookup_verdict", lambda agent_id, text: None)
+    monkeypatch.setattr(main, "store_verdict", lambda *args: None)
+    client = SimpleNamespace(blocks=FakeBlocks())
+    records = [{"id": f"c{i}", "body": f"distinct comment number {i}"} for i in range(20)]
+
+    async def scenario():
+        stalls = []
+
+        async def ticker():
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.005)
+                now = time.perf_counter()
+                stalls.append(now - last)
+                last = now
+
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        result = await main.run_moderation("https://www.reddit.com/r/worldnews/comments/abc/t/", records, {"cascade": False}, client=client)
+        elapsed = time.perf_counter() - started
+        # Let the ticker record the gap left by any final blocking call
+        await asyncio.sleep(0.02)
+        tick.cancel()
+        return result, elapsed, max(stalls)
+
+    result, elapsed, worst_stall = asyncio.run(scenario())
+    assert result["classification_stages"]["agent"] == 20
+    assert all(c["label"] == "FINE" for c in result["comment_classifications"])
+    assert worst_stall < AGENT_DELAY
+    # 20 sequential calls would take 1 s on their own
+    assert elapsed < 20 * AGENT_DELAY / 2
+
+
+def test_ensemble_reports_the_routed_agents_rationale(monkeypatch):
+    routed_id = main.LETTA_AGENTS["worldnews"]
+
+    def send(client, agent_id, content):
+        # The general agent answers first; the routed agent is slower
+        time.sleep(0.1 if agent_id == routed_id else 0.01)
+        reason = "routed rationale" if agent_id == routed_id else "general rationale"
+        return SimpleNamespace(messages=[SimpleNamespace(content=f"FINE confidence: 0.9 {reason}")])
+
+    monkeypatch.setattr(main, "LETTA_API_KEY", None)
+    monkeypatch.setattr(main, "letta_send", send)
+    client = SimpleNamespace(blocks=FakeBlocks())
+    records = [{"id": "c1", "body": "a comment"}]
+
+    result = asyncio.run(main.run_moderation("https://www.reddit.com/r/worldnews/comments/abc/t/", records, {"ensemble": True}, client=client))
+    assert result["agent_decisions"][0]["subreddit"] == "general"
+    assert "routed rationale" in result["comment_classifications"][0]["reason"]
+
+
+class FakeAgents:
+    def __init__(self, twins=(), message_ids=()):
+        self.twins = list(twins)
+        self.created = []
+        self.message_ids = list(message_ids)
+
+    def retrieve(self, agent_id):
+        return SimpleNamespace(id=agent_id, name="worldnews-mod", memory=None, message_ids=self.message_ids)
+
+    def list(self, name=None):
+        return [t for t in self.twins if t.name == name]
+
+    def create(self, name, **config):
+        twin = SimpleNamespace(id=f"agent-new-{len(self.created)}", name=name)
+        self.created.append(twin)
+        return twin
+
+    def modify(self, agent_id, message_ids):
+        self.message_ids = message_ids
+
+
+def test_classifier_twins_are_reused_across_processes(monkeypatch):
+    monkeypatch.setattr(main, "letta_classifier_agents", {})
+    agents = FakeAgents(twins=[SimpleNamespace(id="agent-twin", name="worldnews-mod-classifier", created_at="2025-01-01")])
+    assert main.get_classifier_agent(SimpleNamespace(agents=agents), "agent-src") == "agent-twin"
+    assert agents.created == []
+
+
+def test_compaction_keeps_recent_messages(monkeypatch):
+    monkeypatch.setattr(main, "LETTA_KEEP_MESSAGES", 3)
+    agents = FakeAgents(message_ids=[f"m{i}" for i in range(10)])
+    assert main.compact_agent_history(SimpleNamespace(agents=agents), "agent-compact")
+    assert agents.message_ids == ["m0", "m7", "m8", "m9"]
+    main.letta_agent_stats.pop("agent-compact", None)
+
+
+def test_compaction_runs_for_sends_made_on_worker_threads(monkeypatch):
+    monkeypatch.setattr(main, "LETTA_COMPACTION_INTERVAL", 0.02)
+    monkeypatch.setattr(main, "LETTA_MAX_HISTORY_MESSAGES", 6)
+    monkeypatch.setattr(main, "LETTA_KEEP_MESSAGES", 2)
+    monkeypatch.setattr(main, "letta_maintenance", {"task": None, "client": None})
+    agents = FakeAgents(message_ids=[f"m{i}" for i in range(10)])
+    reply = SimpleNamespace(messages=[SimpleNamespace(content="ok")])
+    agents.messages = SimpleNamespace(create=lambda agent_id, messages: reply)
+    client = SimpleNamespace(agents=agents)
+
+    async def scenario():
+        main.ensure_letta_compaction()
+        for _ in range(4):
+            await asyncio.to_thread(main.letta_send, client, "agent-threaded", "hello")
+        for _ in range(50):
+            if main.letta_agent_stats["agent-threaded"]["compactions"]:
+                break
+            await asyncio.sleep(0.02)
+        main.letta_maintenance["task"].cancel()
+
+    try:
+        asyncio.run(scenario())
+        stats = main.letta_agent_stats["agent-threaded"]
+        assert stats["compactions"] == 1
+        assert stats["history_messages"] == 2
+        assert agents.message_ids == ["m0", "m8", "m9"]
+    finally:
+        main.letta_agent_stats.pop("agent-threaded", None)
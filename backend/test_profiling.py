@@ -0,0 +1,40 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def test_non_ascii_profile_token_is_rejected_not_a_500(monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_TOKEN", "secret")
+    r = client.get("/health", params={"profile": "sécret"})
+    assert r.status_code == 200
+    assert "X-Profile-Output" not in r.headers
+
+
+def test_profiled_request_writes_output(monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_TOKEN", "secret")
+    r = client.get("/health", headers={"X-Profile": "secret"})
+    assert r.status_code == 200
+    assert r.headers["X-Profile-Output"]
+
+
+def test_task_factory_is_removed_when_the_last_session_ends():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        first, second = main.RequestProfiler("a"), main.RequestProfiler("b")
+        first.start()
+        second.start()
+        first.detach()
+        still_installed = loop.get_task_factory() is main.profiling_task_factory
+        second.detach()
+        for profiler in (first, second):
+            profiler.stopped.set()
+            profiler.thread.join()
+        return still_installed, loop.get_task_factory()
+
+    still_installed, factory = asyncio.run(scenario())
+    assert still_installed
+    assert factory is None
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import httpx
+
+import main
+
+
+def comment(cid, parent, depth, replies=""):
+    return {"kind": "t1", "data": {"id": cid, "body": f"body {cid}", "parent_id": parent, "depth": depth,
+                                   "created_utc": 1.0, "replies": replies}}
+
+
+def thread_payload():
+    reply_listing = {"data": {"children": [comment("b", "t1_a", 1), {"kind": "more", "data": {"children": ["c"]}}]}}
+    return json.dumps([
+        {"data": {"children": [{"kind": "t3", "data": {"name": "t3_post"}}]}},
+        {"data": {"children": [comment("a", "t3_post", 0, reply_listing), {"kind": "more", "data": {"children": ["d"]}}]}},
+    ]).encode()
+
+
+def test_more_stubs_are_collected_and_expanded():
+    comments, more_ids, link_id = main.extract_comment_records(thread_payload(), include_replies=True, limit=100)
+    assert [c["id"] for c in comments] == ["a", "b"]
+    assert more_ids == ["c", "d"] and link_id == "t3_post"
+
+    def handler(request):
+        assert request.url.params["link_id"] == "t3_post"
+        things = [comment("c", "t1_a", 1), comment("d", "t3_post", 0), comment("e", "t1_d", 1)]
+        return httpx.Response(200, json={"json": {"data": {"things": things}}})
+
+    async def expand():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await main.expand_more_comments(client, {}, link_id, more_ids, comments, True, 100)
+
+    asyncio.run(expand())
+    assert {c["id"]: c["root_id"] for c in comments} == {"a": "a", "b": "a", "c": "a", "d": "d", "e": "d"}
+
+
+def test_top_level_only_skips_nested_stubs():
+    comments, more_ids, _ = main.extract_comment_records(thread_payload(), include_replies=False, limit=100)
+    assert [c["id"] for c in comments] == ["a"]
+    assert more_ids == ["d"]
+
+
+def refuse_reddit(monkeypatch, status=429):
+    real_client = httpx.AsyncClient
+    transport = httpx.MockTransport(lambda request: httpx.Response(status, text="Too Many Requests"))
+    monkeypatch.setattr(main, "ANTHROPIC_API_KEY", "test-key")
+    monkeypatch.setattr(main.httpx, "AsyncClient", lambda **kwargs: real_client(transport=transport, **kwargs))
+
+
+def test_strict_fetch_raises_instead_of_returning_mock_comments(monkeypatch):
+    refuse_reddit(monkeypatch)
+    url = "https://www.reddit.com/r/x/comments/refused/t/"
+    assert [c["id"] for c in asyncio.run(main.fetch_reddit_comment_records(url))][:2] == ["mock0", "mock1"]
+    try:
+        asyncio.run(main.fetch_reddit_comment_records(url, strict=True))
+    except main.RedditFetchError as e:
+        assert e.status_code == 502 and "429" in e.detail
+    else:
+        raise AssertionError("strict fetch returned comments for a refused request")
@@ -0,0 +1,62 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(scope="module", autouse=True)
+def routing_profiles():
+    main.load_routing_table(force=True)
+    main.build_agent_profiles()
+    yield
+    main.routing_cache.clear()
+
+
+def route(subreddit):
+    main.routing_cache.clear()
+    return main.get_agent_for_subreddit(subreddit)[0]
+
+
+@pytest.mark.parametrize("subreddit,agent", [
+    ("worldnews", "worldnews"),
+    ("politics", "worldnews"),
+    ("askreddit", "askreddit"),
+    ("science", "science"),
+    ("askphysics", "science"),
+    ("history", "askhistorians"),
+])
+def test_configured_names_route_to_their_agent(subreddit, agent):
+    assert route(subreddit) == agent
+
+
+@pytest.mark.parametrize("subreddit", ["technews", "sportsnews", "nbanews", "goodnews"])
+def test_news_lookalikes_are_not_pulled_into_worldnews(subreddit):
+    assert route(subreddit) == "general"
+
+
+def test_similarity_fallback_still_routes_close_names():
+    assert route("canadapolitics") == "worldnews"
+    assert route("askhistory") == "askhistorians"
+
+
+def test_unknown_names_are_not_cached_before_profiles_exist(monkeypatch):
+    monkeypatch.setitem(main.routing_state, "profiles", None)
+    monkeypatch.setattr(main, "schedule_agent_profiles", lambda: None)
+    assert route("canadapolitics") == "general"
+    assert "canadapolitics" not in main.routing_cache
+
+
+def test_a_build_overtaken_by_a_config_reload_is_discarded(monkeypatch):
+    monkeypatch.setitem(main.routing_state, "profiles", main.routing_state["profiles"])
+    built = []
+
+    def compute():
+        built.append(main.routing_state["generation"])
+        if len(built) == 1:
+            # The config file changes while the first build is still reading the corpus
+            main.load_routing_table(force=True)
+        return [f"build{len(built)}"], None
+
+    monkeypatch.setattr(main, "compute_agent_profiles", compute)
+    main.build_agent_profiles()
+    assert len(built) == 2 and built[1] == built[0] + 1
+    assert main.routing_state["profiles"] == (["build2"], None)
@@ -0,0 +1,41 @@
+import main
+
+
+def records(n):
+    return [
+        {"id": f"s{i}", "body": f"comment {i}", "depth": i % 3, "score": (i * 7) % 50, "created_utc": float(i)}
+        for i in range(n)
+    ]
+
+
+def all_fine(monkeypatch):
+    def classify(client, agent_id, texts, max_items=None, cascade=None):
+        return [{"text": t, "label": "FINE", "reason": "", "stage": "agent"} for t in texts]
+
+    monkeypatch.setattr(main, "classify_comments_with_letta", classify)
+
+
+def test_breakdown_covers_every_stratum_and_sums_to_the_total(monkeypatch):
+    all_fine(monkeypatch)
+    comments = records(3000)
+    assert len(main.stratify_comments(comments)) == 18
+    result = main.estimate_verdicts_by_sampling(None, "agent", comments, {"initial": 10, "budget": 200, "margin": 0.3}, seed="t")
+    assert sum(result["verdict_breakdown"].values()) == 3000
+    assert result["verdict_breakdown"]["FINE"] == 3000
+    low, high = result["verdict_intervals"]["FINE"]
+    assert low <= 3000 <= high
+
+
+def test_unsampled_strata_keep_the_interval_wide():
+    strata = {("a",): list(range(0, 50)), ("b",): list(range(50, 100))}
+    labels = {0: "FINE", 1: "FINE", 2: "FINE"}
+    estimates = main.estimate_label_shares(strata, labels, 100, main.normal_quantile(0.95))
+    assert estimates["FINE"]["share"] == 1.0
+    assert estimates["FINE"]["half_width"] > 0.25
+
+
+def test_first_round_reaches_the_largest_unsampled_strata():
+    import random
+    strata = {("big",): list(range(100)), ("mid",): list(range(100, 130)), ("small",): [130]}
+    picked = main.allocate_sample(strata, {}, 2, random.Random(0))
+    assert len(picked) == 2 and picked[0] < 100 and 100 <= picked[1] < 130
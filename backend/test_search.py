@@ -0,0 +1,94 @@
+import pytest
+
+import main
+
+
+def fresh_search_state():
+    return {
+        "loaded": False, "main": None, "delta": None, "columns": None, "corpus_end": 0,
+        "post_ids": [], "post_lookup": {}, "subreddits": [], "subreddit_lookup": {},
+    }
+
+
+def reopen(monkeypatch):
+    """What a restarted worker sees: nothing in memory, only the files on disk."""
+    monkeypatch.setattr(main, "corpus_state", {"mmap": None, "file": None, "by_id": {}, "by_subreddit": {}, "end": 0, "index_size": 0, "loaded": False})
+    monkeypatch.setattr(main, "search_state", fresh_search_state())
+
+
+@pytest.fixture
+def corpus(monkeypatch, tmp_path):
+    path = str(tmp_path / "corpus.jsonl")
+    monkeypatch.setattr(main, "CORPUS_PATH", path)
+    monkeypatch.setattr(main, "CORPUS_INDEX_PATH", path + ".idx")
+    monkeypatch.setattr(main, "SEARCH_INDEX_PATH", path + ".search")
+    monkeypatch.setattr(main, "comment_tree_cache", main.LRUCache(16))
+    for name in (path, path + ".idx"):
+        open(name, "wb").close()
+    reopen(monkeypatch)
+    return path
+
+
+def post(post_id, title, subreddit="alpha", score=1, created=1_000.0, comments=()):
+    return {
+        "url": f"https://www.reddit.com/r/{subreddit}/comments/{post_id}/t/",
+        "post": {"id": post_id, "subreddit": subreddit, "title": title, "selftext": "", "score": score, "created_utc": created},
+        "comments": [
+            {"id": f"{post_id}c{i}", "body": body, "author": "u", "score": score, "created_utc": created + i + 1, "replies": []}
+            for i, body in enumerate(comments)
+        ],
+    }
+
+
+def hits(query, **filters):
+    return [(r["post_id"], r["type"]) for r in main.search_corpus(query, **filters)["results"]]
+
+
+def test_more_frequent_terms_rank_first(corpus):
+    main.append_corpus_post(post("p1", "asyncio tutorial for beginners with plenty of other words"))
+    main.append_corpus_post(post("p2", "asyncio asyncio asyncio"))
+    main.append_corpus_post(post("p3", "gardening in spring"))
+    assert hits("asyncio") == [("p2", "post"), ("p1", "post")]
+    result = main.search_corpus("asyncio")
+    assert result["total"] == 2 and result["results"][0]["bm25"] > result["results"][1]["bm25"]
+
+
+def test_filters_narrow_the_matches(corpus):
+    main.append_corpus_post(post("f1", "kettle", subreddit="alpha", score=5, created=100.0, comments=["kettle boils"]))
+    main.append_corpus_post(post("f2", "kettle", subreddit="beta", score=50, created=900.0))
+    assert {h[0] for h in hits("kettle", subreddit="beta")} == {"f2"}
+    assert hits("kettle", kind="comment") == [("f1", "comment")]
+    assert {h[0] for h in hits("kettle", min_score=10)} == {"f2"}
+    assert {h[0] for h in hits("kettle", since=500.0)} == {"f2"}
+    assert {h[0] for h in hits("kettle", until=500.0)} == {"f1"}
+
+
+def test_delta_survives_compaction_and_a_restart(corpus, monkeypatch):
+    main.append_corpus_post(post("d1", "lighthouse keeper"))
+    main.open_search_index()
+    main.append_corpus_post(post("d2", "lighthouse beam"))
+    main.append_corpus_post(post("d1", "windmill keeper"))
+    assert len(main.search_state["delta"]["columns"]["doc_post"]) > 0
+    before = sorted(hits("lighthouse")), sorted(hits("keeper"))
+    main.compact_search_index()
+    assert len(main.search_state["delta"]["columns"]["doc_post"]) == 0
+    assert (sorted(hits("lighthouse")), sorted(hits("keeper"))) == before == ([("d2", "post")], [("d1", "post")])
+
+    reopen(monkeypatch)
+    assert sorted(hits("lighthouse")) == [("d2", "post")]
+    assert hits("windmill") == [("d1", "post")]
+
+
+def test_segment_from_a_rebuilt_corpus_is_not_trusted(corpus, monkeypatch):
+    main.append_corpus_post(post("s1", "volcano eruption"))
+    main.open_search_index()
+    assert hits("volcano") == [("s1", "post")]
+
+    # Rebuild the corpus with different, longer content: same start, larger size
+    for name in (corpus, corpus + ".idx"):
+        open(name, "wb").close()
+    reopen(monkeypatch)
+    main.append_corpus_post(post("s2", "glacier retreat measured over many decades of careful observation"))
+    reopen(monkeypatch)
+    assert hits("volcano") == []
+    assert hits("glacier") == [("s2", "post")]
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+KEY = "science"
+
+
+class FakeBlocks:
+    def __init__(self, value="", error=None):
+        self.value, self.error, self.calls = value, error, 0
+
+    def retrieve(self, block_id):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return SimpleNamespace(value=self.value)
+
+
+@pytest.fixture
+def letta(monkeypatch):
+    blocks = FakeBlocks(json.dumps({"overview": "stored overview"}))
+    narrations = []
+
+    async def describe(client, subreddit_key, data):
+        narrations.append(subreddit_key)
+        return f"narrated {data.get('overview')}"
+
+    monkeypatch.setattr(main, "LETTA_API_KEY", "test-key")
+    monkeypatch.setattr(main, "get_letta_client", lambda: SimpleNamespace(blocks=blocks))
+    monkeypatch.setattr(main, "describe_subreddit_from_memory", describe)
+    monkeypatch.setattr(main, "subreddit_overview_cache", {})
+    monkeypatch.setattr(main, "subreddit_overview_tasks", {})
+    return SimpleNamespace(blocks=blocks, narrations=narrations)
+
+
+def test_fresh_entry_is_served_without_touching_letta(letta):
+    main.subreddit_overview_cache[KEY] = {"hash": "h", "overview": "cached overview", "refreshed_at": time.time()}
+    assert client.get(f"/api/subreddit/{KEY}/summary").json()["overview"] == "cached overview"
+    assert letta.blocks.calls == 0
+
+
+def test_stale_refresh_renarrates_only_when_the_block_changed(letta):
+    first = asyncio.run(main.refresh_subreddit_overview(KEY))
+    assert first["overview"] == "narrated stored overview" and letta.narrations == [KEY]
+
+    first["refreshed_at"] = 0.0
+    assert main.subreddit_overview_stale(first)
+    again = asyncio.run(main.refresh_subreddit_overview(KEY))
+    assert again["overview"] == "narrated stored overview" and letta.narrations == [KEY]
+    assert not main.subreddit_overview_stale(again)
+
+    letta.blocks.value = json.dumps({"overview": "new overview"})
+    again["refreshed_at"] = 0.0
+    assert asyncio.run(main.refresh_subreddit_overview(KEY))["overview"] == "narrated new overview"
+
+
+def test_failed_refresh_is_cached_and_keeps_the_last_good_value(letta):
+    letta.blocks.error = RuntimeError("letta down")
+    fallback = client.get(f"/api/subreddit/{KEY}/summary").json()["overview"]
+    assert fallback and letta.blocks.calls == 1
+    # The failure is cached: the next page load does not call Letta again
+    assert client.get(f"/api/subreddit/{KEY}/summary").json()["overview"] == fallback
+    assert letta.blocks.calls == 1
+    assert main.subreddit_overview_cache[KEY]["ttl"] == main.SUBREDDIT_OVERVIEW_RETRY_TTL
+
+    main.subreddit_overview_cache[KEY] = {"hash": "h", "overview": "last good", "refreshed_at": 0.0}
+    entry = asyncio.run(main.refresh_subreddit_overview(KEY))
+    assert entry["overview"] == "last good" and not main.subreddit_overview_stale(entry)
+    entry["refreshed_at"] -= main.SUBREDDIT_OVERVIEW_RETRY_TTL + 1
+    assert main.subreddit_overview_stale(entry)
@@ -0,0 +1,29 @@
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def test_live_thread_url_variants_share_one_timeline(monkeypatch):
+    records = [{"id": f"t{i}", "body": f"comment {i}", "score": 1, "created_utc": 1_700_000_000.0 + i * 60} for i in range(5)]
+
+    async def fake_fetch(url, **options):
+        return records
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", fake_fetch)
+    first = client.get("/api/timeline", params={"thread_url": "https://www.reddit.com/r/x/comments/tl1/t/"}).json()
+    again = client.get("/api/timeline", params={"thread_url": "https://www.reddit.com/r/x/comments/tl1/t/.json?sort=new"}).json()
+    assert first["new_comments"] == 5
+    assert again["new_comments"] == 0
+
+
+def test_live_timeline_reports_a_failed_fetch(monkeypatch):
+    async def refused(url, **options):
+        assert options.get("strict")
+        raise main.RedditFetchError("Reddit returned HTTP 429")
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", refused)
+    url = "https://www.reddit.com/r/x/comments/tlfail/t/"
+    assert client.get("/api/timeline", params={"thread_url": url}).status_code == 502
+    assert f"url:{main.thread_key(url)}" not in main.timeline_cache
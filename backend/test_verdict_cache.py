@@ -0,0 +1,56 @@
+import pytest
+
+import main
+
+LONG_FINE = ("I read the whole article and honestly the part about the new water treatment plant "
+             "was the most interesting bit, the city council should publish the budget numbers too")
+
+
+@pytest.fixture
+def agent(request):
+    agent_id = f"verdict-{request.node.name}"
+    yield agent_id
+    main.verdict_caches.pop(agent_id, None)
+
+
+def test_exact_hit_ignores_case_and_punctuation(agent):
+    main.store_verdict(agent, "Great point, thanks!", "FINE", "polite")
+    hit = main.lookup_verdict(agent, "great point thanks")
+    assert hit["cached"] == "exact" and hit["label"] == "FINE"
+
+
+def test_near_duplicate_reuses_the_verdict(agent):
+    main.store_verdict(agent, LONG_FINE, "FINE", "on topic")
+    hit = main.lookup_verdict(agent, LONG_FINE.replace("honestly ", ""))
+    assert hit is not None and hit["cached"] == "near" and hit["label"] == "FINE"
+
+
+def test_near_duplicate_with_appended_abuse_is_not_fine(agent):
+    main.store_verdict(agent, LONG_FINE, "FINE", "on topic")
+    assert main.lookup_verdict(agent, LONG_FINE + " and you should kill yourself") is None
+    assert main.lookup_verdict(agent, LONG_FINE + " and subscribe to my channel") is None
+
+
+def test_near_duplicate_of_a_violation_is_still_reused(agent):
+    spam = "free money giveaway click here to claim your prize before it runs out today only friends"
+    main.store_verdict(agent, spam, "VIOLATION", "spam")
+    hit = main.lookup_verdict(agent, spam + " hurry")
+    assert hit is not None and hit["label"] == "VIOLATION"
+
+
+def test_links_are_part_of_the_key(agent):
+    main.store_verdict(agent, "check this out https://good.example/article", "FINE", "link share")
+    assert main.lookup_verdict(agent, "check this out https://scam.example/free-money") is None
+    assert main.lookup_verdict(agent, "Check this out https://www.good.example/article?utm=x")["cached"] == "exact"
+
+
+def test_cache_survives_concurrent_classification_threads(agent):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def work(i):
+        main.store_verdict(agent, f"comment number {i} about the topic", "FINE", "ok")
+        return main.lookup_verdict(agent, f"comment number {i} about the topic")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(work, range(400)))
+    assert all(r is not None and r["label"] == "FINE" for r in results)
@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import main
+
+
+def new_watch(url):
+    # A second worker's view of the same thread: its own watch entry and poll state
+    return {
+        "key": main.thread_key(url), "url": url, "seq": 0, "subscribers": set(),
+        "state": {"seen_ids": set(), "count": 0, "lock": asyncio.Lock()},
+        "interval": main.WATCH_MIN_INTERVAL, "rate": 0.0, "last_poll": 0.0, "next_poll": 0.0, "polling": False,
+    }
+
+
+def test_workers_share_one_poll_per_thread(monkeypatch, tmp_path):
+    calls = {"fetch": 0, "chat": 0}
+
+    async def fake_fetch(url, sort="", strict=False):
+        calls["fetch"] += 1
+        return [{"id": f"w{i}", "body": f"comment {i}", "score": 1, "created_utc": float(i)} for i in range(3)]
+
+    async def fake_chat(messages, max_tokens=250):
+        calls["chat"] += 1
+        return json.dumps({"sentiment_score": 0.4, "top_keywords": ["x"]})
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", fake_fetch)
+    monkeypatch.setattr(main, "claude_chat", fake_chat)
+    monkeypatch.setitem(main.watch_shared, "dir", str(tmp_path))
+    url = "https://www.reddit.com/r/x/comments/shared1/t/"
+
+    async def scenario():
+        first, second = new_watch(url), new_watch(url)
+        queue = asyncio.Queue()
+        second["subscribers"].add(queue)
+        await main.poll_watched_thread(first)
+        await main.poll_watched_thread(second)
+        return first, second, queue
+
+    first, second, queue = asyncio.run(scenario())
+    assert calls == {"fetch": 1, "chat": 1}
+    assert second["state"]["count"] == 3 and second["state"]["seen_ids"] == first["state"]["seen_ids"]
+    update = queue.get_nowait()
+    assert update["count"] == 3 and len(update["new_comments"]) == 3
+
+
+def test_a_held_lease_skips_the_poll(monkeypatch, tmp_path):
+    async def fail_fetch(url, sort="", strict=False):
+        raise AssertionError("should not poll while another worker holds the lease")
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", fail_fetch)
+    monkeypatch.setitem(main.watch_shared, "dir", str(tmp_path))
+    watch = new_watch("https://www.reddit.com/r/x/comments/shared2/t/")
+    lease = main.acquire_watch_lease(watch["key"])
+    try:
+        asyncio.run(main.poll_watched_thread(watch))
+    finally:
+        main.release_watch_lease(lease)
+    assert watch["state"]["count"] == 0 and not watch["polling"]
+
+
+def test_a_failed_poll_pushes_nothing(monkeypatch):
+    async def refused(url, sort="", strict=False):
+        raise main.RedditFetchError("Reddit returned HTTP 503")
+
+    monkeypatch.setattr(main, "fetch_reddit_comment_records", refused)
+    monkeypatch.setitem(main.watch_shared, "dir", None)
+    watch = new_watch("https://www.reddit.com/r/x/comments/refused/t/")
+    queue = asyncio.Queue()
+    watch["subscribers"].add(queue)
+    asyncio.run(main.poll_watched_thread(watch))
+    assert queue.empty()
+    assert watch["state"]["count"] == 0 and not watch["state"]["seen_ids"]
+    assert watch["interval"] == main.WATCH_MIN_INTERVAL * 2